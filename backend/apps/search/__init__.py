@@ -0,0 +1,7 @@
+'''
+Pluggable search backend: "atlas" is the MongoDB Atlas cluster through Motor, "local" is an
+ in-process engine that executes the same $search/$searchMeta/$vectorSearch pipelines
+ over an in-memory (synthetic or exported) corpus for load testing and profiling
+'''
+from .local import LocalClient, LocalCollection, LocalCursor, LocalDatabase
+from .corpus import populate, synthetic_drugs, synthetic_trials
@@ -0,0 +1,148 @@
+import os
+import uuid
+import numpy as np
+from bson import json_util
+from datetime import datetime, timedelta
+
+conditions = [
+    'Breast Cancer', 'Lung Cancer', 'Prostate Cancer', 'Melanoma', 'Leukemia', 'Lymphoma',
+    'Type 2 Diabetes', 'Type 1 Diabetes', 'Hypertension', 'Heart Failure', 'Atrial Fibrillation',
+    'Asthma', 'COPD', 'Alzheimer Disease', 'Parkinson Disease', 'Multiple Sclerosis', 'Depression',
+    'Schizophrenia', 'HIV Infections', 'Hepatitis C', 'COVID-19', 'Influenza', 'Obesity',
+    'Rheumatoid Arthritis', 'Psoriasis', 'Crohn Disease', 'Chronic Kidney Disease', 'Stroke',
+]
+interventions = [
+    'Pembrolizumab', 'Nivolumab', 'Metformin', 'Insulin Glargine', 'Semaglutide', 'Atorvastatin',
+    'Lisinopril', 'Apixaban', 'Placebo', 'Adalimumab', 'Remdesivir', 'Sertraline', 'Donepezil',
+    'Levodopa', 'Tenofovir', 'Sofosbuvir', 'Dexamethasone', 'Cisplatin', 'Radiation', 'Exercise',
+    'Cognitive Behavioral Therapy', 'Vaccine', 'Surgery', 'Dietary Supplement',
+]
+intervention_types = ['Drug', 'Biological', 'Device', 'Procedure', 'Behavioral', 'Radiation', 'Dietary Supplement']
+sponsors = [
+    'National Cancer Institute (NCI)', 'Pfizer', 'Merck Sharp & Dohme LLC', 'Novartis', 'AstraZeneca',
+    'Hoffmann-La Roche', 'Eli Lilly and Company', 'GlaxoSmithKline', 'Mayo Clinic', 'M.D. Anderson Cancer Center',
+    'Massachusetts General Hospital', 'Assiut University', 'Cairo University', 'Sanofi', 'Bayer',
+]
+statuses = ['Completed', 'Recruiting', 'Active, not recruiting', 'Terminated', 'Withdrawn', 'Unknown status', 'Not yet recruiting']
+phases = ['Phase 1', 'Phase 2', 'Phase 3', 'Phase 4', 'Phase 1/Phase 2', 'Phase 2/Phase 3', 'N/A']
+routes = ['ORAL', 'TOPICAL', 'INTRAVENOUS', 'SUBCUTANEOUS', 'INTRAMUSCULAR', 'OPHTHALMIC', 'NASAL']
+manufacturers = [
+    'Pfizer Laboratories Div Pfizer Inc', 'Teva Pharmaceuticals USA, Inc.', 'Mylan Pharmaceuticals Inc.',
+    'Aurobindo Pharma Limited', 'Sun Pharmaceutical Industries, Inc.', 'Walgreens', 'CVS Pharmacy',
+    'Cardinal Health 107, LLC', 'Amneal Pharmaceuticals LLC', 'Lupin Pharmaceuticals, Inc.',
+]
+words = (
+    'randomized double blind placebo controlled study efficacy safety tolerability patients adults '
+    'treatment dose response primary endpoint secondary outcome survival progression free overall '
+    'response rate adverse events pharmacokinetics open label multicenter trial cohort baseline '
+    'weeks months follow up quality of life biomarker therapy combination standard care evaluate '
+    'investigate compare determine assess improvement reduction risk mortality hospitalization'
+).split()
+
+def topic_vectors(rng, count: int, dimensions: int) -> np.ndarray:
+    topics = rng.standard_normal((count, dimensions)).astype(np.float32)
+    return topics / np.linalg.norm(topics, axis=1, keepdims=True)
+
+def noisy(rng, topic: np.ndarray, noise: float = 0.6) -> list:
+    vector = topic + noise * rng.standard_normal(topic.shape).astype(np.float32) / np.sqrt(topic.shape[0])
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def sentence(rng, topic_words: list, length: int) -> str:
+    chosen = list(rng.choice(words, length)) + list(rng.choice(topic_words, max(1, length // 5)))
+    rng.shuffle(chosen)
+    return ' '.join(chosen).capitalize() + '.'
+
+def synthetic_trials(count: int, dimensions: int = 384, seed: int = 0) -> list:
+    '''
+    Trial documents shaped like the ClinicalTrials.trials collection; vectors are
+     clustered around the trial's condition so vector search has structure to find
+    '''
+    rng = np.random.default_rng(seed)
+    topics = topic_vectors(rng, len(conditions), dimensions)
+    trials = []
+    for i in range(count):
+        c = int(rng.integers(len(conditions)))
+        condition = [conditions[c]] + ([conditions[int(rng.integers(len(conditions)))]] if rng.random() < 0.2 else [])
+        chosen_interventions = list(rng.choice(interventions, int(rng.integers(1, 3)), replace=False))
+        topic_words = condition[0].lower().split() + ' '.join(chosen_interventions).lower().split()
+        start_date = datetime(2010, 1, 1) + timedelta(days=int(rng.integers(0, 15 * 365)))
+        brief_title = f"{chosen_interventions[0]} in {condition[0]}: {sentence(rng, topic_words, 5)}"
+        trials.append({
+            'nct_id': f'NCT{i:08d}',
+            'brief_title': brief_title,
+            'official_title': f"A {rng.choice(phases)} Study of {' and '.join(chosen_interventions)} for {condition[0]}",
+            'brief_summary': ' '.join(sentence(rng, topic_words, 12) for _ in range(3)),
+            'detailed_description': ' '.join(sentence(rng, topic_words, 15) for _ in range(int(rng.integers(4, 12)))),
+            'condition': condition,
+            'condition_mesh_term': condition,
+            'intervention': list(rng.choice(intervention_types, len(chosen_interventions))),
+            'intervention_mesh_term': chosen_interventions,
+            'sponsors': [{
+                'agency': str(rng.choice(sponsors)),
+                'agency_class': str(rng.choice(['Industry', 'Other', 'NIH'])),
+                'lead_or_collaborator': 'lead',
+            }],
+            'status': str(rng.choice(statuses)),
+            'phase': str(rng.choice(phases)),
+            'study_type': str(rng.choice(['Interventional', 'Observational'])),
+            'gender': str(rng.choice(['All', 'Female', 'Male'], p=[0.8, 0.12, 0.08])),
+            'minimum_age': int(rng.choice([0, 18, 18, 18, 40, 65])),
+            'maximum_age': int(rng.choice([17, 65, 75, 99])),
+            'enrollment': int(rng.integers(10, 5000)),
+            'start_date': start_date,
+            'completion_date': start_date + timedelta(days=int(rng.integers(90, 5 * 365))),
+            'url': f'https://clinicaltrials.gov/study/NCT{i:08d}',
+            'facility': [{'name': f'Site {int(rng.integers(1000))}', 'city': 'Springfield', 'country': 'United States'}],
+            'detailed_description_vector': noisy(rng, topics[c]),
+            'brief_summary_vector': noisy(rng, topics[c]),
+        })
+    return trials
+
+def synthetic_drugs(count: int, dimensions: int = 384, seed: int = 1) -> list:
+    '''
+    Drug label documents shaped like the ClinicalTrials.drug_data (openFDA) collection
+    '''
+    rng = np.random.default_rng(seed)
+    topics = topic_vectors(rng, len(conditions), dimensions)
+    drugs = []
+    for _ in range(count):
+        c = int(rng.integers(len(conditions)))
+        ingredient = str(rng.choice(interventions))
+        brand = f"{ingredient[:4].upper()}{str(rng.choice(['ex', 'ol', 'ia', 'ra', 'vo']))}"
+        drugs.append({
+            'id': str(uuid.UUID(int=int(rng.integers(2**62)) << 64 | int(rng.integers(2**62)))),
+            'effective_time': datetime(2015, 1, 1) + timedelta(days=int(rng.integers(0, 9 * 365))),
+            'brand_name': [brand],
+            'active_ingredient': [f'{ingredient} {int(rng.choice([5, 10, 20, 50, 100]))} mg'],
+            'purpose': [f'Treatment of {conditions[c]}'],
+            'indications_and_usage': [f'{brand} is indicated for {conditions[c].lower()}. ' + sentence(rng, [ingredient.lower()], 10)],
+            'description': [sentence(rng, [ingredient.lower(), conditions[c].lower()], 20)],
+            'openfda': {
+                'brand_name': [brand],
+                'generic_name': [ingredient.upper()],
+                'manufacturer_name': [str(rng.choice(manufacturers))],
+                'route': [str(rng.choice(routes))],
+            },
+            'description_vector': noisy(rng, topics[c]),
+        })
+    return drugs
+
+def load_jsonl(path: str) -> list:
+    '''
+    Reads a mongoexport (Extended JSON, one document per line) file
+    '''
+    with open(path) as lines:
+        return [json_util.loads(line) for line in lines if line.strip()]
+
+async def populate(database, path: str = None, trials: int = 2000, drugs: int = 1000, dimensions: int = 384):
+    '''
+    Loads trials.jsonl and drug_data.jsonl from path when present, otherwise generates
+     a synthetic corpus of the given size
+    '''
+    for name, generate, count in (('trials', synthetic_trials, trials), ('drug_data', synthetic_drugs, drugs)):
+        export = os.path.join(path, f'{name}.jsonl') if path else None
+        if export and os.path.exists(export):
+            documents = load_jsonl(export)
+        else:
+            documents = generate(count, dimensions)
+        await database[name].insert_many(documents)
@@ -0,0 +1,268 @@
+import copy
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from .pipeline import get_path, matches, project, run_pipeline, set_path, sort_key
+from .text import TextIndex
+from .vector import VectorIndex
+
+class LocalCursor:
+    '''
+    Lazily evaluated cursor with the subset of the Motor cursor API the routers use
+    '''
+
+    def __init__(self, produce):
+        self.produce = produce
+        self.sort_spec = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key, direction=1):
+        self.sort_spec = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, count: int):
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def max_time_ms(self, milliseconds: int):
+        return self
+
+    def _evaluate(self):
+        if self.results is None:
+            results = self.produce()
+            for field, direction in reversed(self.sort_spec):
+                results.sort(key=lambda d: sort_key(get_path(d, field)), reverse=direction == -1)
+            results = results[self.skip_count:]
+            if self.limit_count:
+                results = results[:self.limit_count]
+            self.results = results
+        return self.results
+
+    async def to_list(self, length=None):
+        results = self._evaluate()
+        return results[:length] if length else list(results)
+
+    def __aiter__(self):
+        self._position = 0
+        return self
+
+    async def __anext__(self):
+        results = self._evaluate()
+        if self._position >= len(results):
+            raise StopAsyncIteration
+        self._position += 1
+        return results[self._position - 1]
+
+    async def close(self):
+        self.results = []
+
+class LocalCollection:
+    '''
+    In-process stand-in for an Atlas collection: documents in a list, Atlas Search
+     text indexes and vector indexes built lazily per path and rebuilt after writes
+    '''
+
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.documents = []
+        self.unique_keys = {}
+        self.text_indexes = {}
+        self.vector_indexes = {}
+
+    def _changed(self):
+        self.text_indexes.clear()
+        self.vector_indexes.clear()
+
+    def text_index(self, path: str) -> TextIndex:
+        if path not in self.text_indexes:
+            self.text_indexes[path] = TextIndex(self.documents, path)
+        return self.text_indexes[path]
+
+    def vector_index(self, path: str) -> VectorIndex:
+        if path not in self.vector_indexes:
+            self.vector_indexes[path] = VectorIndex(self.documents, path, ivf_min_size=self.database.ivf_min_size)
+        return self.vector_indexes[path]
+
+    def aggregate(self, pipeline: list, **kwargs):
+        return LocalCursor(lambda: [d for d, _ in run_pipeline(self, pipeline)])
+
+    def find(self, filter: dict = None, projection: dict = None, **kwargs):
+        def produce():
+            found = [d for d in self.documents if matches(d, filter or {})]
+            if projection:
+                return [project(d, projection, {}, {}) for d in found]
+            return [copy.deepcopy(d) for d in found]
+        return LocalCursor(produce)
+
+    async def find_one(self, filter: dict = None, projection: dict = None, **kwargs):
+        for document in self.documents:
+            if matches(document, filter or {}):
+                return project(document, projection, {}, {}) if projection else copy.deepcopy(document)
+        return None
+
+    async def count_documents(self, filter: dict, limit: int = 0, **kwargs):
+        count = sum(1 for d in self.documents if matches(d, filter))
+        return min(count, limit) if limit else count
+
+    async def estimated_document_count(self, **kwargs):
+        return len(self.documents)
+
+    async def create_index(self, keys, unique: bool = False, **kwargs):
+        names = tuple([keys] if isinstance(keys, str) else [k for k, _ in keys])
+        if unique and names not in self.unique_keys:
+            values = [self._unique_value(d, names) for d in self.documents]
+            if len(set(values)) != len(values):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {names}")
+            self.unique_keys[names] = set(values)
+        return '_'.join(f'{name}_1' for name in names)
+
+    def _unique_value(self, document: dict, keys: tuple):
+        return tuple(repr(get_path(document, k)) for k in keys)
+
+    def _reindex_unique(self):
+        for keys in self.unique_keys:
+            self.unique_keys[keys] = {self._unique_value(d, keys) for d in self.documents}
+
+    def _insert(self, document: dict):
+        document.setdefault('_id', ObjectId())
+        for keys, values in self.unique_keys.items():
+            if self._unique_value(document, keys) in values:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} dup key: {keys}")
+        for keys, values in self.unique_keys.items():
+            values.add(self._unique_value(document, keys))
+        self.documents.append(document)
+        return document['_id']
+
+    async def insert_one(self, document: dict, **kwargs):
+        inserted_id = self._insert(document)
+        self._changed()
+        return InsertOneResult(inserted_id, True)
+
+    async def insert_many(self, documents: list, **kwargs):
+        inserted_ids = [self._insert(d) for d in documents]
+        self._changed()
+        return InsertManyResult(inserted_ids, True)
+
+    def _update(self, document: dict, update: dict, inserting: bool):
+        if not any(k.startswith('$') for k in update):
+            # replacement document
+            document.clear()
+            document.update(update)
+            return
+        for operator, fields in update.items():
+            for path, value in fields.items():
+                if operator == '$set' or (operator == '$setOnInsert' and inserting):
+                    set_path(document, path, value)
+                elif operator == '$unset':
+                    document.pop(path, None)
+                elif operator == '$inc':
+                    set_path(document, path, (get_path(document, path) or 0) + value)
+                elif operator != '$setOnInsert':
+                    raise OperationFailure(f"Unsupported update operator in the local engine: {operator}")
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        return await self._update_matching(filter, update, upsert, many=False)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        return await self._update_matching(filter, update, upsert, many=True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs):
+        return await self._update_matching(filter, replacement, upsert, many=False)
+
+    async def _update_matching(self, filter: dict, update: dict, upsert: bool, many: bool):
+        matched = 0
+        for document in self.documents:
+            if matches(document, filter):
+                _id = document['_id']
+                self._update(document, update, inserting=False)
+                document['_id'] = _id
+                self._reindex_unique()
+                matched += 1
+                if not many:
+                    break
+
+        upserted_id = None
+        if matched == 0 and upsert:
+            document = {k: v for k, v in filter.items() if not k.startswith('$') and not isinstance(v, dict)}
+            self._update(document, update, inserting=True)
+            upserted_id = self._insert(document)
+
+        if matched or upserted_id:
+            self._changed()
+        raw = {'n': matched or (1 if upserted_id else 0), 'nModified': matched}
+        if upserted_id:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    async def delete_many(self, filter: dict, **kwargs):
+        kept = [d for d in self.documents if not matches(d, filter)]
+        deleted = len(self.documents) - len(kept)
+        self.documents[:] = kept
+        self._reindex_unique()
+        self._changed()
+        return DeleteResult({'n': deleted}, True)
+
+    async def drop(self):
+        self.documents.clear()
+        self.unique_keys.clear()
+        self._changed()
+
+class LocalDatabase:
+    def __init__(self, name: str, ivf_min_size: int = 20000):
+        self.name = name
+        self.ivf_min_size = ivf_min_size
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> LocalCollection:
+        if name not in self.collections:
+            self.collections[name] = LocalCollection(self, name)
+        return self.collections[name]
+
+    async def list_collection_names(self):
+        return list(self.collections)
+
+    async def command(self, command: dict, **kwargs):
+        '''
+        Only {'explain': {'aggregate': ...}}: runs the pipeline and reports each stage's
+         output count and time, roughly the shape of executionStats verbosity
+        '''
+        explain = command.get('explain') if isinstance(command, dict) else None
+        if not isinstance(explain, dict) or 'aggregate' not in explain:
+            raise OperationFailure(f"Unsupported command in the local engine: {command}")
+
+        stages = []
+        run_pipeline(self[explain['aggregate']], explain.get('pipeline', []), stats=stages)
+        return {
+            'explainVersion': 'local',
+            'stages': stages,
+            'command': {'aggregate': explain['aggregate']},
+            'ok': 1.0,
+        }
+
+class LocalClient:
+    '''
+    Drop-in replacement for AsyncIOMotorClient backed by the in-process engine
+    '''
+
+    def __init__(self, ivf_min_size: int = 20000):
+        self.ivf_min_size = ivf_min_size
+        self.databases = {}
+
+    def __getitem__(self, name: str) -> LocalDatabase:
+        if name not in self.databases:
+            self.databases[name] = LocalDatabase(name, ivf_min_size=self.ivf_min_size)
+        return self.databases[name]
+
+    def close(self):
+        pass
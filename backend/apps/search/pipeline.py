@@ -0,0 +1,586 @@
+import base64
+import re
+import time
+from collections import Counter, defaultdict
+from pymongo.errors import OperationFailure
+
+from .text import values_at
+
+search_options = {
+    'index', 'count', 'sort', 'searchAfter', 'searchBefore', 'highlight',
+    'returnStoredSource', 'scoreDetails', 'concurrent', 'tracking', 'facet',
+}
+
+################
+# Expressions  #
+################
+def get_path(document, path: str):
+    '''
+    Field path lookup with MongoDB semantics: traversing an array maps over its elements
+    '''
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, list):
+            value = [v.get(part) for v in value if isinstance(v, dict) and part in v]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+def evaluate(expression, document, meta: dict, variables: dict):
+    if isinstance(expression, str):
+        if expression.startswith('$$'):
+            name, _, path = expression[2:].partition('.')
+            value = variables.get(name)
+            return get_path(value, path) if path else value
+        if expression.startswith('$'):
+            return get_path(document, expression[1:])
+        return expression
+
+    if isinstance(expression, list):
+        return [evaluate(e, document, meta, variables) for e in expression]
+
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator, argument = next(iter(expression.items()))
+            if operator == '$meta':
+                return meta.get(argument)
+            if operator == '$literal':
+                return argument
+            if operator == '$concat':
+                parts = [evaluate(a, document, meta, variables) for a in argument]
+                return None if any(p is None for p in parts) else ''.join(parts)
+            if operator == '$ifNull':
+                for a in argument:
+                    value = evaluate(a, document, meta, variables)
+                    if value is not None:
+                        return value
+                return None
+            if operator == '$arrayElemAt':
+                array, index = (evaluate(a, document, meta, variables) for a in argument)
+                try:
+                    return array[index]
+                except (IndexError, TypeError):
+                    return None
+            if operator == '$size':
+                value = evaluate(argument, document, meta, variables)
+                return len(value) if isinstance(value, list) else None
+        return {k: evaluate(v, document, meta, variables) for k, v in expression.items()}
+
+    return expression
+
+def set_path(document: dict, path: str, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+################
+# $project     #
+################
+def project(document: dict, spec: dict, meta: dict, variables: dict) -> dict:
+    include_id = spec.get('_id', 1) not in (0, False)
+    fields = {k: v for k, v in spec.items() if k != '_id'}
+    inclusion = any(v not in (0, False) for v in fields.values())
+
+    if not inclusion:
+        projected = {k: v for k, v in document.items()}
+        for path in fields:
+            unset_path(projected, path)
+        if not include_id:
+            projected.pop('_id', None)
+        return projected
+
+    projected = {}
+    if include_id and '_id' in document:
+        projected['_id'] = document['_id']
+    if spec.get('_id') not in (None, 0, 1, False, True):
+        projected['_id'] = evaluate(spec['_id'], document, meta, variables)
+
+    tree = {}
+    for path, value in fields.items():
+        if value in (1, True):
+            node = tree
+            parts = path.split('.')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+                if node is True:
+                    break
+            else:
+                node[parts[-1]] = True
+        else:
+            set_path(projected, path, evaluate(value, document, meta, variables))
+
+    projected.update(include_tree(document, tree))
+    return projected
+
+def include_tree(value, tree):
+    if isinstance(value, list):
+        return [include_tree(v, tree) for v in value if isinstance(v, (dict, list))]
+    included = {}
+    for key, subtree in tree.items():
+        if key not in value:
+            continue
+        if subtree is True:
+            included[key] = value[key]
+        elif isinstance(value[key], (dict, list)):
+            included[key] = include_tree(value[key], subtree)
+    return included
+
+def unset_path(document: dict, path: str):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+################
+# $match       #
+################
+def compare(a, b, operator: str) -> bool:
+    try:
+        if operator == '$gt':
+            return a > b
+        if operator == '$gte':
+            return a >= b
+        if operator == '$lt':
+            return a < b
+        if operator == '$lte':
+            return a <= b
+    except TypeError:
+        return False
+    return False
+
+def candidate_values(document, path: str) -> list:
+    value = get_path(document, path)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value + [value]
+    return [value]
+
+def matches(document, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(document, q) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, q) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(document, q) for q in condition):
+                return False
+        elif not field_matches(candidate_values(document, key), condition):
+            return False
+    return True
+
+def field_matches(values: list, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for operator, argument in condition.items():
+            if operator == '$eq':
+                ok = argument in values
+            elif operator == '$ne':
+                ok = argument not in values
+            elif operator == '$in':
+                ok = any(v in argument for v in values)
+            elif operator == '$nin':
+                ok = not any(v in argument for v in values)
+            elif operator == '$exists':
+                ok = bool(values) == bool(argument)
+            elif operator in ('$gt', '$gte', '$lt', '$lte'):
+                ok = any(compare(v, argument, operator) for v in values)
+            elif operator == '$regex':
+                pattern = re.compile(argument, re.IGNORECASE if 'i' in condition.get('$options', '') else 0)
+                ok = any(isinstance(v, str) and pattern.search(v) for v in values)
+            elif operator == '$options':
+                ok = True
+            elif operator == '$not':
+                ok = not field_matches(values, argument)
+            else:
+                raise OperationFailure(f"unknown operator: {operator}")
+            if not ok:
+                return False
+        return True
+    return condition in values
+
+################
+# $search      #
+################
+def search_operator(stage: dict):
+    for name, operator in stage.items():
+        if name not in search_options:
+            return name, operator
+    return None, None
+
+def run_operator(collection, name: str, operator: dict) -> dict:
+    '''
+    Evaluates an Atlas Search operator; returns {ordinal: score} for matching documents
+    '''
+    documents = collection.documents
+    if name == 'compound':
+        return run_compound(collection, operator)
+
+    if name == 'text':
+        paths = operator['path'] if isinstance(operator['path'], list) else [operator['path']]
+        queries = operator['query'] if isinstance(operator['query'], list) else [operator['query']]
+        scores = defaultdict(float)
+        for path in paths:
+            index = collection.text_index(path)
+            for query in queries:
+                if query is None:
+                    continue
+                for ordinal, score in index.text(query, operator.get('fuzzy')).items():
+                    scores[ordinal] += score
+        return apply_score(scores, operator.get('score'))
+
+    if name == 'exists':
+        return apply_score(
+            {o: 1.0 for o, d in enumerate(documents) if values_at(d, operator['path'])},
+            operator.get('score'))
+
+    if name == 'equals':
+        return apply_score(
+            {o: 1.0 for o, d in enumerate(documents) if operator['value'] in values_at(d, operator['path'])},
+            operator.get('score'))
+
+    if name == 'range':
+        paths = operator['path'] if isinstance(operator['path'], list) else [operator['path']]
+        bounds = [(op, operator[op.lstrip('$')]) for op in ('$gt', '$gte', '$lt', '$lte') if op.lstrip('$') in operator]
+        scores = {}
+        for ordinal, document in enumerate(documents):
+            for path in paths:
+                if any(all(compare(v, b, op) for op, b in bounds) for v in values_at(document, path)):
+                    scores[ordinal] = 1.0
+                    break
+        return apply_score(scores, operator.get('score'))
+
+    if name == 'queryString':
+        ordinals = QueryStringParser(collection, operator['query'], operator.get('defaultPath')).parse()
+        return apply_score({o: 1.0 for o in ordinals}, operator.get('score'))
+
+    if name == 'autocomplete':
+        paths = operator['path'] if isinstance(operator['path'], list) else [operator['path']]
+        scores = defaultdict(float)
+        for path in paths:
+            for ordinal, score in collection.text_index(path).autocomplete(operator['query']).items():
+                scores[ordinal] += score
+        return apply_score(scores, operator.get('score'))
+
+    if name == 'moreLikeThis':
+        likes = operator['like'] if isinstance(operator['like'], list) else [operator['like']]
+        scores = defaultdict(float)
+        for like in likes:
+            for path, text in flatten_like(like):
+                index = collection.text_index(path)
+                for term in index.top_terms(text):
+                    for ordinal, score in index.bm25(term).items():
+                        scores[ordinal] += score
+        return apply_score(scores, operator.get('score'))
+
+    raise OperationFailure(f"Unsupported $search operator in the local engine: {name}")
+
+def flatten_like(like: dict, prefix: str = ''):
+    for key, value in like.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            yield from flatten_like(value, f'{path}.')
+        elif isinstance(value, list):
+            yield path, ' '.join(v for v in value if isinstance(v, str))
+        elif isinstance(value, str):
+            yield path, value
+
+def run_clauses(collection, clauses) -> list:
+    if isinstance(clauses, dict):
+        clauses = [clauses]
+    return [run_operator(collection, *next(iter(clause.items()))) for clause in clauses or []]
+
+def run_compound(collection, compound: dict) -> dict:
+    must = run_clauses(collection, compound.get('must'))
+    filters = run_clauses(collection, compound.get('filter'))
+    should = run_clauses(collection, compound.get('should'))
+    must_not = run_clauses(collection, compound.get('mustNot'))
+
+    scores = None
+    for clause in must:
+        scores = dict(clause) if scores is None else {o: s + clause[o] for o, s in scores.items() if o in clause}
+    for clause in filters:
+        scores = {o: 0.0 for o in clause} if scores is None else {o: s for o, s in scores.items() if o in clause}
+
+    minimum_should_match = compound.get('minimumShouldMatch', 0 if scores is not None else 1)
+    if should:
+        matched = Counter(o for clause in should for o in clause)
+        if scores is None:
+            scores = {o: 0.0 for o, n in matched.items() if n >= minimum_should_match}
+        elif minimum_should_match > 0:
+            scores = {o: s for o, s in scores.items() if matched[o] >= minimum_should_match}
+        for clause in should:
+            for ordinal, score in clause.items():
+                if ordinal in scores:
+                    scores[ordinal] += score
+
+    scores = scores or {}
+    for clause in must_not:
+        scores = {o: s for o, s in scores.items() if o not in clause}
+    return apply_score(scores, compound.get('score'))
+
+def apply_score(scores: dict, score: dict = None) -> dict:
+    if not score:
+        return dict(scores)
+    if 'boost' in score:
+        factor = score['boost'].get('value', 1)
+        return {o: s * factor for o, s in scores.items()}
+    if 'constant' in score:
+        return {o: score['constant']['value'] for o in scores}
+    return dict(scores)
+
+class QueryStringParser:
+    '''
+    The subset of the Lucene queryString syntax the routers generate:
+     field:value and field:"quoted value" terms combined with AND/OR/NOT and parentheses
+    '''
+
+    token_re = re.compile(r'\s*(\(|\)|"[^"]*"|[^\s()"]+:"[^"]*"|[^\s()]+)')
+
+    def __init__(self, collection, query: str, default_path: str = None):
+        self.collection = collection
+        self.default_path = default_path
+        self.tokens = self.token_re.findall(query or '')
+        self.position = 0
+        self.all = set(range(len(collection.documents)))
+
+    def parse(self) -> set:
+        result = self.expression()
+        return result if result is not None else set()
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expression(self):
+        result = self.term()
+        while self.peek() is not None and self.peek() != ')':
+            operator = self.peek().upper()
+            if operator in ('AND', 'OR'):
+                self.next()
+            else:
+                # Lucene's default operator is OR
+                operator = 'OR'
+            right = self.term()
+            if right is None:
+                break
+            result = result & right if operator == 'AND' else result | right
+        return result
+
+    def term(self):
+        token = self.next()
+        if token is None:
+            return None
+        if token.upper() == 'NOT':
+            return self.all - (self.term() or set())
+        if token == '(':
+            result = self.expression()
+            self.next()
+            return result
+        field, separator, value = token.partition(':')
+        if not separator:
+            field, value = self.default_path, token
+        return self.clause(field, value.strip('"'))
+
+    def clause(self, field: str, value: str) -> set:
+        if value == '*':
+            return {o for o, d in enumerate(self.collection.documents) if values_at(d, field)}
+        return self.collection.text_index(field).phrase(value)
+
+def bucket_facets(documents: list, ordinals, facets: dict) -> dict:
+    '''
+    Atlas Search facet collector output for the given matching documents
+    '''
+    result = {}
+    for name, facet in facets.items():
+        if facet.get('type', 'string') == 'string':
+            counts = Counter()
+            for ordinal in ordinals:
+                counts.update(set(v for v in values_at(documents[ordinal], facet['path']) if isinstance(v, str)))
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            buckets = [{'_id': value, 'count': count} for value, count in ranked[:facet.get('numBuckets', 10)]]
+        else:
+            boundaries = facet['boundaries']
+            counts = Counter()
+            for ordinal in ordinals:
+                values = values_at(documents[ordinal], facet['path'])
+                bucket = facet.get('default')
+                if values:
+                    for lower, upper in zip(boundaries, boundaries[1:]):
+                        if compare(values[0], lower, '$gte') and compare(values[0], upper, '$lt'):
+                            bucket = lower
+                            break
+                if bucket is not None:
+                    counts[bucket] += 1
+            buckets = [{'_id': lower, 'count': counts[lower]} for lower in boundaries[:-1]]
+            if 'default' in facet:
+                buckets.append({'_id': facet['default'], 'count': counts[facet['default']]})
+        result[name] = {'buckets': buckets}
+    return result
+
+def search_meta(documents: list, ordinals, stage: dict) -> dict:
+    meta = {}
+    count = stage.get('count')
+    if count or 'facet' not in stage:
+        if count and count.get('type') == 'lowerBound':
+            meta['count'] = {'lowerBound': len(ordinals)}
+        else:
+            meta['count'] = {'total': len(ordinals)}
+    if 'facet' in stage:
+        meta['facet'] = bucket_facets(documents, ordinals, stage['facet'].get('facets', {}))
+    return meta
+
+def search_matches(collection, stage: dict) -> dict:
+    if 'facet' in stage:
+        operator = stage['facet'].get('operator')
+        if not operator:
+            return {o: 1.0 for o in range(len(collection.documents))}
+        name, operator = next(iter(operator.items()))
+    else:
+        name, operator = search_operator(stage)
+        if name is None:
+            raise OperationFailure("$search requires an operator")
+    return run_operator(collection, name, operator)
+
+def sort_key(value):
+    # nulls sort first, like MongoDB
+    if isinstance(value, list):
+        value = min(value, default=None, key=lambda v: (v is None, v)) if value else None
+    return (value is not None, value)
+
+def order(collection, scores: dict, sort: dict = None) -> list:
+    ordinals = sorted(scores, key=lambda o: (-scores[o], o))
+    if sort:
+        for field, direction in reversed(list(sort.items())):
+            if field == 'score' or isinstance(direction, dict):
+                continue
+            ordinals.sort(
+                key=lambda o: sort_key(get_path(collection.documents[o], field)),
+                reverse=direction == -1)
+    return ordinals
+
+def encode_sequence_token(ordinal: int) -> str:
+    return base64.b64encode(f'local:{ordinal}'.encode()).decode()
+
+def decode_sequence_token(token: str) -> int:
+    try:
+        return int(base64.b64decode(token).decode().split(':', 1)[1])
+    except (ValueError, IndexError):
+        raise OperationFailure(f"Invalid searchAfter token: {token}")
+
+def run_search(collection, stage: dict):
+    '''
+    Executes a $search stage; returns ([(document, meta)], $$SEARCH_META)
+    '''
+    scores = search_matches(collection, stage)
+    ordinals = order(collection, scores, stage.get('sort'))
+    meta = search_meta(collection.documents, ordinals, stage)
+
+    if 'searchAfter' in stage:
+        after = decode_sequence_token(stage['searchAfter'])
+        position = ordinals.index(after) + 1 if after in ordinals else len(ordinals)
+        ordinals = ordinals[position:]
+
+    return [(
+        collection.documents[o], {
+            'searchScore': scores[o],
+            'searchSequenceToken': encode_sequence_token(o),
+            'searchHighlights': [],
+        }) for o in ordinals], meta
+
+def run_vector_search(collection, stage: dict):
+    allowed = None
+    if stage.get('filter'):
+        allowed = {o for o, d in enumerate(collection.documents) if matches(d, stage['filter'])}
+    index = collection.vector_index(stage['path'])
+    hits = index.search(
+        stage['queryVector'],
+        limit=stage['limit'],
+        num_candidates=stage.get('numCandidates'),
+        allowed=allowed,
+        exact=stage.get('exact', False))
+    return [(collection.documents[o], {'vectorSearchScore': score}) for o, score in hits]
+
+################
+# Pipeline     #
+################
+def run_pipeline(collection, pipeline: list, items: list = None, variables: dict = None, stats: list = None):
+    '''
+    Runs an aggregation pipeline over (document, meta) pairs; returns the pairs.
+     Per-stage output counts and timings are appended to stats if given (explain)
+    '''
+    variables = dict(variables or {})
+    if items is None:
+        items = [(d, {}) for d in collection.documents]
+
+    for position, stage in enumerate(pipeline):
+        name, spec = next(iter(stage.items()))
+        started = time.perf_counter()
+        if name in ('$search', '$searchMeta', '$vectorSearch') and position != 0:
+            raise OperationFailure(f"{name} is only valid as the first stage in a pipeline")
+
+        if name == '$search':
+            items, variables['SEARCH_META'] = run_search(collection, spec)
+        elif name == '$searchMeta':
+            scores = search_matches(collection, spec)
+            items = [(search_meta(collection.documents, list(scores), spec), {})]
+        elif name == '$vectorSearch':
+            items = run_vector_search(collection, spec)
+        elif name in ('$addFields', '$set'):
+            updated = []
+            for document, meta in items:
+                document = dict(document)
+                for path, expression in spec.items():
+                    set_path(document, path, evaluate(expression, document, meta, variables))
+                updated.append((document, meta))
+            items = updated
+        elif name == '$project':
+            items = [(project(d, spec, m, variables), m) for d, m in items]
+        elif name == '$unset':
+            paths = spec if isinstance(spec, list) else [spec]
+            items = [(project(d, {p: 0 for p in paths}, m, variables), m) for d, m in items]
+        elif name == '$match':
+            items = [(d, m) for d, m in items if matches(d, spec)]
+        elif name == '$skip':
+            items = items[spec:]
+        elif name == '$limit':
+            items = items[:spec]
+        elif name == '$sort':
+            for field, direction in reversed(list(spec.items())):
+                if isinstance(direction, dict):
+                    items.sort(key=lambda item: -(item[1].get(direction['$meta']) or 0))
+                else:
+                    items.sort(key=lambda item: sort_key(get_path(item[0], field)), reverse=direction == -1)
+        elif name in ('$replaceWith', '$replaceRoot'):
+            expression = spec['newRoot'] if name == '$replaceRoot' else spec
+            items = [(evaluate(expression, d, m, variables), m) for d, m in items]
+        elif name == '$facet':
+            output = {}
+            for field, subpipeline in spec.items():
+                output[field] = [d for d, _ in run_pipeline(collection, subpipeline, list(items), variables)]
+            items = [(output, {})]
+        elif name == '$count':
+            items = [({spec: len(items)}, {})]
+        else:
+            raise OperationFailure(f"Unsupported stage in the local engine: {name}")
+
+        if stats is not None:
+            stats.append({
+                name: spec if name not in ('$vectorSearch', '$facet') else {k: v for k, v in spec.items() if k != 'queryVector'},
+                'nReturned': len(items),
+                'executionTimeMillisEstimate': round((time.perf_counter() - started) * 1000, 3),
+            })
+
+    return items
@@ -0,0 +1,167 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+token_re = re.compile(r'[0-9a-z]+')
+
+def analyze(text: str) -> List[str]:
+    '''
+    Lower-cased alphanumeric tokens, roughly what lucene.standard produces
+    '''
+    return token_re.findall(text.lower()) if text else []
+
+def values_at(document, path: str) -> list:
+    '''
+    All values at a dotted path, descending into arrays (sponsors.agency, openfda.brand_name)
+    '''
+    values = [document]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [v.get(part) for v in value if isinstance(v, dict)]
+                next_values.extend(v for v in value if v is not None)
+            elif isinstance(value, dict) and part in value:
+                next_values.append(value[part])
+        values = next_values
+
+    flattened = []
+    for value in values:
+        if isinstance(value, list):
+            flattened.extend(value)
+        elif value is not None:
+            flattened.append(value)
+    return flattened
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    '''
+    Levenshtein distance, giving up (returning limit + 1) once it exceeds limit
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class TextIndex:
+    '''
+    Inverted index over the string values of one path, scored with BM25
+    '''
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, documents: list, path: str):
+        self.path = path
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.prefixes = None
+        self.expansions = {}
+        for ordinal, document in enumerate(documents):
+            tokens = []
+            for value in values_at(document, path):
+                if isinstance(value, str):
+                    tokens.extend(analyze(value))
+            if not tokens:
+                continue
+            self.lengths[ordinal] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                self.postings[token][ordinal] = tf
+        self.average_length = sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0
+        self.size = len(documents)
+
+    def idf(self, token: str) -> float:
+        df = len(self.postings.get(token, ()))
+        return math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+
+    def bm25(self, token: str) -> Dict[int, float]:
+        idf = self.idf(token)
+        scores = {}
+        for ordinal, tf in self.postings.get(token, {}).items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[ordinal] / self.average_length)
+            scores[ordinal] = idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def expand(self, token: str, max_edits: int, max_expansions: int, prefix_length: int = 0) -> List[str]:
+        '''
+        Index terms within max_edits of token (the token itself first)
+        '''
+        key = (token, max_edits, max_expansions, prefix_length)
+        if key not in self.expansions:
+            prefix = token[:prefix_length]
+            candidates = []
+            for term in self.postings:
+                if not term.startswith(prefix):
+                    continue
+                distance = edit_distance(token, term, max_edits)
+                if distance <= max_edits:
+                    candidates.append((distance, -len(self.postings[term]), term))
+            candidates.sort()
+            self.expansions[key] = [term for _, _, term in candidates[:max_expansions]]
+        return self.expansions[key]
+
+    def text(self, query: str, fuzzy: dict = None) -> Dict[int, float]:
+        '''
+        Documents matching any query token (optionally fuzzy) with their BM25 scores
+        '''
+        scores = defaultdict(float)
+        for token in analyze(query):
+            terms = [token]
+            if fuzzy:
+                terms = self.expand(
+                    token,
+                    min(fuzzy.get('maxEdits', 2), 2),
+                    fuzzy.get('maxExpansions', 50),
+                    fuzzy.get('prefixLength', 0))
+            for term in terms:
+                for ordinal, score in self.bm25(term).items():
+                    scores[ordinal] += score
+        return scores
+
+    def phrase(self, query: str) -> set:
+        '''
+        Documents containing every query token (used for queryString field:value clauses)
+        '''
+        matches = None
+        for token in analyze(query):
+            ordinals = set(self.postings.get(token, ()))
+            matches = ordinals if matches is None else matches & ordinals
+        return matches or set()
+
+    def autocomplete(self, query: str) -> Dict[int, float]:
+        '''
+        Documents where every query token is a prefix of one of the field's tokens
+        '''
+        if self.prefixes is None:
+            self.prefixes = defaultdict(set)
+            for term in self.postings:
+                for end in range(1, min(len(term), 15) + 1):
+                    self.prefixes[term[:end]].add(term)
+
+        scores = None
+        for token in analyze(query):
+            token_scores = defaultdict(float)
+            for term in self.prefixes.get(token[:15], ()):
+                if term.startswith(token):
+                    for ordinal, score in self.bm25(term).items():
+                        token_scores[ordinal] += score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {o: scores[o] + s for o, s in token_scores.items() if o in scores}
+        return dict(scores or {})
+
+    def top_terms(self, text: str, limit: int = 25) -> List[str]:
+        '''
+        The most distinctive terms of text by tf-idf (moreLikeThis)
+        '''
+        counts = Counter(token for token in analyze(text) if token in self.postings)
+        ranked = sorted(counts.items(), key=lambda item: -item[1] * self.idf(item[0]))
+        return [term for term, _ in ranked[:limit]]
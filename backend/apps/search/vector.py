@@ -0,0 +1,107 @@
+import numpy as np
+from typing import Optional
+
+from apps.trials.vectors import vector_array
+
+def as_array(value) -> Optional[np.ndarray]:
+    if value is None:
+        return None
+    # BSON arrays, or float32/int8 binary vectors as Atlas accepts for indexed fields and queryVector
+    array = vector_array(value)
+    return array if array.ndim == 1 and array.size > 0 else None
+
+class VectorIndex:
+    '''
+    Cosine-similarity index over one vector path. Small collections are searched
+     brute force; larger ones get an IVF (k-means inverted file) index whose probes
+     are widened until numCandidates candidates have been scored
+    '''
+
+    def __init__(self, documents: list, path: str, ivf_min_size: int = 20000, seed: int = 0):
+        self.path = path
+        ordinals = []
+        vectors = []
+        for ordinal, document in enumerate(documents):
+            vector = as_array(lookup(document, path))
+            if vector is not None:
+                ordinals.append(ordinal)
+                vectors.append(vector)
+
+        self.ordinals = np.asarray(ordinals, dtype=np.int64)
+        self.matrix = normalize(np.vstack(vectors)) if vectors else np.zeros((0, 0), dtype=np.float32)
+        self.centroids = None
+        self.lists = None
+        if len(ordinals) >= ivf_min_size:
+            self.build_ivf(seed)
+
+    def build_ivf(self, seed: int, iterations: int = 10):
+        n = self.matrix.shape[0]
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        centroids = self.matrix[rng.choice(n, nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(self.matrix @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = self.matrix[assignment == c]
+                if len(members) > 0:
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize(centroids)
+        assignment = np.argmax(self.matrix @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assignment == c) for c in range(nlist)]
+
+    def search(
+        self,
+        query,
+        limit: int,
+        num_candidates: Optional[int] = None,
+        allowed: Optional[set] = None,
+        exact: bool = False):
+        '''
+        Returns [(ordinal, score)] best first; score is Atlas' cosine score, (1 + cos) / 2
+        '''
+        query = as_array(query)
+        if query is None or self.matrix.shape[0] == 0:
+            return []
+        query = query / (np.linalg.norm(query) or 1)
+
+        if exact or self.centroids is None:
+            rows = np.arange(self.matrix.shape[0])
+        else:
+            wanted = max(num_candidates or limit, limit)
+            probes = np.argsort(-(self.centroids @ query))
+            collected = []
+            found = 0
+            for probe in probes:
+                members = self.lists[probe]
+                if allowed is not None:
+                    members = members[np.isin(self.ordinals[members], list(allowed))]
+                collected.append(members)
+                found += len(members)
+                if found >= wanted:
+                    break
+            rows = np.concatenate(collected) if collected else np.arange(0)
+
+        if allowed is not None and (exact or self.centroids is None):
+            rows = rows[np.isin(self.ordinals[rows], list(allowed))]
+        if len(rows) == 0:
+            return []
+
+        similarities = self.matrix[rows] @ query
+        top = min(limit, len(rows))
+        best = np.argpartition(-similarities, top - 1)[:top]
+        best = best[np.argsort(-similarities[best])]
+        return [(int(self.ordinals[rows[i]]), float((1 + similarities[i]) / 2)) for i in best]
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (matrix / norms).astype(np.float32)
+
+def lookup(document, path: str):
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class LRUCache:
+    '''
+    Bounded in-process cache with least-recently-used eviction and an optional
+     time-to-live per entry. Not thread-safe; meant to be used from the event loop
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+class ResultWindowCache(LRUCache):
+    '''
+    Server-side windows of search results for deep pagination, keyed by session token
+    '''
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = 600, default_pages: int = 10, max_pages: int = 20):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.default_pages = default_pages
+        self.max_pages = max_pages
+
+def normalize_query(text: str) -> str:
+    '''
+    Cache key for a free-text query: lower case with whitespace collapsed
+    '''
+    return ' '.join(text.lower().split())
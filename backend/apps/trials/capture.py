@@ -0,0 +1,101 @@
+import atexit
+import logging
+import logging.handlers
+import orjson
+import queue
+import random
+import time
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+class CaptureMiddleware:
+    '''
+    ASGI middleware that samples requests under the given path prefixes (route, query
+     parameters, body, status, latency, response size) into a rotating JSONL file for
+     tools/replay.py. Requests slower than slow_ms are always captured and logged.
+     Lines are written by a QueueListener thread, never on the event loop
+    '''
+
+    def __init__(
+        self,
+        app,
+        path: str,
+        prefixes: tuple = ('/trials', '/drugs'),
+        sample_rate: float = 0.01,
+        slow_ms: float = 1000,
+        max_bytes: int = 100 * 2**20,
+        backups: int = 5,
+        max_body: int = 64 * 2**10):
+        self.app = app
+        self.prefixes = prefixes
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_body = max_body
+        self.captured = 0
+
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        records = queue.SimpleQueue()
+        self.writer = logging.getLogger(f'{__name__}.jsonl')
+        self.writer.propagate = False
+        self.writer.setLevel(logging.INFO)
+        self.writer.addHandler(logging.handlers.QueueHandler(records))
+        self.listener = logging.handlers.QueueListener(records, handler)
+        self.listener.start()
+        # flush what's still queued on shutdown
+        atexit.register(self.listener.stop)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefixes):
+            return await self.app(scope, receive, send)
+
+        body = bytearray()
+        response = {'status': None, 'bytes': 0}
+
+        async def capture_receive():
+            message = await receive()
+            if message['type'] == 'http.request' and len(body) < self.max_body:
+                body.extend(message.get('body', b'')[:self.max_body - len(body)])
+            return message
+
+        async def capture_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['bytes'] += len(message.get('body', b''))
+            await send(message)
+
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            latency_ms = (time.perf_counter() - start) * 1000
+            slow = latency_ms >= self.slow_ms
+            if slow or random.random() < self.sample_rate:
+                # routes of included routers carry their path without the router prefix
+                route = getattr(scope.get('route'), 'path', None)
+                prefix = next(prefix for prefix in self.prefixes if scope['path'].startswith(prefix))
+                if route is None:
+                    route = scope['path']
+                elif not route.startswith(prefix):
+                    route = prefix + route
+                record = {
+                    'ts': started,
+                    'method': scope['method'],
+                    'path': scope['path'],
+                    'route': route,
+                    'query': parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True),
+                    'body': body.decode('utf-8', 'replace') if body else None,
+                    'status': response['status'],
+                    'latency_ms': round(latency_ms, 3),
+                    'response_bytes': response['bytes'],
+                    'slow': slow,
+                }
+                self.writer.info(orjson.dumps(record).decode())
+                self.captured += 1
+                if slow:
+                    logger.warning(
+                        "slow request route=%s latency_ms=%.1f query=%s",
+                        record['route'], latency_ms, record['query'])
@@ -0,0 +1,123 @@
+import asyncio
+from contextlib import contextmanager
+from fastapi import HTTPException, Request
+from pymongo.errors import ExecutionTimeout, WaitQueueTimeoutError
+from typing import Awaitable, Optional
+
+from .diagnostics import current_diagnostics
+from .metrics import stage
+from config import settings
+
+def client_options() -> dict:
+    '''
+    AsyncIOMotorClient keyword arguments from DatabaseSettings
+    '''
+    options = {
+        'maxPoolSize': settings.DB_MAX_POOL_SIZE,
+        'minPoolSize': settings.DB_MIN_POOL_SIZE,
+        'waitQueueTimeoutMS': settings.DB_WAIT_QUEUE_TIMEOUT_MS,
+        'readPreference': settings.DB_READ_PREFERENCE,
+    }
+    if settings.DB_COMPRESSORS:
+        options['compressors'] = settings.DB_COMPRESSORS
+    return options
+
+async def connect():
+    '''
+    (client, database) for the configured backend: Atlas through Motor, or with
+     SEARCH_BACKEND=local the in-process engine, populated from the local corpus
+    '''
+    if settings.SEARCH_BACKEND == "local":
+        from apps.search import LocalClient, populate
+        client = LocalClient(ivf_min_size=settings.LOCAL_IVF_MIN_SIZE)
+        db = client[settings.DB_NAME]
+        await populate(db, settings.LOCAL_CORPUS_PATH, settings.LOCAL_TRIALS, settings.LOCAL_DRUGS)
+        return client, db
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(settings.DB_URL, **client_options())
+    return client, client[settings.DB_NAME]
+
+def query_deadline(route: str) -> int:
+    '''
+    maxTimeMS for a route: its QUERY_TIMEOUTS_MS entry, otherwise QUERY_TIMEOUT_MS
+    '''
+    return settings.QUERY_TIMEOUTS_MS.get(route, settings.QUERY_TIMEOUT_MS)
+
+async def aggregate(collection, pipeline: list, route: str, length: Optional[int] = None):
+    '''
+    Runs an aggregation with the route's deadline; the cursor is closed (killCursors)
+     if the caller is cancelled before it's exhausted
+    '''
+    if (diagnostics := current_diagnostics.get()) is not None:
+        await diagnostics.record(collection, pipeline)
+    cursor = collection.aggregate(pipeline, maxTimeMS=query_deadline(route))
+    try:
+        with query_errors(route), stage('mongo'):
+            return await cursor.to_list(length=length)
+    finally:
+        await cursor.close()
+
+async def batches(collection, pipeline: list, route: str, batch_size: int):
+    '''
+    Iterates an aggregation batch_size documents at a time (the cursor's getMore size
+     too), so memory stays bounded however many documents it returns
+    '''
+    cursor = collection.aggregate(pipeline, maxTimeMS=query_deadline(route), batchSize=batch_size)
+    try:
+        batch = []
+        with query_errors(route):
+            async for document in cursor:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+    finally:
+        await cursor.close()
+
+async def find_one(collection, filter: dict, projection: Optional[dict], route: str):
+    with query_errors(route), stage('mongo'):
+        return await collection.find_one(filter, projection, max_time_ms=query_deadline(route))
+
+@contextmanager
+def query_errors(route: str):
+    '''
+    Maps deadline and pool exhaustion errors to 504/503 responses
+    '''
+    try:
+        yield
+    except ExecutionTimeout as e:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Query exceeded the {query_deadline(route)} ms deadline for {route}") from e
+    except WaitQueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail="No database connection available, try again") from e
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable, poll_interval: float = 0.1):
+    '''
+    Awaits the route's work while watching the connection; if the client goes away
+     first the work is cancelled, which closes its cursor (see aggregate). Coalesced
+     work (SingleFlight) keeps running while other callers still wait on it
+    '''
+    work = asyncio.ensure_future(awaitable)
+
+    async def disconnected():
+        while not await request.is_disconnected():
+            await asyncio.sleep(poll_interval)
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if not work.done():
+        work.cancel()
+        # nginx's "client closed request"; nobody is left to read it
+        raise HTTPException(status_code=499, detail="Client closed request")
+    return work.result()
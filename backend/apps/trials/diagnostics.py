@@ -0,0 +1,150 @@
+import functools
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from fastapi import HTTPException, Request
+from typing import Optional
+
+from config import settings
+from .vectors import vector_format, vector_length
+
+class Sampler:
+    '''
+    Sampling profiler for one thread (the event loop's): a background thread records
+     the target's stack every interval seconds. Cheap enough to leave on for a single
+     request, and unlike cProfile it shows where wall time goes, including waiting
+    '''
+
+    def __init__(self, thread_id: int, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self, limit: int = 25) -> dict:
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        return {
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            # share of samples with the function on top of the stack / anywhere on it
+            'self': [{'function': f, 'samples': n} for f, n in own.most_common(limit)],
+            'total': [{'function': f, 'samples': n} for f, n in total.most_common(limit)],
+            'stacks': [{'stack': ';'.join(s), 'samples': n} for s, n in self.stacks.most_common(limit)],
+        }
+
+class Diagnostics:
+    def __init__(self, explain: bool, profile: bool):
+        self.explain = explain
+        self.profile = profile
+        self.queries = []
+        self.sampler = Sampler(threading.get_ident()) if profile else None
+        self.started = None
+        self.elapsed = None
+
+    async def record(self, collection, pipeline: list):
+        '''
+        Called by db.aggregate for every aggregation the request runs
+        '''
+        query = {'collection': collection.name, 'pipeline': summarize(pipeline)}
+        if self.explain:
+            query['explain'] = await collection.database.command({
+                'explain': {'aggregate': collection.name, 'pipeline': pipeline, 'cursor': {}},
+                'verbosity': 'executionStats',
+            })
+        self.queries.append(query)
+
+    def report(self) -> dict:
+        report = {'elapsed_seconds': self.elapsed, 'queries': self.queries}
+        if self.sampler is not None:
+            report['profile'] = self.sampler.report()
+        return report
+
+current_diagnostics: ContextVar[Optional[Diagnostics]] = ContextVar('current_diagnostics', default=None)
+
+def check_admin(request: Request):
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="explain/profile are disabled (ADMIN_TOKEN is not set)")
+    token = request.headers.get('X-Admin-Token', '')
+    if not secrets.compare_digest(token.encode(), settings.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="explain/profile need a valid X-Admin-Token header")
+
+def diagnosable(endpoint):
+    '''
+    Adds explain=true/profile=true handling to a route whose signature declares
+     both (the flags are passed through and ignored by the route itself). The route
+     runs with caches and request coalescing bypassed and the response gets a
+     'diagnostics' entry with every pipeline it ran, their explain output and/or a
+     sampling profile. List responses become {'results': [...], 'diagnostics': ...}
+    '''
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        if not (kwargs.get('explain') or kwargs.get('profile')):
+            return await endpoint(*args, **kwargs)
+
+        request = kwargs.get('request') or args[0]
+        check_admin(request)
+        diagnostics = Diagnostics(bool(kwargs.get('explain')), bool(kwargs.get('profile')))
+        token = current_diagnostics.set(diagnostics)
+        if diagnostics.sampler is not None:
+            diagnostics.sampler.start()
+        started = time.perf_counter()
+        try:
+            response = await endpoint(*args, **kwargs)
+        finally:
+            diagnostics.elapsed = time.perf_counter() - started
+            if diagnostics.sampler is not None:
+                diagnostics.sampler.stop()
+            current_diagnostics.reset(token)
+
+        if isinstance(response, dict):
+            return {**response, 'diagnostics': diagnostics.report()}
+        return {'results': response, 'diagnostics': diagnostics.report()}
+
+    return wrapper
+
+def diagnosing() -> bool:
+    return current_diagnostics.get() is not None
+
+def summarize(pipeline: list) -> list:
+    '''
+    The pipeline as sent, with query vectors replaced by their length
+    '''
+    summary = []
+    for stage in pipeline:
+        if '$vectorSearch' in stage:
+            spec = dict(stage['$vectorSearch'])
+            vector = spec.get('queryVector')
+            spec['queryVector'] = f"<{vector_length(vector)} element {vector_format(vector)} vector>"
+            stage = {'$vectorSearch': spec}
+        summary.append(stage)
+    return summary
@@ -0,0 +1,165 @@
+import asyncio
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+class EmbeddingModel:
+    '''
+    Holds a single SentenceTransformer instance for the lifetime of the app
+     so that query embeddings don't pay for loading model weights on every call.
+     Created in the main.py lifespan and stored on app.state.embedding_model.
+     sentence_transformers (and torch) is only imported by load(), so workers that never
+     embed a query don't pay for it
+    '''
+
+    def __init__(self, model_name: str, device: Optional[str] = None):
+        self.model_name = model_name
+        self.device = device
+        self.model = None
+        self.load_time = None
+        self.rss_before_load = None
+        self.rss_after_load = None
+        self.lock = threading.Lock()
+
+    def load(self, warmup: bool = True):
+        if self.model is not None:
+            return self.model
+
+        # the batcher can call this from several executor threads on first use
+        with self.lock:
+            if self.model is None:
+                self.rss_before_load = current_rss()
+                start = time.perf_counter()
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(self.model_name, device=self.device)
+                if warmup:
+                    # the first encode allocates the inference buffers
+                    model.encode("warmup")
+                self.load_time = time.perf_counter() - start
+                self.rss_after_load = current_rss()
+                self.model = model
+
+        return self.model
+
+    def encode(self, text: str) -> List[float]:
+        return self.load().encode(text).tolist()
+
+    def encode_batch(self, texts: List[str]) -> List[List[float]]:
+        return self.load().encode(texts, batch_size=len(texts)).tolist()
+
+    def weights_bytes(self):
+        if self.model is None:
+            return 0
+        return sum(p.numel() * p.element_size() for p in self.model.parameters())
+
+    def stats(self):
+        return {
+            'model': self.model_name,
+            'loaded': self.model is not None,
+            'load_time_seconds': self.load_time,
+            'weights_bytes': self.weights_bytes(),
+            'rss_bytes': current_rss(),
+            'rss_delta_bytes': self.rss_after_load - self.rss_before_load if self.model is not None else 0,
+        }
+
+class EmbeddingBatcher:
+    '''
+    Runs model inference on a thread pool so a cache miss doesn't block the event loop.
+     Concurrent encode() calls are collected for up to max_wait_ms (or max_batch_size
+     texts) and embedded with a single batched encode; each caller gets its own vector back
+    '''
+
+    def __init__(
+        self,
+        model: EmbeddingModel,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+        workers: int = 1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.workers = workers
+        self.executor = None
+        self.queue = None
+        self.dispatcher = None
+        self.slots = None
+        self.batches = 0
+        self.texts = 0
+
+    async def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='embedding')
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def encode(self, text: str) -> List[float]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # keep collecting the next batch while this one is encoded
+            await self.slots.acquire()
+            asyncio.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            texts = [text for text, _ in batch]
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.model.encode_batch, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self.batches += 1
+            self.texts += len(texts)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        finally:
+            self.slots.release()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'texts': self.texts,
+            'mean_batch_size': self.texts / self.batches if self.batches else 0,
+            'queued': self.queue.qsize() if self.queue else 0,
+        }
+
+def current_rss():
+    '''
+    Resident set size of this process in bytes; falls back to the peak RSS
+     where /proc isn't available (ru_maxrss is KiB on Linux)
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
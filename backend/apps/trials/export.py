@@ -0,0 +1,150 @@
+import csv
+import io
+import orjson
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, List
+
+from .responses import bson_default
+
+# export columns and their types; nested values that don't flatten well are JSON-encoded
+trial_columns = {
+    'nct_id': 'string',
+    'brief_title': 'string',
+    'official_title': 'string',
+    'start_date': 'datetime',
+    'completion_date': 'datetime',
+    'condition': 'strings',
+    'intervention': 'strings',
+    'intervention_mesh_term': 'strings',
+    'sponsors': 'json',
+    'status': 'string',
+    'phase': 'string',
+    'score': 'float',
+}
+
+drug_columns = {
+    'id': 'string',
+    'brand_name': 'strings',
+    'active_ingredient': 'strings',
+    'effective_time': 'datetime',
+    'purpose': 'strings',
+    'indications_and_usage': 'strings',
+    'openfda.brand_name': 'strings',
+    'openfda.generic_name': 'strings',
+    'openfda.manufacturer_name': 'strings',
+    'score': 'float',
+}
+
+media_types = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+def export_response(
+    batches: AsyncIterator[List[dict]],
+    columns: Dict[str, str],
+    format: str,
+    filename: str) -> StreamingResponse:
+    '''
+    Streams batches of documents as NDJSON, CSV or an Arrow IPC stream, one chunk per
+     batch. Each chunk is only produced once the previous one has been sent, so the
+     client connection sets the pace
+    '''
+    if format == 'ndjson':
+        chunks = ndjson_chunks(batches)
+    elif format == 'csv':
+        chunks = csv_chunks(batches, columns)
+    elif format == 'arrow':
+        chunks = arrow_chunks(batches, columns, arrow_schema(columns))
+    else:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(media_types)}")
+
+    extension = 'arrows' if format == 'arrow' else format
+    return StreamingResponse(
+        chunks,
+        media_type=media_types[format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}.{extension}"'})
+
+async def ndjson_chunks(batches: AsyncIterator[List[dict]]):
+    async for batch in batches:
+        yield b''.join(orjson.dumps(document, default=bson_default) + b'\n' for document in batch)
+
+async def csv_chunks(batches: AsyncIterator[List[dict]], columns: Dict[str, str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for batch in batches:
+        for document in batch:
+            writer.writerow(csv_value(value, columns[column]) for column, value in row(document, columns).items())
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+    if buffer.tell():
+        # header only (nothing matched)
+        yield buffer.getvalue().encode()
+
+def arrow_schema(columns: Dict[str, str]):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Arrow export needs pyarrow installed on the server")
+
+    types = {
+        'string': pa.string(),
+        'strings': pa.list_(pa.string()),
+        'datetime': pa.timestamp('ms'),
+        'float': pa.float64(),
+        'json': pa.string(),
+    }
+    return pa.schema([(column, types[kind]) for column, kind in columns.items()])
+
+async def arrow_chunks(batches: AsyncIterator[List[dict]], columns: Dict[str, str], schema):
+    import pyarrow as pa
+
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        async for batch in batches:
+            rows = [row(document, columns) for document in batch]
+            writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate(0)
+    # end-of-stream marker
+    yield sink.getvalue()
+
+def row(document: dict, columns: Dict[str, str]) -> dict:
+    '''
+    The document's export columns (dotted paths into sub-documents) as plain values
+    '''
+    values = {}
+    for column, kind in columns.items():
+        value = document
+        for part in column.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+
+        if value is None:
+            values[column] = None
+        elif kind == 'strings':
+            values[column] = [str(v) for v in value] if isinstance(value, list) else [str(value)]
+        elif kind == 'json':
+            values[column] = orjson.dumps(value, default=bson_default).decode()
+        elif kind == 'float':
+            values[column] = float(value)
+        elif kind == 'string':
+            values[column] = str(value)
+        else:
+            values[column] = value
+    return values
+
+def csv_value(value, kind: str):
+    if value is None:
+        return ''
+    if kind == 'strings':
+        return '; '.join(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
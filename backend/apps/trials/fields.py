@@ -0,0 +1,92 @@
+import copy
+from fastapi import HTTPException
+from typing import Dict, List, Optional
+
+class Projection(dict):
+    '''
+    A $project body shared by every request, so read-only: copy it ({**projection})
+     to make a variant
+    '''
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError("projections are shared between requests; copy before changing")
+
+    __setitem__ = __delitem__ = __ior__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+    def __reduce__(self):
+        return (Projection, (dict(self),))
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+# stored fields a client may ask for with fields=
+trial_fields = frozenset([
+    'nct_id', 'brief_title', 'official_title', 'brief_summary', 'detailed_description',
+    'start_date', 'completion_date', 'condition', 'condition_mesh_term', 'intervention',
+    'intervention_mesh_term', 'sponsors', 'status', 'phase', 'study_type', 'gender',
+    'minimum_age', 'maximum_age', 'enrollment', 'url', 'facility',
+])
+
+drug_fields = frozenset([
+    'id', 'brand_name', 'active_ingredient', 'effective_time', 'purpose',
+    'indications_and_usage', 'description', 'openfda.brand_name', 'openfda.generic_name',
+    'openfda.manufacturer_name', 'openfda.route',
+])
+
+# named field sets; 'card' is what a result list renders
+trial_presets = {
+    'card': ['nct_id', 'brief_title', 'status', 'phase', 'start_date', 'condition'],
+    'list': [
+        'nct_id', 'brief_title', 'official_title', 'start_date', 'completion_date', 'condition',
+        'intervention', 'intervention_mesh_term', 'sponsors', 'status', 'phase'],
+}
+trial_presets['detail'] = trial_presets['list'] + [
+    'detailed_description', 'enrollment', 'gender', 'maximum_age', 'minimum_age', 'url', 'facility']
+
+drug_presets = {
+    'card': ['id', 'openfda.brand_name', 'openfda.generic_name', 'openfda.manufacturer_name', 'purpose'],
+    'list': [
+        'id', 'active_ingredient', 'brand_name', 'effective_time', 'indications_and_usage', 'purpose',
+        'openfda.brand_name', 'openfda.generic_name', 'openfda.manufacturer_name'],
+}
+
+# computed by the pipeline rather than stored; always kept
+trial_meta_fields = ['score', 'trial_pagination_token', 'count']
+drug_meta_fields = ['score', 'highlights', 'drug_pagination_token']
+
+def select_fields(
+    fields: Optional[str],
+    allowed: frozenset,
+    presets: Dict[str, List[str]],
+    meta_fields: List[str],
+    default: dict) -> dict:
+    '''
+    $project body for a comma separated fields= parameter of field names and/or
+     preset names (fields=card, fields=card,official_title); default when not given
+    '''
+    if not fields:
+        return default
+
+    selected = []
+    unknown = []
+    for name in (name.strip() for name in fields.split(',')):
+        if name in presets:
+            selected.extend(presets[name])
+        elif name in allowed:
+            selected.append(name)
+        elif name:
+            unknown.append(name)
+
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown)}; allowed: {', '.join(sorted(allowed) + sorted(presets))}")
+
+    return {'_id': 0, **{name: 1 for name in selected + meta_fields}}
+
+def trial_projection(fields: Optional[str], default: dict) -> dict:
+    return select_fields(fields, trial_fields, trial_presets, trial_meta_fields, default)
+
+def drug_projection(fields: Optional[str], default: dict) -> dict:
+    return select_fields(fields, drug_fields, drug_presets, drug_meta_fields, default)
@@ -0,0 +1,16 @@
+def reciprocal_rank_fusion(rankings: list, key: str, k: int = 60) -> list:
+    '''
+    Merges result lists (each best first) by reciprocal rank fusion: a document scores
+     the sum of 1 / (k + rank) over the lists it's in, ranks counted from 1. Each
+     document is a copy of its first appearance, with score set to the fused score
+    '''
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            identity = document.get(key)
+            scores[identity] = scores.get(identity, 0.0) + 1 / (k + rank)
+            documents.setdefault(identity, document)
+    # stable, so ties keep the order of first appearance
+    order = sorted(documents, key=lambda identity: -scores[identity])
+    return [{**documents[identity], 'score': scores[identity]} for identity in order]
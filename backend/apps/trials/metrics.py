@@ -0,0 +1,156 @@
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Tuple
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: tuple = default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ('le',), key + (str(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {count}"
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape(str(value))}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_seconds = Histogram(
+    'mongorx_request_seconds', 'Route latency, endpoint call through response rendering', ('route',))
+requests_total = Counter('mongorx_requests_total', 'Requests by route and status code', ('route', 'status'))
+stage_seconds = Histogram(
+    'mongorx_stage_seconds',
+    'Time per request stage (filters, pipeline, embedding, mongo, serialization), excluding nested stages',
+    ('route', 'stage'))
+embedding_lookups_total = Counter(
+    'mongorx_embedding_lookups_total', 'Query vector lookups by the tier that answered them', ('tier',))
+
+registry = [request_seconds, requests_total, stage_seconds, embedding_lookups_total]
+
+def render() -> str:
+    '''
+    All metrics in the Prometheus text exposition format
+    '''
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+class RequestTimings:
+    def __init__(self, route: str):
+        self.route = route
+        # time spent in nested stages, one entry per open stage
+        self.nested = []
+
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar('current_timings', default=None)
+
+@contextmanager
+def timed_request(route: str):
+    '''
+    Times a route and makes it the route stage() timings are recorded against
+    '''
+    token = current_timings.set(RequestTimings(route))
+    start = time.perf_counter()
+    status = 500
+    try:
+        yield
+        status = 200
+    except asyncio.CancelledError:
+        status = 499
+        raise
+    except Exception as e:
+        status = getattr(e, 'status_code', 500)
+        raise
+    finally:
+        request_seconds.observe(time.perf_counter() - start, route=route)
+        requests_total.inc(route=route, status=status)
+        current_timings.reset(token)
+
+@contextmanager
+def stage(name: str):
+    '''
+    Times one stage of the current request. A stage nested in another (filter parsing
+     while building the pipeline) is only counted once, in the inner stage
+    '''
+    timings = current_timings.get()
+    nested = timings.nested if timings is not None else []
+    nested.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        inner = nested.pop()
+        if nested:
+            nested[-1] += elapsed
+        route = timings.route if timings is not None else 'background'
+        stage_seconds.observe(elapsed - inner, route=route, stage=name)
+
+async def branch(awaitable):
+    '''
+    Awaits one of several concurrent tasks (asyncio.gather) of a request: stages get a
+     nesting stack of their own, still recorded against the request's route
+    '''
+    timings = current_timings.get()
+    if timings is not None:
+        # the context is the task's copy, the request's own stack is untouched
+        current_timings.set(RequestTimings(timings.route))
+    return await awaitable
+
+def timed(name: str):
+    '''
+    Decorator form of stage() for coroutine functions
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
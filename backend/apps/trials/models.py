@@ -1,9 +1,11 @@
 import uuid
 from datetime import date, datetime
-from typing import List, Optional
-from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, Field, create_model
 
 class MLTModel(BaseModel):
+    # similar to a stored trial; title and description are ignored when given
+    nct_id: Optional[str] = Field(None)
     title: Optional[str] = Field(None)
     description: Optional[str] = Field(None)
 
@@ -32,3 +34,59 @@ class DrugModel(BaseModel):
 
     class Config:
         allow_population_by_field_name = True
+
+def partial(model, name: str):
+    '''
+    Response schema from a model: every field optional (results are projections)
+     and anything else the pipeline adds (score, highlights, tokens) passed through
+    '''
+    fields = {field: (Optional[info.annotation], None) for field, info in model.model_fields.items()}
+    return create_model(name, __config__=ConfigDict(extra='allow'), **fields)
+
+class Sponsor(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    agency: Optional[str] = None
+    agency_class: Optional[str] = None
+    lead_or_collaborator: Optional[str] = None
+
+class TrialResult(partial(TrialModel, 'TrialFields')):
+    official_title: Optional[str] = None
+    start_date: Optional[datetime] = None
+    completion_date: Optional[datetime] = None
+    intervention: Optional[List[str]] = None
+    intervention_mesh_term: Optional[List[str]] = None
+    sponsors: Optional[List[Sponsor]] = None
+    facility: Optional[List[Dict[str, Any]]] = None
+    maximum_age: Optional[int] = None
+    score: Optional[float] = None
+    trial_pagination_token: Optional[str] = None
+    count: Optional[Dict[str, int]] = None
+
+class DrugResult(partial(DrugModel, 'DrugFields')):
+    # openFDA label fields are arrays
+    id: Optional[str] = None
+    effective_time: Optional[datetime] = None
+    purpose: Optional[List[str]] = None
+    active_ingredient: Optional[List[str]] = None
+    brand_name: Optional[List[str]] = None
+    indications_and_usage: Optional[List[str]] = None
+    openfda: Optional[Dict[str, List[str]]] = None
+    highlights: Optional[List[Dict[str, Any]]] = None
+    score: Optional[float] = None
+    drug_pagination_token: Optional[str] = None
+    count: Optional[Dict[str, int]] = None
+
+class TrialSearchResponse(BaseModel):
+    results: List[TrialResult]
+    count: Optional[Dict[str, int]] = None
+    facets: Optional[List[Dict[str, Any]]] = None
+    session: Optional[str] = None
+    diagnostics: Optional[Dict[str, Any]] = None
+
+class DrugSearchResponse(BaseModel):
+    results: List[DrugResult]
+    count: Optional[Dict[str, int]] = None
+    facets: Optional[List[Dict[str, Any]]] = None
+    session: Optional[str] = None
+    diagnostics: Optional[Dict[str, Any]] = None
@@ -0,0 +1,219 @@
+import asyncio
+import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import shared_memory
+from typing import Optional
+
+from .db import find_one
+from .vectors import vector_array
+
+collection_name = 'trial_neighbors'
+# stored with each neighbour, so mlt_search can answer from the neighbour document alone
+card_fields = ['nct_id', 'brief_title', 'start_date', 'completion_date']
+
+# set in pool workers by attach()
+matrix = None
+segment = None
+
+def attach(name: str, shape: tuple):
+    '''
+    Process pool initializer: maps the parent's vector matrix (shared memory, no copy)
+    '''
+    global matrix, segment
+    segment = shared_memory.SharedMemory(name=name)
+    matrix = np.ndarray(shape, dtype=np.float32, buffer=segment.buf)
+
+def top_k(rows: np.ndarray, columns: Optional[np.ndarray], k: int, column_block: int):
+    '''
+    The k best columns (all, or the given ones) for each row by cosine similarity,
+     excluding the row itself. One rows x column_block product at a time, merged into
+     a running top k with argpartition, so memory stays at rows x (k + column_block)
+    '''
+    queries = matrix[rows]
+    best_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+    best_columns = np.full((len(rows), k), -1, dtype=np.int64)
+    total = matrix.shape[0] if columns is None else len(columns)
+
+    for start in range(0, total, column_block):
+        if columns is None:
+            block = np.arange(start, min(start + column_block, total))
+            scores = queries @ matrix[start:start + column_block].T
+        else:
+            block = columns[start:start + column_block]
+            scores = queries @ matrix[block].T
+        scores[rows[:, None] == block[None, :]] = -np.inf
+
+        scores = np.concatenate([best_scores, scores], axis=1)
+        candidates = np.concatenate([best_columns, np.broadcast_to(block, (len(rows), len(block)))], axis=1)
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k] if scores.shape[1] > k else np.argsort(-scores, axis=1)
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_columns = np.take_along_axis(candidates, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_columns, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+class NeighborGraph:
+    '''
+    Top-k nearest trials by one vector path, computed offline (tools/build_neighbors.py)
+     and stored one document per trial in trial_neighbors:
+
+        {'nct_id', 'path', 'k', 'computed_at', 'neighbors': [{nct_id, brief_title, ..., score}]}
+
+     Scores are $vectorSearch's cosine score, (1 + cos) / 2. Rows are scored in blocks
+     across a process pool sharing one float32 matrix. refresh() only scores trials
+     added since the last run (no neighbour document yet), and splices them into the
+     neighbour lists of existing trials
+    '''
+
+    def __init__(
+        self,
+        db,
+        path: str = 'detailed_description_vector',
+        k: int = 20,
+        workers: Optional[int] = None,
+        row_block: int = 256,
+        column_block: int = 16384):
+        self.db = db
+        self.path = path
+        self.k = k
+        self.workers = workers or os.cpu_count()
+        self.row_block = row_block
+        self.column_block = column_block
+
+    async def load(self):
+        '''
+        Card fields and normalized vectors of every trial with a vector at path
+        '''
+        cards = []
+        vectors = []
+        projection = {'_id': 0, self.path: 1, **{field: 1 for field in card_fields}}
+        async for trial in self.db["trials"].find({self.path: {'$exists': True}}, projection).batch_size(2000):
+            vector = trial.pop(self.path)
+            if vector:
+                cards.append(trial)
+                vectors.append(vector_array(vector))
+        if not vectors:
+            return cards, np.zeros((0, 0), dtype=np.float32)
+        matrix = np.vstack(vectors)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        return cards, matrix
+
+    async def score(self, matrix: np.ndarray, rows: np.ndarray, columns: Optional[np.ndarray] = None):
+        '''
+        top_k for every row, row_block rows per task
+        '''
+        k = min(self.k, matrix.shape[0] - 1 if columns is None else len(columns))
+        if len(rows) == 0 or k <= 0:
+            return np.zeros((len(rows), 0), dtype=np.int64), np.zeros((len(rows), 0), dtype=np.float32)
+
+        segment = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+        try:
+            np.ndarray(matrix.shape, dtype=np.float32, buffer=segment.buf)[:] = matrix
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(self.workers, initializer=attach, initargs=(segment.name, matrix.shape)) as pool:
+                results = await asyncio.gather(*[
+                    loop.run_in_executor(pool, top_k, rows[start:start + self.row_block], columns, k, self.column_block)
+                    for start in range(0, len(rows), self.row_block)])
+        finally:
+            segment.close()
+            segment.unlink()
+        return np.vstack([r[0] for r in results]), np.vstack([r[1] for r in results])
+
+    def document(self, cards: list, row: int, columns, scores, computed_at: datetime) -> dict:
+        return {
+            'nct_id': cards[row]['nct_id'],
+            'path': self.path,
+            'k': self.k,
+            'computed_at': computed_at,
+            'neighbors': [
+                {**cards[column], 'score': (1 + float(score)) / 2}
+                for column, score in zip(columns, scores) if column >= 0],
+        }
+
+    async def build(self) -> dict:
+        '''
+        Recomputes every trial's neighbours and replaces the stored ones
+        '''
+        started = time.perf_counter()
+        cards, matrix = await self.load()
+        loaded = time.perf_counter()
+        columns, scores = await self.score(matrix, np.arange(len(cards)))
+        scored = time.perf_counter()
+
+        computed_at = datetime.now(timezone.utc)
+        documents = [self.document(cards, row, columns[row], scores[row], computed_at) for row in range(len(cards))]
+        neighbors = self.db[collection_name]
+        # lookups that miss fall back to a live search while this runs
+        await neighbors.delete_many({'path': self.path})
+        for start in range(0, len(documents), 1000):
+            await neighbors.insert_many(documents[start:start + 1000], ordered=False)
+
+        return {
+            'trials': len(cards),
+            'written': len(documents),
+            'load_seconds': loaded - started,
+            'score_seconds': scored - loaded,
+            'write_seconds': time.perf_counter() - scored,
+        }
+
+    async def refresh(self) -> dict:
+        '''
+        Scores only trials without a neighbour document (new since the last run) against
+         every trial, then merges them into existing neighbour lists where they now rank
+         in the top k. Changed or deleted trials need a build()
+        '''
+        started = time.perf_counter()
+        neighbors = self.db[collection_name]
+        cards, matrix = await self.load()
+        existing = {}
+        async for document in neighbors.find({'path': self.path}, {'_id': 0, 'nct_id': 1, 'neighbors': 1}):
+            existing[document['nct_id']] = document['neighbors']
+
+        new = np.asarray([row for row, card in enumerate(cards) if card['nct_id'] not in existing], dtype=np.int64)
+        old = np.asarray([row for row, card in enumerate(cards) if card['nct_id'] in existing], dtype=np.int64)
+        if len(new) == 0:
+            return {'trials': len(cards), 'new': 0, 'updated': 0, 'seconds': time.perf_counter() - started}
+
+        computed_at = datetime.now(timezone.utc)
+        new_columns, new_scores = await self.score(matrix, new)
+        old_columns, old_scores = await self.score(matrix, old, columns=new)
+
+        updated = []
+        for i, row in enumerate(old):
+            stored = existing[cards[row]['nct_id']]
+            floor = stored[-1]['score'] if len(stored) >= self.k else 0.0
+            added = [
+                {**cards[column], 'score': (1 + float(score)) / 2}
+                for column, score in zip(old_columns[i], old_scores[i]) if column >= 0 and (1 + score) / 2 > floor]
+            if added:
+                merged = sorted(stored + added, key=lambda neighbor: -neighbor['score'])[:self.k]
+                updated.append((cards[row]['nct_id'], merged))
+
+        documents = [self.document(cards, row, new_columns[i], new_scores[i], computed_at) for i, row in enumerate(new)]
+        for start in range(0, len(documents), 1000):
+            await neighbors.insert_many(documents[start:start + 1000], ordered=False)
+        for nct_id, merged in updated:
+            await neighbors.update_one(
+                {'nct_id': nct_id, 'path': self.path},
+                {'$set': {'neighbors': merged, 'computed_at': computed_at}})
+
+        return {
+            'trials': len(cards),
+            'new': len(documents),
+            'updated': len(updated),
+            'seconds': time.perf_counter() - started,
+        }
+
+async def stored_neighbors(db, nct_id: str, path: str, skip: int, limit: int) -> Optional[list]:
+    '''
+    Precomputed neighbours skip..skip + limit of a trial, or None if there aren't
+     that many stored (not built yet, or a page past k)
+    '''
+    document = await find_one(
+        db[collection_name], {'nct_id': nct_id, 'path': path}, {'_id': 0, 'neighbors': 1}, 'lookup')
+    if document is None or len(document['neighbors']) < skip + limit:
+        return None
+    return document['neighbors'][skip:skip + limit]
@@ -0,0 +1,346 @@
+import functools
+import math
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from typing import Optional
+
+date_fields = ('start_date', 'effective_time')
+
+@dataclass(frozen=True)
+class Match:
+    '''
+    A field:value filter; queryString gets it as written
+    '''
+    field: str
+    value: str
+    text: str
+
+@dataclass(frozen=True)
+class DateRange:
+    '''
+    A start_date:YYYY-MM-DD or effective_time:YYYY-MM-DD filter, matching the year
+     from that date
+    '''
+    field: str
+    start: datetime
+    text: str
+
+    @property
+    def end(self) -> datetime:
+        return self.start + timedelta(days=365)
+
+@dataclass(frozen=True)
+class Filters:
+    '''
+    The filters= list parsed once, with the forms each pipeline needs. Shared between
+     requests (see parse_filters), so read-only
+    '''
+    clauses: tuple = ()
+    # queryString defaultPath: the first filter's field
+    default_path: str = ''
+    # queryString query over everything but start_date filters
+    query_string: Optional[str] = None
+    # Atlas Search range operator for the first date filter
+    range: Optional[dict] = None
+    # $vectorSearch MQL pre-filter over all filters
+    mql: Optional[dict] = None
+
+no_filters = Filters()
+
+def parse_filters(filters: Optional[list]) -> Filters:
+    if not filters:
+        return no_filters
+    return parsed_filters(tuple(filters))
+
+@functools.lru_cache(maxsize=1024)
+def parsed_filters(filters: tuple) -> Filters:
+    clauses = tuple(parse_clause(text) for text in filters)
+
+    matching = [clause.text for clause in clauses if not (isinstance(clause, DateRange) and clause.field == 'start_date')]
+    if not matching:
+        query_string = None
+    elif len(matching) == 1:
+        query_string = matching[0]
+    else:
+        query_string = '(' + ') AND ('.join(matching) + ')'
+
+    dates = [clause for clause in clauses if isinstance(clause, DateRange)]
+    range_query = None
+    if dates:
+        range_query = {'range': {'path': dates[0].field, 'gte': dates[0].start, 'lt': dates[0].end}}
+
+    mql = []
+    for clause in clauses:
+        if isinstance(clause, DateRange):
+            mql.extend([{clause.field: {'$gte': clause.start}}, {clause.field: {'$lte': clause.end}}])
+        else:
+            mql.append({clause.field: clause.value})
+
+    return Filters(
+        clauses=clauses,
+        default_path=clauses[0].field,
+        query_string=query_string,
+        range=range_query,
+        mql={'$and': mql})
+
+def parse_clause(text: str):
+    name, colon, rest = text.partition(':')
+    if not colon:
+        raise HTTPException(status_code=400, detail=f"filter {text!r} isn't field:value")
+
+    value = rest.split(':')[0]
+    if name in date_fields:
+        # "2020-01-01" or 2020-01-01, anything after the date is ignored
+        day = value[1:11] if value.startswith('"') else value[0:10]
+        try:
+            return DateRange(name, datetime.strptime(day, "%Y-%m-%d"), text)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"filter {text!r} needs a YYYY-MM-DD date")
+
+    if value.startswith('"'):  # remove quotes
+        value = re.sub(r'["\']+', '', value)
+    return Match(name, value, text)
+
+@dataclass(frozen=True, eq=False)
+class SearchSpec:
+    '''
+    What differs between the trials and drugs search pipelines. Compared and hashed
+     by identity, one instance per collection
+    '''
+    collection: str
+    index: str
+    exists_path: str
+    boost_paths: list
+    text_paths: list
+    fuzzy: dict
+    vector_index: str
+    vector_path: str
+    token_field: str
+    highlight_paths: list = field(default_factory=list)
+    # date filters become a $search range operator (otherwise they only reach queryString)
+    range_filter: bool = False
+    # $project before $addFields, so the projection needn't keep the computed fields
+    project_first: bool = False
+
+class Param:
+    '''
+    A per-request value in a pipeline template
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+
+search_modes = ('lexical', 'vector', 'hybrid')
+
+def search_mode(mode: Optional[str], use_vector: Optional[bool]) -> str:
+    '''
+    mode= when given (it overrides use_vector), otherwise lexical or vector by use_vector
+    '''
+    if mode is None:
+        return 'vector' if use_vector else 'lexical'
+    if mode not in search_modes:
+        raise HTTPException(status_code=422, detail="mode must be one of lexical, vector or hybrid")
+    return mode
+
+def check_hybrid(term: Optional[str], sort: Optional[str], pagination_token: Optional[str]):
+    if term is None:
+        raise HTTPException(status_code=422, detail="mode=hybrid needs a term")
+    if sort is not None:
+        raise HTTPException(status_code=422, detail="sort is not supported with mode=hybrid")
+    if pagination_token is not None:
+        raise HTTPException(status_code=422, detail="pagination_token is not supported with mode=hybrid")
+
+def check_search(term: Optional[str], use_vector: Optional[bool], include_facets: Optional[bool], pagination_token: Optional[str]):
+    if not use_vector:
+        return
+    if term is None:
+        raise HTTPException(status_code=422)
+    if include_facets:
+        raise HTTPException(status_code=422, detail="include_facets is not supported with use_vector")
+    if pagination_token is not None:
+        raise HTTPException(status_code=422, detail="pagination_token is not supported with use_vector")
+
+def build_search(
+    spec: SearchSpec,
+    filters: Filters,
+    term: Optional[str],
+    limit: int,
+    skip: Optional[int],
+    pagination_token: Optional[str],
+    sort: Optional[str],
+    sort_order: Optional[int],
+    use_vector: Optional[bool],
+    num_candidates: Optional[int],
+    projection: dict,
+    query_vector: Optional[list] = None) -> list:
+    '''
+    The $search (or $vectorSearch) pipeline up to and including the projection, built
+     by the compiled template for this combination of parameters. The pipeline, its
+     stages and the stage specs are new for each call and may be modified; anything
+     deeper may be shared with other requests
+    '''
+    vector = bool(use_vector)
+    shape = (
+        term is not None,
+        vector,
+        not vector and bool(filters.query_string),
+        not vector and spec.range_filter and filters.range is not None,
+        vector and filters.mql is not None,
+        not vector and sort is not None,
+        pagination_token is not None,
+        pagination_token is None and bool(skip and skip > 0),
+    )
+    return compiled_search(spec, shape)({
+        'term': term,
+        'default_path': filters.default_path,
+        'query_string': filters.query_string,
+        'range': filters.range,
+        'mql': filters.mql,
+        'query_vector': query_vector,
+        'num_candidates': num_candidates,
+        'limit': limit,
+        'skip': skip,
+        'sort': {sort: 1 if sort_order is None else sort_order},
+        'pagination_token': pagination_token,
+        'projection': projection,
+    })
+
+def candidates_for(limit: int, selectivity: float, multiplier: float, exponent: float, maximum: int) -> int:
+    '''
+    $vectorSearch numCandidates for limit hits when the pre-filter passes selectivity
+     (0..1] of the collection: limit * multiplier, grown by selectivity ** -exponent for
+     selective filters, within [limit, maximum]. tools/calibrate_candidates.py fits
+     multiplier and exponent to a recall target
+    '''
+    if selectivity <= 0:
+        # nothing passes the filter, more candidates won't find it
+        return limit
+    wanted = limit * multiplier * min(selectivity, 1.0) ** -exponent
+    return max(limit, min(maximum, math.ceil(wanted)))
+
+def filter_count(spec: SearchSpec, filters: Filters, threshold: int) -> dict:
+    '''
+    $searchMeta stage counting (exactly up to threshold) what the $vectorSearch
+     pre-filter passes, clause by clause: field:value as queryString, dates as the same
+     inclusive range as the MQL filter. Runs on the search index, not a collection scan
+    '''
+    clauses = []
+    for clause in filters.clauses:
+        if isinstance(clause, DateRange):
+            clauses.append({'range': {'path': clause.field, 'gte': clause.start, 'lte': clause.end}})
+        else:
+            clauses.append({'queryString': {'defaultPath': clause.field, 'query': clause.text}})
+    return {
+        '$searchMeta': {
+            'index': spec.index,
+            'compound': {'filter': clauses},
+            'count': {'type': 'lowerBound', 'threshold': threshold},
+        }
+    }
+
+@functools.lru_cache(maxsize=512)
+def compiled_search(spec: SearchSpec, shape: tuple):
+    return compile_template(search_template(spec, *shape))
+
+def search_template(
+    spec: SearchSpec,
+    term: bool,
+    vector: bool,
+    query_string: bool,
+    date_range: bool,
+    vector_filter: bool,
+    sort: bool,
+    pagination_token: bool,
+    skip: bool) -> list:
+    if vector:
+        search = {
+            'index': spec.vector_index,
+            'queryVector': Param('query_vector'),
+            'path': spec.vector_path,
+            'numCandidates': Param('num_candidates'),
+            'limit': Param('limit'),
+        }
+        if vector_filter:
+            search['filter'] = Param('mql')
+        pipeline = [{'$vectorSearch': search}]
+    else:
+        compound = {}
+        if term:
+            compound['should'] = [{
+                'text': {
+                    'query': Param('term'),
+                    'path': spec.boost_paths,
+                    'score': { 'boost': { 'value': 3 } }
+                }
+            }]
+            compound['must'] = [{
+                'text': {
+                    'query': Param('term'),
+                    'path': spec.text_paths,
+                    'fuzzy': spec.fuzzy
+                }
+            }]
+        if query_string:
+            compound['filter'] = [{
+                'queryString': {
+                    'defaultPath': Param('default_path'),
+                    'query': Param('query_string')
+                }
+            }]
+        else:
+            compound['filter'] = [{ 'exists': { 'path': spec.exists_path } }]
+        if date_range:
+            compound['filter'].append(Param('range'))
+
+        search = {'index': spec.index, 'compound': compound, 'count': { 'type': 'total' }}
+        if term and spec.highlight_paths:
+            search['highlight'] = { 'path': spec.highlight_paths }
+        if sort:
+            search['sort'] = Param('sort')
+        if pagination_token:
+            search['searchAfter'] = Param('pagination_token')
+        pipeline = [{'$search': search}]
+
+    if skip:
+        pipeline.append({'$skip': Param('skip')})
+    if not vector:
+        # $vectorSearch applies its own limit
+        pipeline.append({'$limit': Param('limit')})
+
+    add_fields = {'score': {'$meta': 'vectorSearchScore' if vector else 'searchScore'}}
+    if spec.highlight_paths:
+        add_fields['highlights'] = {'$meta': 'searchHighlights'}
+    add_fields[spec.token_field] = {'$meta': 'searchSequenceToken'}
+    tail = [{'$addFields': add_fields}, {'$project': Param('projection')}]
+    pipeline.extend(reversed(tail) if spec.project_first else tail)
+    return pipeline
+
+def compile_template(template, depth: int = 0):
+    '''
+    Turns a template into a function of the request's parameters that builds it.
+     The outer three levels (pipeline, stages, stage specs) are rebuilt on every call
+     since callers add to them; deeper subtrees without a Param are shared
+    '''
+    if isinstance(template, Param):
+        name = template.name
+        return lambda params: params[name]
+    if depth >= 3 and not has_params(template):
+        return lambda params: template
+    if isinstance(template, dict):
+        items = [(key, compile_template(value, depth + 1)) for key, value in template.items()]
+        return lambda params: {key: build(params) for key, build in items}
+    if isinstance(template, list):
+        builders = [compile_template(value, depth + 1) for value in template]
+        return lambda params: [build(params) for build in builders]
+    return lambda params: template
+
+def has_params(template) -> bool:
+    if isinstance(template, Param):
+        return True
+    if isinstance(template, dict):
+        return any(has_params(value) for value in template.values())
+    if isinstance(template, list):
+        return any(has_params(value) for value in template)
+    return False
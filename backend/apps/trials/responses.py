@@ -0,0 +1,60 @@
+import functools
+import orjson
+from bson import Binary, Decimal128, ObjectId, Regex, Timestamp
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute
+
+from .metrics import stage, timed_request
+
+def bson_default(value):
+    '''
+    orjson fallback for the BSON types orjson doesn't know (datetime, date and UUID
+     are encoded natively)
+    '''
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, Timestamp):
+        return value.as_datetime()
+    if isinstance(value, Regex):
+        return value.pattern
+    if isinstance(value, Binary):
+        return value.hex()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+class BSONResponse(JSONResponse):
+    '''
+    JSON response rendered with orjson, including Mongo documents as returned by Motor
+    '''
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+
+class BSONRoute(APIRoute):
+    '''
+    Route class that renders whatever the endpoint returns straight to a BSONResponse,
+     skipping FastAPI's jsonable_encoder pass over every document. The route's
+     response_model still documents the schema in OpenAPI but isn't validated.
+     Endpoints are timed per route (see metrics.py)
+    '''
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not getattr(endpoint, 'bson_encoded', False):
+            endpoint = bson_encoded(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+def bson_encoded(endpoint):
+    @functools.wraps(endpoint)
+    async def encoded(*args, **kwargs):
+        with timed_request(endpoint.__name__):
+            content = await endpoint(*args, **kwargs)
+            if isinstance(content, Response):
+                return content
+            with stage('serialization'):
+                return BSONResponse(content)
+
+    encoded.bson_encoded = True
+    return encoded
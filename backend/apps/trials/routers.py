@@ -1,23 +1,53 @@
-from .models import TrialModel, DrugModel, MLTModel
-from datetime import date, datetime, timedelta
-from fastapi import APIRouter, Body, HTTPException, Request, status, Query
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer
+from .cache import normalize_query
+from .db import aggregate, batches, cancel_on_disconnect, find_one, query_deadline, query_errors
+from .diagnostics import diagnosable, diagnosing
+from .export import drug_columns, export_response, trial_columns
+from .fields import Projection, drug_projection, trial_projection
+from .fusion import reciprocal_rank_fusion
+from .metrics import branch, embedding_lookups_total, stage, timed
+from .models import MLTModel, TrialResult, DrugResult, TrialSearchResponse, DrugSearchResponse
+from .neighbors import stored_neighbors
+from .pipelines import (
+    SearchSpec, build_search, candidates_for, check_hybrid, check_search, filter_count, parse_filters,
+    search_mode)
+from .responses import BSONRoute
+from .singleflight import request_key
+from .vectors import encode_vector, vector_format
+from config import settings
+from datetime import datetime
+from fastapi import APIRouter, Body, HTTPException, Request, Query
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from typing import Optional, List
+import asyncio
+import base64
+import json
+import logging
 import re
+import uuid
 
-trial_router = APIRouter()
-drug_router = APIRouter()
+# endpoints' documents go straight to orjson (see responses.py)
+trial_router = APIRouter(route_class=BSONRoute)
+drug_router = APIRouter(route_class=BSONRoute)
 
-client = OpenAI(
-    # Defaults to os.environ.get("OPENAI_API_KEY")
-    # TODO: change base URL for Radiant
-)
+logger = logging.getLogger(__name__)
+
+openai_client = None
+
+def get_openai_client():
+    '''
+    The OpenAI client is only built (and openai only imported) on first use
+    '''
+    global openai_client
+    if openai_client is None:
+        from openai import OpenAI
+        openai_client = OpenAI(
+            # Defaults to os.environ.get("OPENAI_API_KEY")
+            # TODO: change base URL for Radiant
+        )
+    return openai_client
 
 trial_project = {
-    '$project': {
+    '$project': Projection({
         '_id': 0,
         'nct_id': 1,
         'brief_title': 1,
@@ -34,27 +64,46 @@ trial_project = {
         'score': 1,
         'trial_pagination_token': 1,
         'count': 1
-    }
+    })
+}
+
+# show_trial: the list fields plus the long ones
+trial_detail_project = {
+    '$project': Projection({
+        **trial_project['$project'],
+        'detailed_description': 1,
+        'enrollment': 1,
+        'gender': 1,
+        'maximum_age': 1,
+        'minimum_age': 1,
+        'url': 1,
+        'facility': 1,
+    })
 }
 
 mlt_trial_project = {
-    '$project': {
+    '$project': Projection({
         '_id': 0,
         'nct_id': 1,
         'brief_title': 1,
         'start_date': 1,
         'completion_date': 1,
         'score': 1,
-    }
+    })
 }
 
+# what mlt_search needs of the trial it's given by nct_id
+mlt_source_project = Projection({'_id': 0, 'brief_title': 1, 'detailed_description': 1})
+# the text is only fetched (mlt_source_project) for a trial without a stored vector
+mlt_source_vector_project = Projection({'_id': 0, 'detailed_description_vector': 1})
+
 trial_autocomplete_project = {
-    '$project': {
+    '$project': Projection({
         '_id': 0,
         'nct_id': 1,
         'brief_title': 1,
         'highlights': { '$meta': 'searchHighlights' },
-    }
+    })
 }
 
 fuzzy = {
@@ -62,42 +111,123 @@ fuzzy = {
     'maxExpansions': 100
 }
 
+trial_search = SearchSpec(
+    collection='trials',
+    index='default',
+    exists_path='nct_id',
+    boost_paths=['brief_title'],
+    text_paths=['brief_title', 'official_title', 'brief_summary', 'detailed_description'],
+    fuzzy=fuzzy,
+    vector_index='trials_vector_index',
+    vector_path='detailed_description_vector',
+    token_field='trial_pagination_token',
+    range_filter=True)
+
+trial_facets_object = {
+    'conditions': {
+        'type': 'string',
+        'path': 'condition',
+        'numBuckets': 10
+    },
+    'intervention_types': {
+        'type': 'string',
+        'path': 'intervention',
+        'numBuckets': 10
+    },
+    'interventions': {
+        'type': 'string',
+        'path': 'intervention_mesh_term',
+        'numBuckets': 10
+    },
+    'genders': {
+        'type': 'string',
+        'path': 'gender',
+        'numBuckets': 10
+    },
+    'sponsors': {
+        'type': 'string',
+        'path': 'sponsors.agency',
+        'numBuckets': 10
+    },
+    'start_date': {
+        'type': 'date',
+        'path': 'start_date',
+        'boundaries': [
+            datetime.fromisoformat('2012-01-01'),
+            datetime.fromisoformat('2013-01-01'),
+            datetime.fromisoformat('2014-01-01'),
+            datetime.fromisoformat('2015-01-01'),
+            datetime.fromisoformat('2016-01-01'),
+            datetime.fromisoformat('2017-01-01'),
+            datetime.fromisoformat('2018-01-01'),
+            datetime.fromisoformat('2019-01-01'),
+            datetime.fromisoformat('2020-01-01'),
+            datetime.fromisoformat('2021-01-01'),
+            datetime.fromisoformat('2022-01-01'),
+            datetime.fromisoformat('2023-01-01'),
+            datetime.fromisoformat('2024-01-01'),
+        ],
+        'default': 'other'
+    },
+    'statuses': {
+        'type': 'string',
+        'path': 'status',
+        'numBuckets': 10
+    },
+}
+
+# landing-page facets (no term, no filters) are precomputed and refreshed in the background
+default_trial_facets_key = ('trials.facets', 'default')
+
+# returns the page of hits and $$SEARCH_META (count and facet buckets) as a single document
+search_meta_facet = {
+    '$facet': {
+        'results': [],
+        'meta': [{ '$replaceWith': '$$SEARCH_META' }, { '$limit': 1 }]
+    }
+}
+
 ################
 # Trial Router #
 ################
-@trial_router.get("/", response_description="List all trials")
+@trial_router.get("/", response_description="List all trials", response_model=TrialSearchResponse)
 async def list_trials(
     request: Request,
     limit: Optional[int] = 100,
     skip: Optional[int] = 0,
     pagination_token: Optional[str] = None,
     sort: Optional[str] = None,
-    sort_order: Optional[int] = 1):
-
-    trials = await search_trials(
+    sort_order: Optional[int] = 1,
+    fields: Optional[str] = None):
+
+    if sort in (None, 'nct_id') and (pagination_token is None or is_keyset_token(pagination_token)):
+        # plain browsing doesn't need Atlas Search; page through the nct_id index instead
+        return await cancel_on_disconnect(request, browse_collection(
+            request.app.mongodb["trials"],
+            key_field='nct_id',
+            projection=trial_projection(fields, trial_project['$project']),
+            token_field='trial_pagination_token',
+            limit=limit,
+            skip=skip,
+            pagination_token=pagination_token,
+            sort_order=sort_order))
+
+    return await search_trials(
         request,
         limit=limit,
         skip=skip,
         sort=sort,
         sort_order=sort_order,
         pagination_token=pagination_token,
+        fields=fields,
         filters=None)
-    return trials
 
-@trial_router.get("/{nct_id}", response_description="Get a single trial")
-async def show_trial(nct_id: str, request: Request):
-    project = trial_project['$project']
-    project['completion_date'] = 1
-    project['detailed_description'] = 1
-    project['enrollment'] = 1
-    project['gender'] = 1
-    project['maximum_age'] = 1
-    project['minimum_age'] = 1
-    project['url'] = 1
-    project['facility'] = 1
-
-    if (trial := await request.app.mongodb["trials"].find_one(
-        {"nct_id": nct_id}, project)) is not None:
+@trial_router.get("/{nct_id}", response_description="Get a single trial", response_model=TrialResult)
+async def show_trial(nct_id: str, request: Request, fields: Optional[str] = None):
+    project = trial_projection(fields, trial_detail_project['$project'])
+
+    if (trial := await find_one(
+        request.app.mongodb["trials"], {"nct_id": nct_id}, project, 'lookup')) is not None:
         return trial
 
     raise HTTPException(status_code=404, detail=f"Trial {nct_id} not found")
@@ -150,10 +280,12 @@ async def autocomplete_trials(
     if nct:
         pipeline.append(title_override)
   
-    trials = await request.app.mongodb["trials"].aggregate(pipeline).to_list(length=limit)
+    trials = await cancel_on_disconnect(
+        request, aggregate(request.app.mongodb["trials"], pipeline, 'autocomplete', length=limit))
     return trials
 
-@trial_router.post("/", response_description="Search for trials")
+@trial_router.post("/", response_description="Search for trials", response_model=TrialSearchResponse)
+@diagnosable
 async def search_trials(
     request: Request,
     term: Optional[str] = None,
@@ -163,205 +295,216 @@ async def search_trials(
     sort: Optional[str] = None,
     sort_order: Optional[int] = 1,
     use_vector: Optional[bool] = False,
-    num_candidates: Optional[int] = 1000,
+    mode: Optional[str] = None,
+    num_candidates: Optional[int] = None,
+    include_facets: Optional[bool] = False,
+    count_mode: Optional[str] = 'total',
+    count_threshold: Optional[int] = 1000,
+    window_pages: Optional[int] = None,
+    session: Optional[str] = None,
+    fields: Optional[str] = None,
+    explain: Optional[bool] = False,
+    profile: Optional[bool] = False,
     filters: Optional[List[str]] = Query(None)):
-    basic_search_no_term = {
-        '$search': {
-            'index': 'default',
-            'compound': {
-                'filter': [{
-                    'exists': { 'path': 'nct_id' }
-                }]
-            },
-            'count': { 'type': 'total' }
-        }
-    }
-
-    basic_search = {
-        '$search': {
-            'index': 'default',
-            'compound': {
-                'filter': [{
-                    'exists': { 'path': 'nct_id' }
-                }],
-                'should': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'brief_title',
-                        ],
-                        'score': { 'boost': { 'value': 3 } }
-                    }}
-                ],
-                'must': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'brief_title',
-                            'official_title',
-                            'brief_summary',
-                            'detailed_description'
-                        ],
-                        'fuzzy': fuzzy
-                    }
-                }]
-            },
-            'count': { 'type': 'total' }
-            #'highlight': {
-            #    'path': [
-            #        'brief_summary',
-            #        'detailed_description'
-            #    ]
-            #}
-        }
-    }
-
-    default_filter_field = filters[0].split(":")[0] if filters != None and len(filters) > 0 else ""
-    query_string = await filters_to_query_string(filters)
-    print(f"query_string: {query_string}")
-    
-    search_with_filters = {
-        '$search': {
-            'index': 'default',
-            'compound': {
-                'should': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'brief_title',
-                        ],
-                        'score': { 'boost': { 'value': 3 } }
-                    }}
-                ],
-                'must': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'brief_title',
-                            'official_title',
-                            'brief_summary',
-                            'detailed_description'
-                        ],
-                        'fuzzy': fuzzy
-                    }
-                }],
-                'filter': [{
-                    'queryString': {
-                        'defaultPath': default_filter_field,
-                        'query': query_string
-                    }
-                }]
-            },
-            'count': { 'type': 'total' },
-            #'highlight': {
-                #'path': [
-                    #'brief_summary',
-                    #'brief_title',
-                    #'official_title',
-                    #'detailed_description'
-                #]
-            #}
-        }
-    }
-    
-    search_no_term_with_filters = {
-        '$search': {
-            'index': 'default',
-            'compound': {
-                'filter': [{
-                    'queryString': {
-                        'defaultPath': default_filter_field,
-                        'query': query_string
-                    }
-                }]
-            },
-            'count': { 'type': 'total' }
-        }
-    }
-    
-    vector_search = {
-        '$vectorSearch': {
-            'index': 'trials_vector_index', 
-            'queryVector': [],
-            'path': 'detailed_description_vector', 
-            'numCandidates': num_candidates,
-            'limit': limit
-        }
-    }
-
-    add_fields = {
-        '$addFields': {
-            'score': {'$meta': 'searchScore'},
-            #'highlights': {'$meta': 'searchHighlights'},
-            'trial_pagination_token': {'$meta' : 'searchSequenceToken'},
-        }
-    }
-
-    range_query = await filters_to_range_query(filters)
-    mql_filter = await filters_to_mql_query(filters)
-    print(f"mql_filter: {mql_filter}")
-    if (range_query != None):
-        basic_search['$search']['compound']['filter'].append(range_query)
-        basic_search_no_term['$search']['compound']['filter'].append(range_query)
-        search_no_term_with_filters['$search']['compound']['filter'].append(range_query)
-        search_with_filters['$search']['compound']['filter'].append(range_query)
-        vector_search['$vectorSearch']['filter'] = mql_filter
-    
-    if (use_vector == True):
-        if (term is None):
-            raise HTTPException(status_code=422)
-        else:
-            add_fields['$addFields']['score'] = { '$meta': 'vectorSearchScore' }
-    else:
-        add_fields['$addFields']['count'] = '$$SEARCH_META.count'
-    
-    pipeline = []
-    
-    if (term is None):
-        if query_string != None and len(query_string) > 0:
-            pipeline.append(search_no_term_with_filters)
-        else:
-            pipeline.append(basic_search_no_term)
-    else:
-        if (use_vector == True):
-            # vectorize the search term
-            vector_search['$vectorSearch']['queryVector'] = await get_cached_embeddings(request, term) #create_openai_embeddings(term, client)
-            pipeline.append(vector_search)
-        else:
-            if query_string != None and len(query_string) > 0:
-                pipeline.append(search_with_filters)
-            else:
-                pipeline.append(basic_search)
-            pipeline.append({'$limit': limit})
-    
-    # sorting
-    if (sort != None and use_vector == False):
-        pipeline[0]['$search']['sort'] = { sort: sort_order }
-    
-    # pagination
-    if pagination_token != None:
-        pipeline[0]['$search']['searchAfter'] = pagination_token
-    elif skip and skip > 0:
-        pipeline.append({'$skip': skip})
-
-    pipeline.extend([add_fields, trial_project])
+    check_count_mode(count_mode)
+    mode = search_mode(mode, use_vector)
+
+    if (window_pages and window_pages > 1) or session:
+        # deep pagination served from a server-side window of results
+        return await windowed_search(
+            request,
+            search_trials,
+            token_field='trial_pagination_token',
+            session=session,
+            window_pages=window_pages,
+            limit=limit,
+            skip=skip,
+            term=term,
+            sort=sort,
+            sort_order=sort_order,
+            use_vector=use_vector,
+            mode=mode,
+            num_candidates=num_candidates,
+            include_facets=include_facets,
+            count_mode=count_mode,
+            count_threshold=count_threshold,
+            fields=fields,
+            filters=filters)
+
+    if mode == 'hybrid':
+        check_hybrid(term, sort, pagination_token)
+        return await hybrid_search(
+            request,
+            search_trials,
+            key_field='nct_id',
+            token_field='trial_pagination_token',
+            limit=limit,
+            skip=skip,
+            term=term,
+            num_candidates=num_candidates,
+            include_facets=include_facets,
+            count_mode=count_mode,
+            count_threshold=count_threshold,
+            fields=fields,
+            filters=filters)
+    use_vector = mode == 'vector'
+
+    pipeline = await trial_search_pipeline(
+        request,
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        fields=fields,
+        filters=filters)
+
+    # counting: once per query, later pages reuse the cached count
+    count_cache = request.app.state.count_cache
+    count_key = request_key(
+        'trials.count',
+        term=term,
+        count_mode=count_mode,
+        count_threshold=count_threshold,
+        filters=filters or [])
+    count = count_cache.get(count_key) if use_vector == False and not diagnosing() else None
+    if use_vector == False:
+        set_count_collector(pipeline[0], None if count else count_mode, count_threshold)
+
+    if include_facets:
+        # hits and facet buckets from one $search evaluation
+        to_facet_collector(pipeline[0], trial_facets_object)
+    with_meta = use_vector == False and (include_facets or 'count' in pipeline[0]['$search'])
+    if with_meta:
+        pipeline.append(search_meta_facet)
     #print(pipeline)
 
-    trials = await request.app.mongodb["trials"].aggregate(pipeline).to_list(length=limit)
+    # identical concurrent searches share a single aggregation
+    key = request_key(
+        'trials.search',
+        fields=fields,
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        count_mode=count_mode,
+        count_threshold=count_threshold,
+        filters=filters or [])
+
+    async def run_search():
+        trials = await aggregate(request.app.mongodb["trials"], pipeline, 'search', length=limit)
+        if not with_meta:
+            return {'results': trials, 'count': count}
+
+        results, meta = split_search_meta(trials)
+        if meta is None:
+            meta = await empty_page_meta(
+                request.app.mongodb["trials"], pipeline[0], skip, pagination_token, trial_facets_object)
+        envelope = {'results': results, 'count': count}
+        if meta and 'count' in meta:
+            envelope['count'] = meta['count']
+            count_cache.set(count_key, meta['count'])
+        if include_facets:
+            envelope['facets'] = format_trial_facets([meta or empty_search_meta(trial_facets_object)])
+        return envelope
+
+    return await cancel_on_disconnect(request, shared(request, key, run_search))
+
+@timed('pipeline')
+async def trial_search_pipeline(
+    request: Request,
+    term: Optional[str],
+    limit: int,
+    skip: Optional[int],
+    pagination_token: Optional[str],
+    sort: Optional[str],
+    sort_order: Optional[int],
+    use_vector: Optional[bool],
+    num_candidates: Optional[int],
+    include_facets: Optional[bool],
+    filters: Optional[List[str]],
+    fields: Optional[str] = None):
+    '''
+    The $search (or $vectorSearch) pipeline for search_trials and export_trials,
+     up to and including the projection
+    '''
+    return await search_pipeline(
+        request,
+        trial_search,
+        trial_projection(fields, trial_project['$project']),
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        filters=filters)
 
-    return trials
+@trial_router.post("/export", response_description="Stream matching trials as NDJSON, CSV or Arrow")
+async def export_trials(
+    request: Request,
+    term: Optional[str] = None,
+    format: Optional[str] = 'ndjson',
+    batch_size: Optional[int] = None,
+    limit: Optional[int] = None,
+    sort: Optional[str] = None,
+    sort_order: Optional[int] = 1,
+    use_vector: Optional[bool] = False,
+    num_candidates: Optional[int] = None,
+    filters: Optional[List[str]] = Query(None)):
+    '''
+    Same arguments as search_trials, but every match is streamed from a single cursor
+     instead of paging through POST /trials/
+    '''
+    batch_size, limit = export_bounds(batch_size, limit, use_vector)
+    pipeline = await trial_search_pipeline(
+        request,
+        term=term,
+        limit=limit,
+        skip=0,
+        pagination_token=None,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates and max(num_candidates, limit),
+        include_facets=False,
+        filters=filters)
+    # nobody reads the count
+    pipeline[0].get('$search', {}).pop('count', None)
+
+    return export_response(
+        batches(request.app.mongodb["trials"], pipeline, 'export', batch_size),
+        trial_columns,
+        format,
+        filename='trials')
 
 @trial_router.post("/facets", response_description="Facet search for trials")
+@diagnosable
 async def search_trial_facets(
     request: Request,
     term: Optional[str] = None,
     filters: Optional[List[str]] = Query(None),
     count_only: Optional[bool] = False,
-    use_vector: Optional[bool] = False):
+    use_vector: Optional[bool] = False,
+    explain: Optional[bool] = False,
+    profile: Optional[bool] = False):
     
-    default_filter_field = filters[0].split(":")[0] if filters != None and len(filters) > 0 else ""
-    query_string = await filters_to_query_string(filters)
-    range_query = await filters_to_range_query(filters)
+    parsed = parse_filters(filters)
+    default_filter_field = parsed.default_path
+    query_string = parsed.query_string
+    range_query = parsed.range
 
     count_all_facets = {
         '$searchMeta': {
@@ -385,67 +528,7 @@ async def search_trial_facets(
         }
     }
 
-    facets_object = {
-        'conditions': {
-            'type': 'string',
-            'path': 'condition',
-            'numBuckets': 10
-        },
-        'intervention_types': {
-            'type': 'string',
-            'path': 'intervention',
-            'numBuckets': 10
-        },
-        'interventions': {
-            'type': 'string',
-            'path': 'intervention_mesh_term',
-            'numBuckets': 10
-        },
-        'genders': {
-            'type': 'string',
-            'path': 'gender',
-            'numBuckets': 10
-        },
-        'sponsors': {
-            'type': 'string',
-            'path': 'sponsors.agency',
-            'numBuckets': 10
-        },
-        'start_date': {
-            'type': 'date',
-            'path': 'start_date',
-            'boundaries': [
-                datetime.fromisoformat('2012-01-01'),
-                datetime.fromisoformat('2013-01-01'),
-                datetime.fromisoformat('2014-01-01'),
-                datetime.fromisoformat('2015-01-01'),
-                datetime.fromisoformat('2016-01-01'),
-                datetime.fromisoformat('2017-01-01'),
-                datetime.fromisoformat('2018-01-01'),
-                datetime.fromisoformat('2019-01-01'),
-                datetime.fromisoformat('2020-01-01'),
-                datetime.fromisoformat('2021-01-01'),
-                datetime.fromisoformat('2022-01-01'),
-                datetime.fromisoformat('2023-01-01'),
-                datetime.fromisoformat('2024-01-01'),
-            ],
-            'default': 'other'
-        },
-        'statuses': {
-            'type': 'string',
-            'path': 'status',
-            'numBuckets': 10
-        },
-    }
-
-    basic_facets_no_term = {
-        '$searchMeta': {
-            'index': 'default',
-            'facet': {
-                'facets': facets_object
-            }
-        }
-    }
+    basic_facets_no_term = trial_facets_no_term()
 
     compound_operator = { 'compound': {} }
 
@@ -471,7 +554,7 @@ async def search_trial_facets(
         }]
 
     if range_query:
-        print(f"compound_operator: {compound_operator}")
+        logger.debug("compound_operator=%s", compound_operator)
         if compound_operator['compound'] and compound_operator['compound']['filter'] and len(compound_operator['compound']['filter']) > 0:
             compound_operator['compound']['filter'].append(range_query)
         else:
@@ -482,12 +565,19 @@ async def search_trial_facets(
             'index': 'default',
             'facet': {
                 'operator': compound_operator,
-                'facets': facets_object
+                'facets': trial_facets_object
             }
         }
     }
 
     pipeline = []
+    # identical concurrent facet requests share a single aggregation
+    key = request_key(
+        'trials.facets',
+        term=term,
+        filters=filters or [],
+        count_only=count_only,
+        use_vector=use_vector)
 
     if count_only:
         if query_string and len(query_string.strip()) > 0:
@@ -508,55 +598,237 @@ async def search_trial_facets(
         # filters provided
         pipeline.append(search_facets_with_filters)
     else:
-        print("not count only basic");
         # no search term or filters provided
+        key = default_trial_facets_key
         pipeline.append(basic_facets_no_term)
 
-    print(f"Facet pipeline:", pipeline)
+    logger.debug("facet pipeline=%s", pipeline)
 
-    facets = await request.app.mongodb["trials"].aggregate(pipeline).to_list()
+    facet_cache = request.app.state.facet_cache
+    if not diagnosing() and (facets := facet_cache.get(key)) is not None:
+        return facets
 
-    if not count_only:
-        # reformat for easier consumption
-        buckets = facets[0]['facet']['conditions']['buckets']
-        conditions = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
-    
-        buckets = facets[0]['facet']['intervention_types']['buckets']
-        intervention_types = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+    async def run_facets():
+        facets = await aggregate(request.app.mongodb["trials"], pipeline, 'facets')
+        return facets if count_only else format_trial_facets(facets)
 
-        buckets = facets[0]['facet']['interventions']['buckets']
-        interventions = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+    facets = await cancel_on_disconnect(request, shared(request, key, run_facets))
+    facet_cache.set(key, facets)
+    return facets
 
-        buckets = facets[0]['facet']['sponsors']['buckets']
-        sponsors = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+def trial_facets_no_term():
+    return {
+        '$searchMeta': {
+            'index': 'default',
+            'facet': {
+                'facets': trial_facets_object
+            }
+        }
+    }
+
+def format_trial_facets(facets):
+    '''
+    Reformats the $searchMeta facet buckets for easier consumption
+    '''
+    buckets = facets[0]['facet']['conditions']['buckets']
+    conditions = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
 
-        buckets = facets[0]['facet']['genders']['buckets']
-        genders = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+    buckets = facets[0]['facet']['intervention_types']['buckets']
+    intervention_types = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
 
-        buckets = facets[0]['facet']['start_date']['buckets']
-        sdates = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
-  
-        buckets = facets[0]['facet']['statuses']['buckets']
-        statuses = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
-
-        facets[0]['conditions'] = conditions
-        facets[0]['intervention_types'] = intervention_types
-        facets[0]['interventions'] = interventions
-        facets[0]['sponsors'] = sponsors
-        facets[0]['genders'] = genders
-        facets[0]['start_date'] = sdates
-        facets[0]['statuses'] = statuses
-        del facets[0]['facet']
+    buckets = facets[0]['facet']['interventions']['buckets']
+    interventions = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    buckets = facets[0]['facet']['sponsors']['buckets']
+    sponsors = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    buckets = facets[0]['facet']['genders']['buckets']
+    genders = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    buckets = facets[0]['facet']['start_date']['buckets']
+    sdates = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    buckets = facets[0]['facet']['statuses']['buckets']
+    statuses = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    facets[0]['conditions'] = conditions
+    facets[0]['intervention_types'] = intervention_types
+    facets[0]['interventions'] = interventions
+    facets[0]['sponsors'] = sponsors
+    facets[0]['genders'] = genders
+    facets[0]['start_date'] = sdates
+    facets[0]['statuses'] = statuses
+    del facets[0]['facet']
 
     return facets
 
-@trial_router.post('/mlt', response_description="More Like This search for trials")
+def to_facet_collector(search_stage, facets_object):
+    '''
+    Moves the operator of a $search stage into a facet collector
+     <https://www.mongodb.com/docs/atlas/atlas-search/facet/#use-facet-with-the--search-stage>
+     so the facet buckets are available in $$SEARCH_META alongside the hits
+    '''
+    search = search_stage['$search']
+    search['facet'] = {
+        'operator': { 'compound': search.pop('compound') },
+        'facets': facets_object
+    }
+
+def split_search_meta(documents):
+    '''
+    Splits the output of search_meta_facet into the page of results and
+     $$SEARCH_META (count and facet buckets)
+    '''
+    document = documents[0] if len(documents) > 0 else {}
+    # an empty page (no hits, or paged past the last one) never reaches $facet's meta pipeline
+    meta = document['meta'][0] if document.get('meta') else None
+    return document.get('results', []), meta
+
+def empty_search_meta(facets_object):
+    return {'facet': {name: {'buckets': []} for name in facets_object}}
+
+# $search options that only shape the page of hits, not the count or facet buckets
+page_options = ('highlight', 'sort', 'searchAfter', 'searchBefore', 'returnStoredSource')
+
+async def empty_page_meta(collection, search_stage, skip: Optional[int], pagination_token: Optional[str], facets_object):
+    '''
+    $$SEARCH_META for a page without hits, which search_meta_facet can't return. On the
+     first page the query matched nothing, so the count is 0 and the buckets are empty;
+     past the last hit they come from a $searchMeta with the same operator
+    '''
+    search = search_stage['$search']
+    if not (skip and skip > 0) and pagination_token is None:
+        meta = empty_search_meta(facets_object)
+        if 'count' in search:
+            meta['count'] = {search['count']['type']: 0}
+        return meta
+
+    search_meta = {name: value for name, value in search.items() if name not in page_options}
+    documents = await aggregate(collection, [{'$searchMeta': search_meta}], 'search', length=1)
+    return documents[0] if documents else None
+
+async def windowed_search(
+    request: Request,
+    search,
+    token_field: str,
+    session: Optional[str],
+    window_pages: Optional[int],
+    limit: int,
+    skip: Optional[int],
+    **params):
+    '''
+    Fetches window_pages pages of results in one search and keeps them in a TTL-evicted
+     server-side cache (app.state.result_windows) under an opaque session token. Later
+     pages (same parameters, session and skip) are served from memory; once the window
+     runs out it's refilled after the last hit with searchAfter rather than $skip
+    '''
+    windows = request.app.state.result_windows
+    skip = skip or 0
+
+    window = windows.get(session) if session else None
+    if window is None or window['params'] != params or skip < window['offset']:
+        # new (or expired) session, or paging backwards past the cached window
+        session = session or uuid.uuid4().hex
+        window_size = limit * min(window_pages or windows.default_pages, windows.max_pages)
+        envelope = await search(request, limit=window_size, skip=skip, **params)
+        # coalesced searches share the envelope, so it's read, not modified
+        results = envelope['results']
+        window = {
+            'params': params,
+            'size': window_size,
+            'offset': skip,
+            'results': results,
+            'meta': {name: value for name, value in envelope.items() if name != 'results'},
+            # $vectorSearch (and so hybrid) can't be resumed with searchAfter
+            'exhausted': len(results) < window_size or params.get('mode') != 'lexical',
+        }
+        windows.set(session, window)
+
+    while skip + limit > window['offset'] + len(window['results']) and not window['exhausted']:
+        last_token = window['results'][-1].get(token_field) if window['results'] else None
+        if last_token is None:
+            window['exhausted'] = True
+            break
+
+        envelope = await search(request, limit=window['size'], pagination_token=last_token, **params)
+        more = envelope['results']
+        # keep only what the requested page still needs from the current window
+        keep_from = min(skip - window['offset'], len(window['results']))
+        window['results'] = window['results'][keep_from:] + more
+        window['offset'] += keep_from
+        window['exhausted'] = len(more) < window['size']
+        windows.set(session, window)
+
+    start = skip - window['offset']
+    return {
+        **window['meta'],
+        'results': window['results'][start:start + limit],
+        'session': session,
+    }
+
+async def hybrid_search(
+    request: Request,
+    search,
+    key_field: str,
+    token_field: str,
+    limit: int,
+    skip: Optional[int],
+    fields: Optional[str],
+    include_facets: Optional[bool],
+    **params):
+    '''
+    mode=hybrid: the lexical and vector searches for the top skip + limit hits each,
+     run concurrently (only the vector one looks up the embedding), merged by
+     reciprocal rank fusion. Count and facets come from the lexical search
+    '''
+    skip = skip or 0
+    # the fusion is keyed on it, whatever fields= asks for
+    fields = fields and f"{fields},{key_field}"
+    lexical, vector = await asyncio.gather(
+        branch(search(
+            request, mode='lexical', limit=skip + limit, skip=0, fields=fields,
+            include_facets=include_facets, **params)),
+        branch(search(
+            request, mode='vector', limit=skip + limit, skip=0, fields=fields,
+            include_facets=False, **params)))
+    # coalesced searches share their envelopes, so they're read, not modified
+    fused = reciprocal_rank_fusion(
+        [lexical['results'], vector['results']], key_field, settings.HYBRID_RRF_K)
+    for document in fused:
+        # a searchAfter position in the lexical results only (fused documents are copies)
+        document.pop(token_field, None)
+    return {
+        **{name: value for name, value in lexical.items() if name != 'results'},
+        'results': fused[skip:skip + limit],
+    }
+
+def check_count_mode(count_mode: str):
+    if count_mode not in ('total', 'lowerBound', 'none'):
+        raise HTTPException(status_code=422, detail="count_mode must be one of total, lowerBound or none")
+
+def set_count_collector(search_stage, count_mode: Optional[str], count_threshold: int):
+    '''
+    Sets the $search count option <https://www.mongodb.com/docs/atlas/atlas-search/counting/>;
+     count_mode None or 'none' skips counting altogether
+    '''
+    search = search_stage['$search']
+    if count_mode == 'total':
+        search['count'] = { 'type': 'total' }
+    elif count_mode == 'lowerBound':
+        search['count'] = { 'type': 'lowerBound', 'threshold': count_threshold }
+    else:
+        search.pop('count', None)
+
+@trial_router.post('/mlt', response_description="More Like This search for trials", response_model=List[TrialResult])
+@diagnosable
 async def mlt_search(
     request: Request,
     trial: MLTModel = Body(...),
     limit: Optional[int] = 12,
     skip: Optional[int] = 0,
-    use_vector: Optional[bool] = False):
+    use_vector: Optional[bool] = False,
+    explain: Optional[bool] = False,
+    profile: Optional[bool] = False):
     
     mlt_search = {
         '$search': {
@@ -571,19 +843,49 @@ async def mlt_search(
         '$vectorSearch': {
             'index': 'trials_vector_index',
             'queryVector': [],
-            'path': 'detailed_description_vector' if trial.description else 'brief_summary_vector',
+            'path': 'detailed_description_vector' if trial.description or trial.nct_id else 'brief_summary_vector',
             'numCandidates': 150,
             'limit': limit
         }
     }
-  
-    if trial.title and len(trial.title.strip()) > 0:
+
+    if trial.nct_id and use_vector:
+        # precomputed by tools/build_neighbors.py; a live search otherwise
+        neighbors = await stored_neighbors(
+            request.app.mongodb, trial.nct_id, 'detailed_description_vector', skip or 0, limit)
+        if neighbors is not None:
+            return neighbors
+
+    if trial.nct_id:
+        # similar to a stored trial: search with its stored vector (or text), excluding it
+        source = await find_one(
+            request.app.mongodb["trials"],
+            {'nct_id': trial.nct_id},
+            mlt_source_vector_project if use_vector else mlt_source_project,
+            'lookup')
+        if source is None:
+            raise HTTPException(status_code=404, detail=f"Trial {trial.nct_id} not found")
+        if use_vector:
+            mlt_vector_search['$vectorSearch']['filter'] = {'nct_id': {'$ne': trial.nct_id}}
+            if source.get('detailed_description_vector'):
+                mlt_vector_search['$vectorSearch']['queryVector'] = source['detailed_description_vector']
+            else:
+                # not embedded yet: embed its text
+                source = await find_one(
+                    request.app.mongodb["trials"], {'nct_id': trial.nct_id}, mlt_source_project, 'lookup') or {}
+                mlt_vector_search['$vectorSearch']['queryVector'] = await get_cached_embeddings(
+                    request, source.get('detailed_description'))
+        else:
+            mlt_search['$search']['moreLikeThis']['like'] = [
+                {'brief_title': source.get('brief_title') or ''},
+                {'detailed_description': source.get('detailed_description') or ''}]
+    elif trial.title and len(trial.title.strip()) > 0:
         if use_vector:
             mlt_vector_search['$vectorSearch']['queryVector'] = await get_cached_embeddings(request, trial.title)
         else:
             mlt_search['$search']['moreLikeThis']['like'].append({"brief_title": trial.title})
 
-    if trial.description and len(trial.description.strip()) > 0:
+    if not trial.nct_id and trial.description and len(trial.description.strip()) > 0:
         if use_vector:
             mlt_vector_search['$vectorSearch']['queryVector'] = await get_cached_embeddings(request, trial.description)
         else:
@@ -600,153 +902,249 @@ async def mlt_search(
   
     pipeline = [mlt_vector_search if use_vector else mlt_search, add_fields, mlt_trial_project]
     if not use_vector:
+        if trial.nct_id:
+            pipeline.insert(1, {'$match': {'nct_id': {'$ne': trial.nct_id}}})
         pipeline.append({'$skip': skip})
         pipeline.append({'$limit': limit})
 
     #print(pipeline)
   
-    trials = await request.app.mongodb["trials"].aggregate(pipeline).to_list()
-    return trials[1:]
+    trials = await cancel_on_disconnect(request, aggregate(request.app.mongodb["trials"], pipeline, 'mlt'))
+    # free text: the top hit is taken to be the trial the text came from
+    return trials if trial.nct_id else trials[1:]
   
-async def create_embeddings(text: str):
-    model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-    return model.encode(text).tolist()
+async def shared(request: Request, key, fn):
+    '''
+    Runs fn through request coalescing, except for explain/profile requests, which
+     need to run (and explain) their own query
+    '''
+    if diagnosing():
+        return await fn()
+    return await request.app.state.inflight.do(key, fn)
 
+async def create_embeddings(request: Request, text: str):
+    # the model is loaded once at startup and run off the event loop (see main.py lifespan)
+    return await request.app.state.embedding_batcher.encode(text)
+
+@timed('embedding')
 async def get_cached_embeddings(
     request: Request,
     text: str):
+    '''
+    Two-tier query vector cache: an in-process LRU (app.state.query_cache) in front
+     of the queries collection, which has a unique index on the normalized query
+    '''
+
+    key = normalize_query(text)
+    query_cache = request.app.state.query_cache
+
+    # tier 1: in-process LRU
+    vector = query_cache.get(key)
+    if vector is not None:
+        embedding_lookups_total.inc(tier='memory')
+        return vector
+
+    # tier 2: the queries collection; concurrent misses on the same query share one lookup and encode
+    vector = await request.app.state.inflight.do(
+        ('embedding', key), lambda: fetch_query_vector(request, key, text))
+
+    if len(vector) > 0:
+        query_cache.set(key, vector)
+
+    return vector
 
-    # lookup the query cache
-    lc_text = text.lower()
-    cached_query = await request.app.mongodb["queries"].find_one({"query": lc_text})
-    if cached_query and len(cached_query['vector']) > 0:
+async def fetch_query_vector(
+    request: Request,
+    key: str,
+    text: str):
+
+    query_cache_stats = request.app.state.query_cache_stats
+    cached_query = await find_one(
+        request.app.mongodb["queries"], {"query": key}, {"_id": 0, "vector": 1}, 'embeddings')
+    if cached_query and len(cached_query.get('vector', [])) > 0:
+        query_cache_stats['hits'] += 1
+        embedding_lookups_total.inc(tier='mongodb')
         vector = cached_query['vector']
+        if vector_format(vector) != settings.VECTOR_FORMAT:
+            # cached before a VECTOR_FORMAT change
+            vector = encode_vector(vector, settings.VECTOR_FORMAT)
         #print(f"Using cached vector: {vector[0:4]}")
     else:
+        query_cache_stats['misses'] += 1
+        embedding_lookups_total.inc(tier='model')
         # embed the query
-        vector = await create_embeddings(text)
-        # cache the query vector
+        vector = await create_embeddings(request, text)
+        # cache the query vector; the upsert keeps racing misses from creating duplicates
         if len(vector) > 0:
-            inserted = await request.app.mongodb["queries"].insert_one({"query": lc_text, "vector": vector})
-            #print(f"Caching query '{text}' - {inserted.inserted_id}")
+            vector = encode_vector(vector, settings.VECTOR_FORMAT)
+            try:
+                await request.app.mongodb["queries"].update_one(
+                    {"query": key},
+                    {"$setOnInsert": {"vector": vector}},
+                    upsert=True)
+            except DuplicateKeyError:
+                # another worker cached it first
+                pass
         else:
-            print("create_embedding returned an empty array?")
+            logger.warning("create_embeddings returned an empty vector for query=%r", key)
 
     return vector
 
-async def create_openai_embeddings(text: str, client: OpenAI):
-    response = client.embeddings.create(
+async def create_openai_embeddings(text: str, client=None):
+    response = (client or get_openai_client()).embeddings.create(
         model= "text-embedding-ada-002",
         input=[text]
     )
     
     return response.data[0].embedding
 
-async def filters_to_range_query(filters: List[str]):
-    '''
-    Converts an array of key:value filter expressions to a range 
-     <https://www.mongodb.com/docs/atlas/atlas-search/range/> query
-     or a vector search pre-filter expression
-     <https://www.mongodb.com/docs/atlas/atlas-vector-search/vector-search-stage/#atlas-vector-search-pre-filter>
-    '''
-
-    if (filters == None or len(filters) == 0):
-        return None
-
-    date_filters = [x for x in filters if x.startswith("start_date:") or x.startswith("effective_time:")]
-    start_date = end_date = None
-    if len(date_filters) > 0:
-        parts = date_filters[0].split(":")
-        p0 = parts[0] # field name
-        p1 = parts[1] # ISO date value
-        if p1 != None and p1.startswith("\""): # remove quotes
-            p1 = p1[1:11]
-        else:
-            p1 = p1[0:10]
-        start_date = datetime.strptime(p1, "%Y-%m-%d")
-        end_date = start_date + timedelta(days=365)
-    else:
-        return None
-
-    range_query = {}
-    range_query['range'] = {
-        'path': 'start_date' if p0 == 'start_date' else 'effective_time',
-        'gte': start_date,
-        'lt': end_date
-    }
-       
-    print(f"range_query: {range_query}")
-    return range_query
+keyset_token_prefix = 'ks1.'
 
-async def filters_to_mql_query(filters: List[str]):
+def export_bounds(batch_size: Optional[int], limit: Optional[int], use_vector: Optional[bool]):
+    batch_size = min(max(batch_size or settings.EXPORT_BATCH_SIZE, 1), settings.EXPORT_MAX_BATCH_SIZE)
+    limit = min(limit or settings.EXPORT_MAX_ROWS, settings.EXPORT_MAX_ROWS)
+    if use_vector:
+        # $vectorSearch caps numCandidates (and so limit) at 10000
+        limit = min(limit, 10000)
+    return batch_size, limit
+
+def is_keyset_token(token: str) -> bool:
+    return token.startswith(keyset_token_prefix)
+
+def encode_keyset_token(last_seen) -> str:
+    payload = json.dumps({'after': last_seen}).encode()
+    return keyset_token_prefix + base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_keyset_token(token: str):
+    try:
+        encoded = token[len(keyset_token_prefix):]
+        payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        last_seen = json.loads(payload)['after']
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid pagination_token")
+    # key fields are scalars; anything else (e.g. an operator document) wasn't issued here
+    if isinstance(last_seen, bool) or not isinstance(last_seen, (str, int, float)):
+        raise HTTPException(status_code=400, detail="Invalid pagination_token")
+    return last_seen
+
+async def browse_collection(
+    collection,
+    key_field: str,
+    projection: dict,
+    token_field: str,
+    limit: Optional[int] = 100,
+    skip: Optional[int] = 0,
+    pagination_token: Optional[str] = None,
+    sort_order: Optional[int] = 1):
     '''
-    Converts an array of key:value filter expressions to an Atlas Vector Search
-     MQL pre-filter expression 
-     <https://www.mongodb.com/docs/atlas/atlas-vector-search/vector-search-stage/#atlas-vector-search-pre-filter/>
+    Keyset pagination over an indexed key field: each document carries an opaque
+     continuation token (key_field > last seen) and the page carries the estimated
+     collection count, so any page costs O(limit) without touching the Atlas Search nodes
     '''
-    if filters == None or len(filters) == 0:
-        return None
-    else:
-        mql_query = {}
-        for filter in filters:
-            if filter.startswith("start_date:") or filter.startswith("effective_time:"):
-                start_date = end_date = None
-                parts = filter.split(":")
-                p0 = parts[0] # field name
-                p1 = parts[1] # ISO date value
-                if p1 != None and p1.startswith("\""): # remove quotes
-                    p1 = p1[1:11]
-                else:
-                    p1 = p1[0:10]
-                start_date = datetime.strptime(p1, "%Y-%m-%d")
-                end_date = start_date + timedelta(days=365)
-                gte = { 'start_date' if p0 == 'start_date' else 'effective_time' : { '$gte': start_date } }
-                lte = { 'start_date' if p0 == 'start_date' else 'effective_time' : { '$lte': end_date } }
-                if '$and' in mql_query:
-                    mql_query['$and'].append(gte)
-                    mql_query['$and'].append(lte)
-                else:
-                    mql_query['$and'] = [gte, lte]
+    sort_order = -1 if sort_order == -1 else 1
+    query = {}
+    if pagination_token is not None:
+        last_seen = decode_keyset_token(pagination_token)
+        query[key_field] = { '$gt' if sort_order == 1 else '$lt': last_seen }
+
+    cursor = collection.find(query, {**projection, key_field: 1}).sort(key_field, sort_order)
+    if pagination_token is None and skip and skip > 0:
+        cursor = cursor.skip(skip)
+    cursor = cursor.limit(limit).max_time_ms(query_deadline('browse'))
+    try:
+        with query_errors('browse'), stage('mongo'):
+            documents = await cursor.to_list(length=limit)
+            # collection metadata only, no scan
+            estimated_count = await collection.estimated_document_count(maxTimeMS=query_deadline('browse'))
+    finally:
+        await cursor.close()
+    for document in documents:
+        document[token_field] = encode_keyset_token(document[key_field])
+
+    return {'results': documents, 'count': { 'estimate': estimated_count }}
+
+async def search_pipeline(
+    request: Request,
+    spec: SearchSpec,
+    projection: dict,
+    term: Optional[str],
+    limit: int,
+    skip: Optional[int],
+    pagination_token: Optional[str],
+    sort: Optional[str],
+    sort_order: Optional[int],
+    use_vector: Optional[bool],
+    num_candidates: Optional[int],
+    include_facets: Optional[bool],
+    filters: Optional[List[str]]):
+    with stage('filters'):
+        parsed = parse_filters(filters)
+    logger.debug("query_string=%s mql_filter=%s", parsed.query_string, parsed.mql)
+    check_search(term, use_vector, include_facets, pagination_token)
+
+    # vectorize the search term
+    query_vector = await get_cached_embeddings(request, term) if use_vector else None
+    if use_vector and not num_candidates:
+        # enough candidates for limit hits through the pre-filter
+        selectivity = await filter_selectivity(request, spec, parsed) if parsed.mql else 1.0
+        num_candidates = candidates_for(
+            limit,
+            selectivity,
+            settings.VECTOR_CANDIDATE_MULTIPLIER,
+            settings.VECTOR_SELECTIVITY_EXPONENT,
+            settings.VECTOR_MAX_CANDIDATES)
+    return build_search(
+        spec,
+        parsed,
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        projection=projection,
+        query_vector=query_vector)
 
-            else:
-                parts = filter.split(":")
-                field = parts[0]
-                value = parts[1]
-                if value and value.startswith("\""): # remove quotes
-                    value = re.sub(r'["\']+', '', value)
-                eq = { field: value }
-                if '$and' in mql_query:
-                    mql_query['$and'].append(eq)
-                else:
-                    mql_query['$and'] = [eq]
-
-        print(f"mql_query: {mql_query}")
-        return mql_query
-
-async def filters_to_query_string(filters: List[str]):
+async def filter_selectivity(request: Request, spec: SearchSpec, filters) -> float:
     '''
-    Converts an array of key:value filter expressions to an Atlas Search queryString
-     <https://www.mongodb.com/docs/atlas/atlas-search/queryString/> operator
+    Share of the collection the filters match, from a $searchMeta count of the
+     pre-filter's clauses; cached alongside the result counts. It's only an estimate:
+     filters matching VECTOR_SELECTIVITY_THRESHOLD or more documents, and counts that
+     fail or time out, are taken as unselective (1.0)
     '''
-
-    if filters == None or len(filters) == 0:
-        return None
-
-    # skip date fields
-    filters_no_dates = list(filter(lambda x: not x.startswith("start_date:"), filters))
-    if len(filters_no_dates) == 0:
-        return None
-    elif len(filters_no_dates) == 1:
-        return filters_no_dates[0]
-    else:
-        joined = ') AND ('.join(filters_no_dates)
-        return f'({joined})'
+    count_cache = request.app.state.count_cache
+    key = ('selectivity', spec.collection, filters.clauses)
+    selectivity = count_cache.get(key)
+    if selectivity is not None:
+        return selectivity
+
+    collection = request.app.mongodb[spec.collection]
+    threshold = settings.VECTOR_SELECTIVITY_THRESHOLD
+    deadline = query_deadline('selectivity')
+    cursor = collection.aggregate([filter_count(spec, filters, threshold)], maxTimeMS=deadline)
+    try:
+        with stage('mongo'):
+            meta = await cursor.to_list(length=1)
+            total = await collection.estimated_document_count(maxTimeMS=deadline)
+    except PyMongoError as e:
+        logger.warning("filter selectivity unavailable for %s: %s", filters.clauses, e)
+        return 1.0
+    finally:
+        await cursor.close()
+
+    count = next(iter(meta[0]['count'].values())) if meta else 0
+    # the lowerBound count stops at threshold, so a larger share isn't known
+    selectivity = 1.0 if count >= threshold or not total else min(1.0, count / total)
+    count_cache.set(key, selectivity)
+    return selectivity
 
 ###############
 # Drug Router #
 ###############
 drug_project = {
-    '$project': {
+    '$project': Projection({
         '_id': 0,
         'active_ingredient': 1,
         'brand_name': 1,
@@ -759,45 +1157,88 @@ drug_project = {
         'openfda.generic_name': 1,
         'openfda.manufacturer_name': 1,
         'trial_pagination_token': 1,
-    }
+    })
 }
 
+drug_search = SearchSpec(
+    collection='drug_data',
+    index='drugs',
+    exists_path='id',
+    boost_paths=['openfda.brand_name'],
+    text_paths=['openfda.brand_name', 'openfda.generic_name', 'openfda.manufacturer_name'],
+    fuzzy=fuzzy,
+    vector_index='drugs_vector_index',
+    vector_path='description_vector',
+    token_field='drug_pagination_token',
+    highlight_paths=['openfda.brand_name', 'openfda.generic_name', 'openfda.manufacturer_name'],
+    project_first=True)
+
 drug_autocomplete_project = {
-    '$project': {
+    '$project': Projection({
         '_id': 0,
         'id': 1,
         'highlights': {'$meta': 'searchHighlights'},
         'brand_name': '$openfda.brand_name',
+    })
+}
+
+drug_facets_object = {
+    'manufacturers': {
+        'type': 'string',
+        'path': 'openfda.manufacturer_name',
+        'numBuckets': 10
+    },
+    'routes': {
+        'type': 'string',
+        'path': 'openfda.route',
+        'numBuckets': 10
     }
 }
 
-@drug_router.get("/", response_description="List all drugs")
+default_drug_facets_key = ('drugs.facets', 'default')
+
+@drug_router.get("/", response_description="List all drugs", response_model=DrugSearchResponse)
 async def list_drugs(
     request: Request,
     limit: Optional[int] = 100,
     skip: Optional[int] = None,
     pagination_token: Optional[str] = None,
     sort: Optional[str] = None,
-    sort_order: Optional[int] = 1):
-
-    drugs = await search_drugs(
+    sort_order: Optional[int] = 1,
+    fields: Optional[str] = None):
+
+    if sort in (None, 'id') and (pagination_token is None or is_keyset_token(pagination_token)):
+        # plain browsing doesn't need Atlas Search; page through the id index instead
+        return await cancel_on_disconnect(request, browse_collection(
+            request.app.mongodb["drug_data"],
+            key_field='id',
+            projection=drug_projection(fields, drug_project['$project']),
+            token_field='drug_pagination_token',
+            limit=limit,
+            skip=skip,
+            pagination_token=pagination_token,
+            sort_order=sort_order))
+
+    return await search_drugs(
         request,
         limit=limit,
         skip=skip,
         pagination_token=pagination_token,
         sort=sort,
         sort_order=sort_order,
+        fields=fields,
         filters=None)
-    return drugs
 
-@drug_router.get("/{uuid}", response_description="Get a single drug")
-async def show_drug(uuid: str, request: Request):
-    if (drug := await request.app.mongodb["drug_data"].find_one({"id": uuid}, {'_id': 0})) is not None:
+@drug_router.get("/{uuid}", response_description="Get a single drug", response_model=DrugResult)
+async def show_drug(uuid: str, request: Request, fields: Optional[str] = None):
+    project = drug_projection(fields, {'_id': 0})
+    if (drug := await find_one(request.app.mongodb["drug_data"], {"id": uuid}, project, 'lookup')) is not None:
         return drug
 
     raise HTTPException(status_code=404, detail=f"Drug {uuid} not found")
 
-@drug_router.post("/", response_description="Search for drugs")
+@drug_router.post("/", response_description="Search for drugs", response_model=DrugSearchResponse)
+@diagnosable
 async def search_drugs(
     request: Request,
     term: Optional[str] = None,
@@ -806,185 +1247,163 @@ async def search_drugs(
     sort: Optional[str] = None,
     sort_order: Optional[int] = None,
     use_vector: Optional[bool] = False,
-    num_candidates: Optional[int] = 1000,
+    mode: Optional[str] = None,
+    num_candidates: Optional[int] = None,
     pagination_token: Optional[str] = None,
+    include_facets: Optional[bool] = False,
+    count_mode: Optional[str] = 'total',
+    count_threshold: Optional[int] = 1000,
+    window_pages: Optional[int] = None,
+    session: Optional[str] = None,
+    fields: Optional[str] = None,
+    explain: Optional[bool] = False,
+    profile: Optional[bool] = False,
     filters: Optional[List[str]] = Query(None)):
+    check_count_mode(count_mode)
+    mode = search_mode(mode, use_vector)
+
+    if (window_pages and window_pages > 1) or session:
+        # deep pagination served from a server-side window of results
+        return await windowed_search(
+            request,
+            search_drugs,
+            token_field='drug_pagination_token',
+            session=session,
+            window_pages=window_pages,
+            limit=limit,
+            skip=skip,
+            term=term,
+            sort=sort,
+            sort_order=sort_order,
+            use_vector=use_vector,
+            mode=mode,
+            num_candidates=num_candidates,
+            include_facets=include_facets,
+            count_mode=count_mode,
+            count_threshold=count_threshold,
+            fields=fields,
+            filters=filters)
+
+    if mode == 'hybrid':
+        check_hybrid(term, sort, pagination_token)
+        return await hybrid_search(
+            request,
+            search_drugs,
+            key_field='id',
+            token_field='drug_pagination_token',
+            limit=limit,
+            skip=skip,
+            term=term,
+            num_candidates=num_candidates,
+            include_facets=include_facets,
+            count_mode=count_mode,
+            count_threshold=count_threshold,
+            fields=fields,
+            filters=filters)
+    use_vector = mode == 'vector'
     
-    default_filter_field = filters[0].split(":")[0] if filters != None and len(filters) > 0 else ""
-    query_string = await filters_to_query_string(filters)
-    mql_filter = await filters_to_mql_query(filters)
-
-    basic_search_no_term = {
-        '$search': {
-            'index': 'drugs',
-            'compound': {
-                'filter': [{
-                    'exists': { 'path': 'id' }
-                }]
-            },
-            'count': { 'type': 'total' }
-        }
-    }
-  
-    basic_search = {
-        '$search': {
-            'index': 'drugs',
-            'compound': {
-                'should': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'openfda.brand_name',
-                        ],
-                        'score': { 'boost': { 'value': 3 } }
-                    }
-                }],
-                'must': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'openfda.brand_name',
-                            'openfda.generic_name',
-                            'openfda.manufacturer_name'
-                        ],
-                        'fuzzy': fuzzy,
-                    }
-                }]
-            },
-            'count': { 'type': 'total' },
-            'highlight': {
-                'path': [
-                    'openfda.brand_name',
-                    'openfda.generic_name',
-                    'openfda.manufacturer_name'
-                ]
-            }
-        }
-    }
-  
-    search_with_filters = {
-        '$search': {
-            'index': 'drugs',
-            'compound': {
-                'should': [{
-                    'text': {
-                        'query': term,
-                        'path': [
-                            'openfda.brand_name',
-                        ],
-                        'score': { 'boost': { 'value': 3 } }
-                    }
-                }],
-                'must': [{
-                    'text': {
-                    'query': term,
-                    'path': [
-                        'openfda.brand_name',
-                        'openfda.generic_name',
-                        'openfda.manufacturer_name'
-                    ],
-                    'fuzzy': fuzzy
-                }
-            }],
-            'filter': [{
-                'queryString': {
-                    'defaultPath': default_filter_field,
-                    'query': query_string
-                }
-            }]
-        },
-            'count': { 'type': 'total' },
-            'highlight': {
-                'path': [
-                    'openfda.brand_name', 
-                    'openfda.generic_name', 
-                    'openfda.manufacturer_name'
-                ]
-            }
-        }
-    }
-
-    search_no_term_with_filters = {
-        '$search': {
-            'index': 'drugs',
-            'compound': {
-                'filter': [{
-                    'queryString': {
-                        'defaultPath': default_filter_field,
-                        'query': query_string
-                    }
-                }]
-            },
-            'count': { 'type': 'total' },
-        }
-    }
-
-    vector_search = {
-        '$vectorSearch': {
-            'index': 'drugs_vector_index', 
-            'queryVector': [],
-            'path': 'description_vector', 
-            'numCandidates': num_candidates,
-            'limit': limit
-        }
-    }
-    if mql_filter != None:
-        vector_search['$vectorSearch']['filter'] = mql_filter
-
-
-    add_fields = {
-        '$addFields': {
-            'score': {'$meta': 'searchScore'},
-            'highlights': {'$meta': 'searchHighlights'},
-            'drug_pagination_token': {'$meta' : 'searchSequenceToken'},
-        }
-    }
-
-    if (use_vector == True):
-        if (term is None):
-            raise HTTPException(status_code=422)
-        else:
-            add_fields['$addFields']['score'] = { '$meta': 'vectorSearchScore' }
-            #drug_project['$project']['description'] = 1
-    else:
-        add_fields['$addFields']['count'] = '$$SEARCH_META.count'
-
-    
-    pipeline = []
-    
-    if (term is None):
-        if query_string != None and len(query_string) > 0:
-            pipeline.append(search_no_term_with_filters)
-        else:
-            pipeline.append(basic_search_no_term)
-    else:
-        if (use_vector == True):
-            # vectorize the search term
-            vector_search['$vectorSearch']['queryVector'] = await get_cached_embeddings(request, term)
-            pipeline.append(vector_search)
-        else:
-            if query_string != None and len(query_string) > 0:
-                pipeline.append(search_with_filters)
-            else:
-                pipeline.append(basic_search)
-
-    # sorting
-    if (sort != None):
-        sort_order = 1 if sort_order == None else sort_order
-        pipeline[0]['$search']['sort'] = { sort: sort_order }
-
-    # pagination
-    if pagination_token != None:
-        pipeline[0]['$search']['searchAfter'] = pagination_token
-    elif skip and skip > 0:
-        pipeline.append({'$skip': skip})
-        
-    pipeline.extend([{'$limit': limit}, drug_project, add_fields])
+    pipeline = await drug_search_pipeline(
+        request,
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        fields=fields,
+        filters=filters)
+
+    # counting: once per query, later pages reuse the cached count
+    count_cache = request.app.state.count_cache
+    count_key = request_key(
+        'drugs.count',
+        term=term,
+        count_mode=count_mode,
+        count_threshold=count_threshold,
+        filters=filters or [])
+    count = count_cache.get(count_key) if use_vector == False and not diagnosing() else None
+    if use_vector == False:
+        set_count_collector(pipeline[0], None if count else count_mode, count_threshold)
+
+    if include_facets:
+        # hits and facet buckets from one $search evaluation
+        to_facet_collector(pipeline[0], drug_facets_object)
+    with_meta = use_vector == False and (include_facets or 'count' in pipeline[0]['$search'])
+    if with_meta:
+        pipeline.append(search_meta_facet)
     #print(pipeline)
 
-    drugs = await request.app.mongodb["drug_data"].aggregate(pipeline).to_list(length=limit)
-
-    return drugs
+    # identical concurrent searches share a single aggregation
+    key = request_key(
+        'drugs.search',
+        fields=fields,
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        count_mode=count_mode,
+        count_threshold=count_threshold,
+        filters=filters or [])
+
+    async def run_search():
+        drugs = await aggregate(request.app.mongodb["drug_data"], pipeline, 'search', length=limit)
+        if not with_meta:
+            return {'results': drugs, 'count': count}
+
+        results, meta = split_search_meta(drugs)
+        if meta is None:
+            meta = await empty_page_meta(
+                request.app.mongodb["drug_data"], pipeline[0], skip, pagination_token, drug_facets_object)
+        envelope = {'results': results, 'count': count}
+        if meta and 'count' in meta:
+            envelope['count'] = meta['count']
+            count_cache.set(count_key, meta['count'])
+        if include_facets:
+            envelope['facets'] = format_drug_facets([meta or empty_search_meta(drug_facets_object)])
+        return envelope
+
+    return await cancel_on_disconnect(request, shared(request, key, run_search))
+
+@timed('pipeline')
+async def drug_search_pipeline(
+    request: Request,
+    term: Optional[str],
+    limit: int,
+    skip: Optional[int],
+    pagination_token: Optional[str],
+    sort: Optional[str],
+    sort_order: Optional[int],
+    use_vector: Optional[bool],
+    num_candidates: Optional[int],
+    include_facets: Optional[bool],
+    filters: Optional[List[str]],
+    fields: Optional[str] = None):
+    '''
+    The $search (or $vectorSearch) pipeline for search_drugs and export_drugs,
+     up to and including the projection
+    '''
+    return await search_pipeline(
+        request,
+        drug_search,
+        drug_projection(fields, drug_project['$project']),
+        term=term,
+        limit=limit,
+        skip=skip,
+        pagination_token=pagination_token,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates,
+        include_facets=include_facets,
+        filters=filters)
 
 @drug_router.post("/autocomplete", response_description="Autocomplete search for drugs")
 async def autocomplete_drugs(
@@ -1016,18 +1435,59 @@ async def autocomplete_drugs(
         drug_autocomplete_project]
     #print(pipeline)
 
-    trials = await request.app.mongodb["drug_data"].aggregate(pipeline).to_list(length=limit)
+    trials = await cancel_on_disconnect(
+        request, aggregate(request.app.mongodb["drug_data"], pipeline, 'autocomplete', length=limit))
     return trials
 
+@drug_router.post("/export", response_description="Stream matching drugs as NDJSON, CSV or Arrow")
+async def export_drugs(
+    request: Request,
+    term: Optional[str] = None,
+    format: Optional[str] = 'ndjson',
+    batch_size: Optional[int] = None,
+    limit: Optional[int] = None,
+    sort: Optional[str] = None,
+    sort_order: Optional[int] = None,
+    use_vector: Optional[bool] = False,
+    num_candidates: Optional[int] = None,
+    filters: Optional[List[str]] = Query(None)):
+    '''
+    Same arguments as search_drugs, but every match is streamed from a single cursor
+     instead of paging through POST /drugs/
+    '''
+    batch_size, limit = export_bounds(batch_size, limit, use_vector)
+    pipeline = await drug_search_pipeline(
+        request,
+        term=term,
+        limit=limit,
+        skip=0,
+        pagination_token=None,
+        sort=sort,
+        sort_order=sort_order,
+        use_vector=use_vector,
+        num_candidates=num_candidates and max(num_candidates, limit),
+        include_facets=False,
+        filters=filters)
+    # nobody reads the count
+    pipeline[0].get('$search', {}).pop('count', None)
+
+    return export_response(
+        batches(request.app.mongodb["drug_data"], pipeline, 'export', batch_size),
+        drug_columns,
+        format,
+        filename='drugs')
+
 @drug_router.post("/facets", response_description="Facet search for drugs")
-async def search_trial_facets(
+@diagnosable
+async def search_drug_facets(
     request: Request,
     term: Optional[str] = None,
     filters: Optional[List[str]] = Query(None),
-    count_only: Optional[bool] = False):
+    count_only: Optional[bool] = False,
+    explain: Optional[bool] = False,
+    profile: Optional[bool] = False):
     
-    default_filter_field = filters[0].split(":")[0] if filters != None and len(filters) > 0 else ""
-    query_string = await filters_to_query_string(filters)
+    query_string = parse_filters(filters).query_string
 
     count_all_facets = {
         '$searchMeta': {
@@ -1052,27 +1512,7 @@ async def search_trial_facets(
         }
     }
   
-    drug_facets_object = {
-        'manufacturers': {
-            'type': 'string',
-            'path': 'openfda.manufacturer_name',
-            'numBuckets': 10
-        },
-        'routes': {
-            'type': 'string',
-            'path': 'openfda.route',
-            'numBuckets': 10
-        }
-    }
-
-    basic_facets_no_term = {
-        '$searchMeta': {
-            'index': 'drugs',
-            'facet': {
-                'facets': drug_facets_object
-            }
-        }
-    }
+    basic_facets_no_term = drug_facets_no_term()
   
     compound_operator = { 'compound': {} }
   
@@ -1110,9 +1550,14 @@ async def search_trial_facets(
   
     add_fields = { '$addFields': { 'count': '$$SEARCH_META.count' } }
     pipeline = []
+    # identical concurrent facet requests share a single aggregation
+    key = request_key(
+        'drugs.facets',
+        term=term,
+        filters=filters or [],
+        count_only=count_only)
   
     if count_only:
-        print('count_only')
         if query_string and len(query_string.strip()) > 0:
             # filters provided
             pipeline.append(count_facets_with_filters)
@@ -1120,7 +1565,6 @@ async def search_trial_facets(
             # no filters provided
             pipeline.append(count_all_facets)
     elif term and len(term.strip()) > 0:
-        print(f"not count only, term: {term}")
         # search term provided
         pipeline.append(search_facets_with_filters)
     elif query_string and len(query_string.strip()) > 0:
@@ -1128,22 +1572,56 @@ async def search_trial_facets(
         pipeline.append(search_facets_with_filters)
     else:
         # no search term or filters provided
+        key = default_drug_facets_key
         pipeline.append(basic_facets_no_term)
 
     #pipeline.append(add_fields);
     #print(pipeline)
   
-    facets = await request.app.mongodb["drug_data"].aggregate(pipeline).to_list()
-
-    if not count_only:
-        # reformat to match schema
-        buckets = facets[0]['facet']['manufacturers']['buckets']
-        manufacturers = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
-        buckets = facets[0]['facet']['routes']['buckets']
-        routes = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
-  
-        facets[0]['manufacturers'] = manufacturers
-        facets[0]['routes'] = routes
-        del facets[0]['facet']
-  
+    facet_cache = request.app.state.facet_cache
+    if not diagnosing() and (facets := facet_cache.get(key)) is not None:
+        return facets
+
+    async def run_facets():
+        facets = await aggregate(request.app.mongodb["drug_data"], pipeline, 'facets')
+        return facets if count_only else format_drug_facets(facets)
+
+    facets = await cancel_on_disconnect(request, shared(request, key, run_facets))
+    facet_cache.set(key, facets)
+    return facets
+
+def drug_facets_no_term():
+    return {
+        '$searchMeta': {
+            'index': 'drugs',
+            'facet': {
+                'facets': drug_facets_object
+            }
+        }
+    }
+
+def format_drug_facets(facets):
+    '''
+    Reformats the $searchMeta facet buckets to match the schema
+    '''
+    buckets = facets[0]['facet']['manufacturers']['buckets']
+    manufacturers = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+    buckets = facets[0]['facet']['routes']['buckets']
+    routes = list(map(lambda bucket: {'name': bucket['_id'], 'count': bucket['count']}, buckets))
+
+    facets[0]['manufacturers'] = manufacturers
+    facets[0]['routes'] = routes
+    del facets[0]['facet']
+
     return facets
+
+async def precompute_default_facets(db, facet_cache, ttl: float = 0):
+    '''
+    Computes the no-term/no-filter facets for trials and drugs and stores them
+     in the facet cache so the landing-page request never touches the database
+    '''
+    trial_facets = await aggregate(db["trials"], [trial_facets_no_term()], 'facets')
+    facet_cache.set(default_trial_facets_key, format_trial_facets(trial_facets), ttl=ttl)
+
+    drug_facets = await aggregate(db["drug_data"], [drug_facets_no_term()], 'facets')
+    facet_cache.set(default_drug_facets_key, format_drug_facets(drug_facets), ttl=ttl)
@@ -0,0 +1,70 @@
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Hashable
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls: the first caller for a key runs the
+     coroutine and every caller that arrives while it is in flight awaits the same
+     result (or exception). Nothing is cached once the call completes. The call is
+     cancelled once every caller waiting on it has been cancelled.
+
+     Each caller gets its own shallow copy of the result, so it may add or remove
+     top-level keys (or items); anything nested is shared and must not be modified
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.waiters = {}
+        self.executed = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]):
+        task = self.calls.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+
+        # shielded so one waiter disconnecting doesn't cancel the call for the others
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return copy.copy(await asyncio.shield(task))
+        except asyncio.CancelledError:
+            if self.waiters[task] == 1:
+                # nobody is left to use the result
+                self.cancelled += 1
+                task.cancel()
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if self.waiters[task] == 0:
+                del self.waiters[task]
+
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self.calls),
+            'executed': self.executed,
+            'shared': self.shared,
+            'cancelled': self.cancelled,
+        }
+
+def request_key(route: str, **params) -> tuple:
+    '''
+    Canonical, hashable key for a request: parameters sorted by name and
+     list values (e.g. filters) sorted so that their order doesn't matter
+    '''
+    canonical = []
+    for name, value in sorted(params.items()):
+        if isinstance(value, (list, tuple)):
+            value = tuple(sorted(value))
+        canonical.append((name, value))
+    return (route, tuple(canonical))
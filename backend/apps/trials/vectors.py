@@ -0,0 +1,51 @@
+import numpy as np
+from bson.binary import Binary, BinaryVectorDtype, VECTOR_SUBTYPE
+
+# per-element layout of BSON binary vectors (subtype 9), after the 2-byte dtype/padding header
+binary_dtypes = {
+    BinaryVectorDtype.FLOAT32.value[0]: np.dtype('<f4'),
+    BinaryVectorDtype.INT8.value[0]: np.dtype('i1'),
+}
+binary_formats = {
+    BinaryVectorDtype.FLOAT32.value[0]: 'float32',
+    BinaryVectorDtype.INT8.value[0]: 'int8',
+}
+
+def encode_vector(vector, format: str):
+    '''
+    A vector as stored and sent to $vectorSearch: 'array' is a BSON array of doubles
+     (8 bytes plus ~4 bytes of key per element), 'float32' a packed binary vector
+     (4 bytes per element) and 'int8' a binary vector scaled so the largest element is
+     +-127 (1 byte per element). int8 keeps cosine similarity, not magnitude
+    '''
+    if format == 'array':
+        return vector if isinstance(vector, list) else vector_array(vector).tolist()
+    array = vector_array(vector)
+    if format == 'float32':
+        return Binary.from_vector(array, BinaryVectorDtype.FLOAT32)
+    if format == 'int8':
+        scale = np.abs(array).max() if array.size else 0
+        quantized = np.round(array * (127 / scale)) if scale else np.zeros_like(array)
+        return Binary.from_vector(quantized.astype(np.int8).tolist(), BinaryVectorDtype.INT8)
+    raise ValueError(f"unknown vector format {format!r}")
+
+def vector_array(value) -> np.ndarray:
+    '''
+    float32 ndarray from any stored form (array, float32 or int8 binary vector)
+    '''
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        dtype = binary_dtypes.get(value[0])
+        if dtype is None:
+            raise ValueError(f"unsupported binary vector dtype {value[0]:#x}")
+        return np.frombuffer(value, dtype=dtype, offset=2).astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def vector_format(value) -> str:
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        return binary_formats.get(value[0], 'binary')
+    return 'array'
+
+def vector_length(value) -> int:
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        return (len(value) - 2) // binary_dtypes[value[0]].itemsize
+    return len(value) if value is not None else 0
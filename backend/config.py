@@ -1,9 +1,14 @@
+from typing import Dict, Literal, Optional
 from pydantic_settings import BaseSettings
 
 
 class CommonSettings(BaseSettings):
     APP_NAME: str = "MongoRx"
     DEBUG_MODE: bool = False
+    # DEBUG logs query strings, filters and pipelines
+    LOG_LEVEL: str = "INFO"
+    # required (X-Admin-Token header) for explain=true/profile=true; unset disables them
+    ADMIN_TOKEN: Optional[str] = None
 
 
 class ServerSettings(BaseSettings):
@@ -14,9 +19,86 @@ class ServerSettings(BaseSettings):
 class DatabaseSettings(BaseSettings):
     DB_URL: str
     DB_NAME: str
+    # "atlas" or "local" (in-process search engine, see apps/search)
+    SEARCH_BACKEND: str = "atlas"
+    LOCAL_CORPUS_PATH: Optional[str] = None
+    LOCAL_TRIALS: int = 2000
+    LOCAL_DRUGS: int = 1000
+    LOCAL_IVF_MIN_SIZE: int = 20000
+    # connection pool (see apps/trials/db.py)
+    DB_MAX_POOL_SIZE: int = 100
+    DB_MIN_POOL_SIZE: int = 10
+    DB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = 2000
+    # e.g. "zstd,snappy"; needs the zstandard / python-snappy packages
+    DB_COMPRESSORS: Optional[str] = None
+    DB_READ_PREFERENCE: str = "primary"
+    # maxTimeMS per query; QUERY_TIMEOUTS_MS overrides it per route
+    QUERY_TIMEOUT_MS: int = 10000
+    QUERY_TIMEOUTS_MS: Dict[str, int] = {
+        'autocomplete': 2000, 'lookup': 2000, 'embeddings': 2000, 'selectivity': 1000, 'export': 600000}
 
 
-class Settings(CommonSettings, ServerSettings, DatabaseSettings):
+class EmbeddingSettings(BaseSettings):
+    EMBEDDING_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_DEVICE: Optional[str] = None
+    EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_BATCH_WAIT_MS: float = 5
+    EMBEDDING_WORKERS: int = 1
+    # load the model during startup; keyword-only workers can turn this off and load on first vector query
+    EMBEDDING_PRELOAD: bool = True
+    # how query vectors are cached in queries and sent to $vectorSearch: BSON array of doubles,
+    # or float32/int8 binary vectors; must match the stored vector fields (tools/migrate_vectors.py)
+    VECTOR_FORMAT: Literal["array", "float32", "int8"] = "array"
+
+
+class CacheSettings(BaseSettings):
+    QUERY_CACHE_SIZE: int = 10000
+    QUERY_CACHE_TTL: float = 3600
+    FACET_CACHE_SIZE: int = 1000
+    FACET_CACHE_TTL: float = 300
+    FACET_REFRESH_INTERVAL: float = 300
+    COUNT_CACHE_SIZE: int = 10000
+    COUNT_CACHE_TTL: float = 300
+    RESULT_WINDOW_CACHE_SIZE: int = 256
+    RESULT_WINDOW_TTL: float = 600
+    RESULT_WINDOW_PAGES: int = 10
+    RESULT_WINDOW_MAX_PAGES: int = 20
+
+
+class ExportSettings(BaseSettings):
+    # documents per cursor batch and per streamed chunk
+    EXPORT_BATCH_SIZE: int = 500
+    EXPORT_MAX_BATCH_SIZE: int = 5000
+    EXPORT_MAX_ROWS: int = 1000000
+
+
+class VectorSearchSettings(BaseSettings):
+    # numCandidates when a request doesn't give num_candidates:
+    # limit * MULTIPLIER * selectivity ** -EXPONENT (see tools/calibrate_candidates.py)
+    VECTOR_CANDIDATE_MULTIPLIER: float = 10
+    VECTOR_SELECTIVITY_EXPONENT: float = 0.5
+    # Atlas' numCandidates cap
+    VECTOR_MAX_CANDIDATES: int = 10000
+    # filter selectivity is counted ($searchMeta) up to this many matches; filters
+    # matching more are treated as unselective
+    VECTOR_SELECTIVITY_THRESHOLD: int = 10000
+    # mode=hybrid: reciprocal rank fusion constant, larger flattens the rank weights
+    HYBRID_RRF_K: int = 60
+
+
+class CaptureSettings(BaseSettings):
+    # JSONL capture of /trials and /drugs requests for tools/replay.py; unset disables it
+    CAPTURE_PATH: Optional[str] = None
+    CAPTURE_SAMPLE_RATE: float = 0.01
+    # slower requests are always captured and logged
+    CAPTURE_SLOW_MS: float = 1000
+    CAPTURE_MAX_BYTES: int = 100 * 2**20
+    CAPTURE_BACKUPS: int = 5
+
+
+class Settings(
+    CommonSettings, ServerSettings, DatabaseSettings, EmbeddingSettings, CacheSettings, ExportSettings,
+    VectorSearchSettings, CaptureSettings):
     pass
 
 
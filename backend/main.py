@@ -1,23 +1,67 @@
+import time
+import_started = time.perf_counter()
+
+import asyncio
+import logging
 import uvicorn
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
 
-from apps.trials.routers import trial_router, drug_router
+from apps.trials.cache import LRUCache, ResultWindowCache
+from apps.trials.capture import CaptureMiddleware
+from apps.trials.db import connect
+from apps.trials import metrics
+from apps.trials.embeddings import EmbeddingBatcher, EmbeddingModel, current_rss
+from apps.trials.responses import BSONResponse
+from apps.trials.routers import trial_router, drug_router, precompute_default_facets
+from apps.trials.singleflight import SingleFlight
 from config import settings
 
+import_seconds = time.perf_counter() - import_started
+import_rss = current_rss()
+
+logging.basicConfig(
+    level=settings.LOG_LEVEL.upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("mongorx")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
+        logger.info("imported app in %.2fs rss_mib=%d", import_seconds, import_rss // 2**20)
         await startup_db_client()
+        await startup_indexes()
+        app.state.inflight = SingleFlight()
+        await startup_embedding_model()
+        await startup_query_cache()
+        await startup_facet_cache()
+        app.state.count_cache = LRUCache(maxsize=settings.COUNT_CACHE_SIZE, ttl=settings.COUNT_CACHE_TTL)
+        app.state.result_windows = ResultWindowCache(
+            maxsize=settings.RESULT_WINDOW_CACHE_SIZE,
+            ttl=settings.RESULT_WINDOW_TTL,
+            default_pages=settings.RESULT_WINDOW_PAGES,
+            max_pages=settings.RESULT_WINDOW_MAX_PAGES)
         yield
     finally:
+        await shutdown_facet_cache()
+        await shutdown_embedding_model()
         await shutdown_db_client()
         
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=BSONResponse)
+if settings.CAPTURE_PATH:
+    # innermost, so it records uncompressed response sizes
+    app.add_middleware(
+        CaptureMiddleware,
+        path=settings.CAPTURE_PATH,
+        sample_rate=settings.CAPTURE_SAMPLE_RATE,
+        slow_ms=settings.CAPTURE_SLOW_MS,
+        max_bytes=settings.CAPTURE_MAX_BYTES,
+        backups=settings.CAPTURE_BACKUPS)
 app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
 
 origins = ["*"]
@@ -31,13 +75,96 @@ app.add_middleware(
 
 #@app.on_event("startup")
 async def startup_db_client():
-    app.mongodb_client = AsyncIOMotorClient(settings.DB_URL)
-    app.mongodb = app.mongodb_client[settings.DB_NAME]
+    app.mongodb_client, app.mongodb = await connect()
 
 #@app.on_event("shutdown")
 async def shutdown_db_client():
     app.mongodb_client.close()
 
+async def startup_indexes():
+    # keyset pagination for list_trials/list_drugs (no-op if the indexes already exist)
+    try:
+        await app.mongodb["trials"].create_index("nct_id")
+        await app.mongodb["drug_data"].create_index("id")
+        # mlt_search's precomputed neighbour lookups
+        await app.mongodb["trial_neighbors"].create_index([("nct_id", 1), ("path", 1)], unique=True)
+    except PyMongoError as e:
+        logger.warning("unable to create browse indexes: %s", e)
+
+async def startup_embedding_model():
+    # load once and keep resident; the warmup encode keeps the first vector query from paying for it.
+    # Without EMBEDDING_PRELOAD the model is loaded by the first vector query instead
+    app.state.embedding_model = EmbeddingModel(settings.EMBEDDING_MODEL, device=settings.EMBEDDING_DEVICE)
+    if settings.EMBEDDING_PRELOAD:
+        app.state.embedding_model.load(warmup=True)
+        stats = app.state.embedding_model.stats()
+        logger.info(
+            "loaded %s in %.2fs rss_mib=%d", stats['model'], stats['load_time_seconds'], stats['rss_bytes'] // 2**20)
+
+    app.state.embedding_batcher = EmbeddingBatcher(
+        app.state.embedding_model,
+        max_batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_wait_ms=settings.EMBEDDING_BATCH_WAIT_MS,
+        workers=settings.EMBEDDING_WORKERS)
+    await app.state.embedding_batcher.start()
+
+async def startup_query_cache():
+    app.state.query_cache = LRUCache(maxsize=settings.QUERY_CACHE_SIZE, ttl=settings.QUERY_CACHE_TTL)
+    app.state.query_cache_stats = {'hits': 0, 'misses': 0}
+    try:
+        await app.mongodb["queries"].create_index("query", unique=True)
+    except PyMongoError as e:
+        # e.g. duplicate cache entries written before the index existed
+        logger.warning("unable to create unique index on queries.query: %s", e)
+
+async def startup_facet_cache():
+    app.state.facet_cache = LRUCache(maxsize=settings.FACET_CACHE_SIZE, ttl=settings.FACET_CACHE_TTL)
+    await refresh_default_facets()
+    app.state.facet_refresher = asyncio.create_task(refresh_default_facets_forever())
+
+async def refresh_default_facets():
+    try:
+        # kept for two refresh intervals so a failed refresh doesn't serve stale facets forever
+        await precompute_default_facets(
+            app.mongodb, app.state.facet_cache, ttl=2 * settings.FACET_REFRESH_INTERVAL)
+    except (PyMongoError, HTTPException) as e:
+        # HTTPException: the facets query hit its deadline
+        logger.warning("unable to precompute default facets: %s", e)
+
+async def refresh_default_facets_forever():
+    while True:
+        await asyncio.sleep(settings.FACET_REFRESH_INTERVAL)
+        await refresh_default_facets()
+
+async def shutdown_facet_cache():
+    if hasattr(app.state, 'facet_refresher'):
+        app.state.facet_refresher.cancel()
+
+async def shutdown_embedding_model():
+    if hasattr(app.state, 'embedding_batcher'):
+        await app.state.embedding_batcher.stop()
+
+@app.get("/metrics", response_description="Prometheus metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/status", response_description="Service status")
+async def status():
+    return {
+        'app': settings.APP_NAME,
+        'startup': {'import_seconds': import_seconds, 'import_rss_bytes': import_rss},
+        'embedding_model': app.state.embedding_model.stats(),
+        'embedding_batcher': app.state.embedding_batcher.stats(),
+        'inflight': app.state.inflight.stats(),
+        'facet_cache': app.state.facet_cache.stats(),
+        'count_cache': app.state.count_cache.stats(),
+        'result_windows': app.state.result_windows.stats(),
+        'query_cache': {
+            'memory': app.state.query_cache.stats(),
+            'mongodb': app.state.query_cache_stats,
+        },
+    }
+
 
 app.include_router(trial_router, tags=["trials"], prefix="/trials")
 app.include_router(drug_router, tags=["drugs"], prefix="/drugs")
@@ -0,0 +1,66 @@
+'''
+Tests run the app in-process against the local search engine (apps/search), with
+ query embeddings from a hash of the text rather than the model
+'''
+import asyncio
+import hashlib
+import os
+import sys
+
+import httpx
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DB_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'mongorx_test')
+os.environ['SEARCH_BACKEND'] = 'local'
+os.environ['EMBEDDING_PRELOAD'] = 'false'
+os.environ['CAPTURE_PATH'] = ''
+
+from fastapi.testclient import TestClient
+
+@pytest.fixture(scope='session')
+def client():
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+def hashed_embedding(text: str) -> list:
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little'))
+    vector = rng.standard_normal(384).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    from apps.trials import routers
+
+    async def create_embeddings(request, text):
+        return hashed_embedding(text)
+
+    monkeypatch.setattr(routers, 'create_embeddings', create_embeddings)
+
+@pytest.fixture
+def slow_queries(monkeypatch):
+    '''
+    Every aggregation takes 50ms longer, so identical concurrent requests overlap
+    '''
+    from apps.trials import routers
+    aggregate = routers.aggregate
+
+    async def slow_aggregate(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await aggregate(*args, **kwargs)
+
+    monkeypatch.setattr(routers, 'aggregate', slow_aggregate)
+
+def concurrently(client, method: str, url: str, count: int = 4, **kwargs) -> list:
+    '''
+    count identical requests at once, on the app's event loop
+    '''
+    async def send():
+        transport = httpx.ASGITransport(app=client.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as http:
+            return await asyncio.gather(*[http.request(method, url, **kwargs) for _ in range(count)])
+    return client.portal.call(send)
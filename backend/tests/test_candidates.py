@@ -0,0 +1,52 @@
+import pytest
+
+from apps.trials import routers
+from apps.trials.pipelines import candidates_for
+
+def test_candidates_grow_for_selective_filters():
+    assert candidates_for(10, 1.0, 10, 0.5, 10000) == 100
+    assert candidates_for(10, 0.01, 10, 0.5, 10000) == 1000
+    assert candidates_for(10, 1e-9, 10, 0.5, 10000) == 10000
+    # nothing passes the filter
+    assert candidates_for(10, 0.0, 10, 0.5, 10000) == 10
+
+@pytest.fixture
+def vector_stages(monkeypatch):
+    stages = []
+    aggregate = routers.aggregate
+
+    async def recording_aggregate(collection, pipeline, *args, **kwargs):
+        if '$vectorSearch' in pipeline[0]:
+            stages.append(pipeline[0]['$vectorSearch'])
+        return await aggregate(collection, pipeline, *args, **kwargs)
+
+    monkeypatch.setattr(routers, 'aggregate', recording_aggregate)
+    return stages
+
+@pytest.mark.parametrize('url, filter', [
+    ('/trials/', 'status:"Completed"'),
+    ('/trials/', 'start_date:2015-01-01'),
+    ('/drugs/', 'effective_time:2020-01-01'),
+])
+def test_filters_are_pushed_down_and_sized(client, embeddings, vector_stages, url, filter):
+    response = client.post(url, params={'term': 'pain', 'use_vector': True, 'limit': 10, 'filters': [filter]})
+    assert response.status_code == 200
+    assert response.json()['results']
+    search = vector_stages[-1]
+    assert search['filter']['$and']
+    # a filter narrower than the whole collection asks for more than the unfiltered 100
+    assert search['numCandidates'] > 100
+
+def test_broad_filters_count_as_unselective(client, embeddings, vector_stages, monkeypatch):
+    # the count stops at the threshold, so it can't tell how much more the filter matches
+    monkeypatch.setattr(routers.settings, 'VECTOR_SELECTIVITY_THRESHOLD', 1)
+    response = client.post('/trials/', params={'term': 'pain', 'use_vector': True, 'limit': 10, 'filters': ['status:"Recruiting"']})
+    assert response.status_code == 200
+    assert vector_stages[-1]['numCandidates'] == 100
+
+def test_failed_counts_fall_back_to_unselective(client, embeddings, vector_stages, monkeypatch):
+    monkeypatch.setattr(routers, 'filter_count', lambda *args: {'$searchMeta': {'index': 'default', 'unknown': {}}})
+    response = client.post('/trials/', params={'term': 'pain', 'use_vector': True, 'limit': 10, 'filters': ['status:"Terminated"']})
+    assert response.status_code == 200
+    assert response.json()['results']
+    assert vector_stages[-1]['numCandidates'] == 100
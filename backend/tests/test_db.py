@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from apps.trials.db import aggregate, cancel_on_disconnect
+
+class Connection:
+    def __init__(self, disconnect_after: float):
+        self.disconnect_after = disconnect_after
+        self.opened = None
+
+    async def is_disconnected(self) -> bool:
+        loop = asyncio.get_running_loop()
+        if self.opened is None:
+            self.opened = loop.time()
+        return loop.time() - self.opened >= self.disconnect_after
+
+def test_work_is_cancelled_when_the_client_goes_away():
+    async def run():
+        cancelled = []
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with pytest.raises(HTTPException) as raised:
+            await cancel_on_disconnect(Connection(0.02), work(), poll_interval=0.01)
+        await asyncio.sleep(0)
+        return raised.value, cancelled
+
+    error, cancelled = asyncio.run(run())
+    assert error.status_code == 499
+    assert cancelled == [True]
+
+def test_work_finishing_first_returns_its_result():
+    async def work():
+        await asyncio.sleep(0.01)
+        return ['result']
+
+    assert asyncio.run(cancel_on_disconnect(Connection(10), work(), poll_interval=0.01)) == ['result']
+
+class Cursor:
+    def __init__(self):
+        self.closed = False
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(10)
+
+    async def close(self):
+        self.closed = True
+
+class Collection:
+    name = 'trials'
+
+    def __init__(self):
+        self.cursor = Cursor()
+        self.options = None
+
+    def aggregate(self, pipeline, **options):
+        self.options = options
+        return self.cursor
+
+def test_cancelled_aggregations_close_their_cursor():
+    collection = Collection()
+
+    async def run():
+        with pytest.raises(HTTPException):
+            await cancel_on_disconnect(
+                Connection(0.02), aggregate(collection, [{'$match': {}}], 'search'), poll_interval=0.01)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert collection.cursor.closed
+    assert collection.options['maxTimeMS'] > 0
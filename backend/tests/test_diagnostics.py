@@ -0,0 +1,36 @@
+import pytest
+
+from config import settings
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(settings, 'ADMIN_TOKEN', 'letmein')
+    return 'letmein'
+
+def search(client, headers=None, **params):
+    return client.post('/trials/', params={'term': 'cancer', 'limit': 2, **params}, headers=headers or {})
+
+@pytest.mark.parametrize('flag', ['explain', 'profile'])
+def test_diagnostics_are_off_without_an_admin_token(client, monkeypatch, flag):
+    monkeypatch.setattr(settings, 'ADMIN_TOKEN', None)
+    response = search(client, headers={'X-Admin-Token': ''}, **{flag: True})
+    assert response.status_code == 403
+    assert response.json()['detail'] == "explain/profile are disabled (ADMIN_TOKEN is not set)"
+
+@pytest.mark.parametrize('headers', [{}, {'X-Admin-Token': 'guess'}])
+def test_diagnostics_need_the_admin_token(client, admin_token, headers):
+    response = search(client, headers=headers, explain=True)
+    assert response.status_code == 403
+
+def test_explain_and_profile_with_the_admin_token(client, admin_token):
+    response = search(client, headers={'X-Admin-Token': admin_token}, explain=True, profile=True)
+    assert response.status_code == 200
+    diagnostics = response.json()['diagnostics']
+    assert diagnostics['queries'][0]['collection'] == 'trials'
+    assert 'explain' in diagnostics['queries'][0]
+    assert diagnostics['profile']['samples'] >= 0
+
+def test_plain_requests_carry_no_diagnostics(client, admin_token):
+    response = search(client)
+    assert response.status_code == 200
+    assert 'diagnostics' not in response.json()
@@ -0,0 +1,45 @@
+import asyncio
+
+from apps.trials.embeddings import EmbeddingBatcher
+
+class CountingModel:
+    def __init__(self):
+        self.batches = []
+
+    def encode_batch(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+def test_batches_flush_at_max_batch_size():
+    async def run():
+        model = CountingModel()
+        # a wait long enough that only the size limit can flush in time
+        batcher = EmbeddingBatcher(model, max_batch_size=3, max_wait_ms=10000)
+        await batcher.start()
+        try:
+            vectors = await asyncio.wait_for(
+                asyncio.gather(*[batcher.encode('x' * n) for n in range(1, 7)]), timeout=5)
+        finally:
+            await batcher.stop()
+        return model, vectors
+
+    model, vectors = asyncio.run(run())
+    assert [len(batch) for batch in model.batches] == [3, 3]
+    assert vectors == [[float(n)] for n in range(1, 7)]
+
+def test_partial_batches_flush_after_max_wait():
+    async def run():
+        model = CountingModel()
+        batcher = EmbeddingBatcher(model, max_batch_size=32, max_wait_ms=20)
+        await batcher.start()
+        try:
+            vectors = await asyncio.wait_for(
+                asyncio.gather(batcher.encode('a'), batcher.encode('bb')), timeout=5)
+        finally:
+            await batcher.stop()
+        return model, batcher, vectors
+
+    model, batcher, vectors = asyncio.run(run())
+    assert model.batches == [['a', 'bb']]
+    assert vectors == [[1.0], [2.0]]
+    assert batcher.batches == 1 and batcher.texts == 2
@@ -0,0 +1,54 @@
+import asyncio
+import csv
+import io
+import json
+
+from apps.trials.export import export_response, trial_columns
+
+def test_ndjson_export_streams_every_match(client):
+    count = client.post('/trials/', params={'term': 'asthma', 'limit': 1}).json()['count']['total']
+    with client.stream('POST', '/trials/export', params={'term': 'asthma', 'batch_size': 7}) as response:
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        assert 'filename="trials.ndjson"' in response.headers['content-disposition']
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+    assert count > 7 and len(lines) == count
+    assert all(trial['nct_id'] for trial in lines)
+
+def test_csv_export_has_the_column_header(client):
+    with client.stream('POST', '/drugs/export', params={'term': 'pfizer', 'format': 'csv', 'limit': 5}) as response:
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/csv')
+        rows = list(csv.reader(io.StringIO(response.read().decode())))
+    assert rows[0][0] == 'id' and rows[0][-1] == 'score'
+    assert 1 <= len(rows) - 1 <= 5
+
+def test_unknown_formats_are_rejected(client):
+    response = client.post('/trials/export', params={'term': 'asthma', 'format': 'xml'})
+    assert response.status_code == 400
+
+def test_one_chunk_per_batch_read_as_sent():
+    read = []
+
+    async def batches():
+        for number in range(3):
+            read.append(number)
+            yield [{'nct_id': f'NCT{number}{n}', 'score': 1.0} for n in range(2)]
+
+    async def run(format):
+        read.clear()
+        chunks = export_response(batches(), trial_columns, format, 'trials').body_iterator
+        first = await chunks.__anext__()
+        # only the first batch has been read from the cursor so far
+        pending = list(read)
+        rest = [chunk async for chunk in chunks]
+        return first, pending, rest
+
+    first, pending, rest = asyncio.run(run('ndjson'))
+    assert pending == [0]
+    assert [len(chunk.splitlines()) for chunk in [first] + rest] == [2, 2, 2]
+
+    first, pending, rest = asyncio.run(run('csv'))
+    assert pending == [0]
+    assert first.decode().splitlines()[0].startswith('nct_id,')
+    assert [len(chunk.splitlines()) for chunk in rest] == [2, 2]
@@ -0,0 +1,28 @@
+import pytest
+from fastapi import HTTPException
+
+from apps.trials.fields import drug_projection, trial_presets, trial_projection
+
+def test_presets_and_fields_combine():
+    projection = trial_projection('card, official_title', default={})
+    assert projection['_id'] == 0
+    assert all(projection[name] == 1 for name in trial_presets['card'] + ['official_title', 'score'])
+    assert 'detailed_description' not in projection
+
+def test_unknown_fields_are_rejected():
+    with pytest.raises(HTTPException) as raised:
+        drug_projection('id,password,$where', default={})
+    assert raised.value.status_code == 400
+    assert raised.value.detail.startswith('Unknown fields: password, $where;')
+
+@pytest.mark.parametrize('method, url', [('GET', '/trials/'), ('POST', '/trials/'), ('GET', '/drugs/')])
+def test_routes_reject_unknown_fields(client, method, url):
+    response = client.request(method, url, params={'term': 'cancer', 'fields': 'nct_id,internal_notes'})
+    assert response.status_code == 400
+    assert 'internal_notes' in response.json()['detail']
+
+def test_routes_return_only_the_selected_fields(client):
+    response = client.post('/trials/', params={'term': 'cancer', 'limit': 3, 'fields': 'card'})
+    assert response.status_code == 200
+    allowed = set(trial_presets['card']) | {'score', 'trial_pagination_token', 'count'}
+    assert all(set(trial) <= allowed for trial in response.json()['results'])
@@ -0,0 +1,32 @@
+import pytest
+
+from apps.trials.fusion import reciprocal_rank_fusion
+from conftest import concurrently
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[{'id': 'a', 'score': 9}, {'id': 'b'}], [{'id': 'b'}, {'id': 'c'}]], 'id', k=60)
+    assert [document['id'] for document in fused] == ['b', 'a', 'c']
+    assert fused[0]['score'] == pytest.approx(1 / 62 + 1 / 61)
+
+@pytest.mark.parametrize('url, key', [('/trials/', 'nct_id'), ('/drugs/', 'id')])
+def test_concurrent_hybrid_searches(client, embeddings, slow_queries, url, key):
+    responses = concurrently(client, 'POST', url, params={'term': 'diabetes', 'mode': 'hybrid', 'limit': 10})
+    assert [response.status_code for response in responses] == [200] * 4
+    assert len({response.content for response in responses}) == 1
+    results = responses[0].json()['results']
+    assert results and len({document[key] for document in results}) == len(results)
+
+def test_hybrid_pages(client, embeddings):
+    params = {'term': 'diabetes', 'mode': 'hybrid'}
+    first = client.post('/trials/', params={**params, 'limit': 10}).json()['results']
+    second = client.post('/trials/', params={**params, 'limit': 5, 'skip': 5}).json()['results']
+    assert second == first[5:10]
+    assert all('trial_pagination_token' not in trial for trial in first)
+
+@pytest.mark.parametrize('params', [
+    {'mode': 'fuzzy', 'term': 'diabetes'},
+    {'mode': 'hybrid'},
+    {'mode': 'hybrid', 'term': 'diabetes', 'sort': 'start_date'},
+])
+def test_hybrid_rejects(client, params):
+    assert client.post('/trials/', params=params).status_code == 422
@@ -0,0 +1,37 @@
+import base64
+import json
+
+import pytest
+
+from apps.trials.routers import decode_keyset_token, encode_keyset_token, is_keyset_token
+
+@pytest.mark.parametrize('last_seen', ['NCT00000102', 'D-0042', 17])
+def test_tokens_round_trip(last_seen):
+    token = encode_keyset_token(last_seen)
+    assert is_keyset_token(token)
+    assert decode_keyset_token(token) == last_seen
+
+@pytest.mark.parametrize('url, key, token_field', [
+    ('/trials/', 'nct_id', 'trial_pagination_token'),
+    ('/drugs/', 'id', 'drug_pagination_token'),
+])
+def test_pages_continue_after_the_token(client, url, key, token_field):
+    first = client.get(url, params={'limit': 4}).json()['results']
+    token = first[1][token_field]
+    second = client.get(url, params={'limit': 2, 'pagination_token': token}).json()['results']
+    assert [document[key] for document in second] == [document[key] for document in first[2:4]]
+
+def forged(payload) -> str:
+    return 'ks1.' + base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+@pytest.mark.parametrize('token', [
+    'ks1.not-base64!',
+    'ks1.' + base64.urlsafe_b64encode(b'{"after": ').decode(),
+    forged({'before': 'NCT00000102'}),
+    forged({'after': {'$ne': None}}),
+    forged({'after': ['NCT00000102']}),
+])
+def test_tampered_tokens_are_rejected(client, token):
+    response = client.get('/trials/', params={'limit': 2, 'pagination_token': token})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Invalid pagination_token'
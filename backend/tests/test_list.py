@@ -0,0 +1,42 @@
+import pytest
+
+@pytest.mark.parametrize('url, params', [
+    ('/trials/', {}),
+    ('/trials/', {'sort': 'start_date'}),
+    ('/drugs/', {}),
+    ('/drugs/', {'sort': 'effective_time'}),
+])
+def test_list_pages_carry_one_count(client, url, params):
+    response = client.get(url, params={'limit': 5, **params})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page['results']) == 5
+    assert page['count']
+    assert all('count' not in document for document in page['results'])
+
+@pytest.mark.parametrize('url, count_mode', [
+    ('/trials/', 'total'),
+    ('/trials/', 'lowerBound'),
+    ('/drugs/', 'total'),
+])
+def test_search_without_hits_counts_zero(client, url, count_mode):
+    response = client.post(url, params={'term': 'zzqxv', 'count_mode': count_mode, 'include_facets': True})
+    assert response.status_code == 200
+    page = response.json()
+    assert page['results'] == []
+    assert page['count'] == {count_mode: 0}
+    assert page['facets']
+
+def buckets(facets):
+    return [{name: value for name, value in facet.items() if name != 'count'} for facet in facets]
+
+@pytest.mark.parametrize('url, term', [('/trials/', 'cancer'), ('/drugs/', 'pfizer')])
+def test_page_past_the_end_keeps_count_and_facets(client, url, term):
+    params = {'term': term, 'include_facets': True, 'limit': 10}
+    first = client.post(url, params=params).json()
+    assert first['count']['total'] > 0
+
+    past = client.post(url, params={**params, 'skip': 5000}).json()
+    assert past['results'] == []
+    assert past['count'] == first['count']
+    assert buckets(past['facets']) == buckets(first['facets'])
@@ -0,0 +1,30 @@
+from apps.trials import routers
+
+def first_trial(client):
+    return client.get('/trials/', params={'limit': 1}).json()['results'][0]['nct_id']
+
+def test_similar_by_stored_vector_reads_no_text(client, monkeypatch):
+    nct_id = first_trial(client)
+    projections = []
+    find_one = routers.find_one
+
+    async def recording_find_one(collection, query, projection, route):
+        projections.append(projection)
+        return await find_one(collection, query, projection, route)
+
+    monkeypatch.setattr(routers, 'find_one', recording_find_one)
+    response = client.post('/trials/mlt', params={'use_vector': True, 'limit': 5}, json={'nct_id': nct_id})
+    assert response.status_code == 200
+    trials = response.json()
+    assert len(trials) == 5 and nct_id not in {trial['nct_id'] for trial in trials}
+    assert projections == [routers.mlt_source_vector_project]
+
+def test_similar_by_text(client):
+    nct_id = first_trial(client)
+    response = client.post('/trials/mlt', params={'limit': 5}, json={'nct_id': nct_id})
+    assert response.status_code == 200
+    assert nct_id not in {trial['nct_id'] for trial in response.json()}
+
+def test_similar_to_unknown_trial(client):
+    response = client.post('/trials/mlt', params={'use_vector': True}, json={'nct_id': 'NCT99999999'})
+    assert response.status_code == 404
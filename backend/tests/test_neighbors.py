@@ -0,0 +1,54 @@
+import asyncio
+
+import numpy as np
+
+from apps.search import LocalClient
+from apps.trials.neighbors import NeighborGraph, collection_name, stored_neighbors
+
+path = 'detailed_description_vector'
+
+def trials(start: int, stop: int) -> list:
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((stop, 16))
+    return [
+        {'nct_id': f'NCT{row:08d}', 'brief_title': f'trial {row}', path: vectors[row].tolist()}
+        for row in range(start, stop)]
+
+async def stored(db) -> dict:
+    documents = db[collection_name].find({'path': path}, {'_id': 0, 'nct_id': 1, 'neighbors': 1})
+    return {
+        document['nct_id']: [(neighbor['nct_id'], round(neighbor['score'], 5)) for neighbor in document['neighbors']]
+        async for document in documents}
+
+def test_refresh_matches_a_full_build():
+    async def run():
+        refreshed = LocalClient()['refreshed']
+        await refreshed['trials'].insert_many(trials(0, 60))
+        await NeighborGraph(refreshed, path, k=5, workers=1, row_block=16, column_block=32).build()
+        await refreshed['trials'].insert_many(trials(60, 80))
+        stats = await NeighborGraph(refreshed, path, k=5, workers=1, row_block=16, column_block=32).refresh()
+
+        built = LocalClient()['built']
+        await built['trials'].insert_many(trials(0, 80))
+        await NeighborGraph(built, path, k=5, workers=1, row_block=16, column_block=32).build()
+
+        page = await stored_neighbors(refreshed, 'NCT00000070', path, skip=1, limit=3)
+        return stats, await stored(refreshed), await stored(built), page
+
+    stats, refreshed, built, page = asyncio.run(run())
+    assert stats['new'] == 20 and stats['updated'] > 0
+    assert refreshed == built
+    assert [neighbor['nct_id'] for neighbor in page] == [nct_id for nct_id, _ in built['NCT00000070'][1:4]]
+
+def test_refresh_without_new_trials_changes_nothing():
+    async def run():
+        db = LocalClient()['unchanged']
+        await db['trials'].insert_many(trials(0, 30))
+        graph = NeighborGraph(db, path, k=5, workers=1)
+        await graph.build()
+        before = await stored(db)
+        return await graph.refresh(), before, await stored(db)
+
+    stats, before, after = asyncio.run(run())
+    assert stats['new'] == 0 and stats['updated'] == 0
+    assert before == after and len(after) == 30
@@ -0,0 +1,27 @@
+import pytest
+
+from apps.trials.fields import Projection
+
+def list_payload(client):
+    search = client.post('/trials/', params={'term': 'cancer', 'limit': 20})
+    browse = client.get('/trials/', params={'limit': 20})
+    assert search.status_code == browse.status_code == 200
+    return [
+        (len(response.content), [sorted(trial) for trial in response.json()['results']])
+        for response in (search, browse)]
+
+def test_detail_view_leaves_list_projection_alone(client):
+    before = list_payload(client)
+    nct_id = client.get('/trials/', params={'limit': 1}).json()['results'][0]['nct_id']
+
+    detail = client.get(f'/trials/{nct_id}')
+    assert detail.status_code == 200
+    assert 'detailed_description' in detail.json()
+
+    assert list_payload(client) == before
+
+def test_projections_are_read_only():
+    projection = Projection({'_id': 0, 'nct_id': 1})
+    with pytest.raises(TypeError):
+        projection['detailed_description'] = 1
+    assert {**projection, 'url': 1} == {'_id': 0, 'nct_id': 1, 'url': 1}
@@ -0,0 +1,74 @@
+import asyncio
+
+from apps.trials.singleflight import SingleFlight
+from conftest import concurrently
+
+def test_waiters_get_their_own_copy():
+    async def run():
+        flight = SingleFlight()
+
+        async def search():
+            await asyncio.sleep(0.01)
+            return {'results': [1, 2], 'count': 2}
+
+        envelopes = await asyncio.gather(*[flight.do('key', search) for _ in range(3)])
+        return flight, envelopes
+
+    flight, envelopes = asyncio.run(run())
+    assert flight.executed == 1 and flight.shared == 2
+    envelopes[0].pop('results')
+    assert all(envelope['results'] == [1, 2] for envelope in envelopes[1:])
+
+def test_concurrent_searches_share_one_query(client, slow_queries):
+    inflight = client.app.state.inflight
+    shared = inflight.shared
+    responses = concurrently(client, 'POST', '/trials/', params={'term': 'asthma', 'limit': 5})
+    assert [response.status_code for response in responses] == [200] * 4
+    assert len({response.content for response in responses}) == 1
+    assert inflight.shared > shared
+
+def test_call_outlives_a_cancelled_waiter():
+    async def run():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def search():
+            started.set()
+            await asyncio.sleep(0.05)
+            return {'count': 1}
+
+        first = asyncio.ensure_future(flight.do('key', search))
+        second = asyncio.ensure_future(flight.do('key', search))
+        await started.wait()
+        first.cancel()
+        return flight, await second, first.cancelled()
+
+    flight, envelope, cancelled = asyncio.run(run())
+    assert cancelled and envelope == {'count': 1}
+    assert flight.cancelled == 0
+
+def test_call_is_cancelled_with_its_last_waiter():
+    async def run():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        finished = []
+
+        async def search():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                finished.append('cancelled')
+                raise
+
+        waiters = [asyncio.ensure_future(flight.do('key', search)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flight, finished
+
+    flight, finished = asyncio.run(run())
+    assert finished == ['cancelled']
+    assert flight.cancelled == 1 and flight.stats()['in_flight'] == 0
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from apps.search.vector import as_array
+from apps.trials.vectors import encode_vector, vector_array, vector_format, vector_length
+
+vector = [0.5, -1.0, 0.25, 0.0]
+
+@pytest.mark.parametrize('format', ['array', 'float32', 'int8'])
+def test_round_trip(format):
+    encoded = encode_vector(vector, format)
+    assert vector_format(encoded) == format
+    assert vector_length(encoded) == len(vector)
+    decoded = vector_array(encoded)
+    cosine = decoded @ np.asarray(vector) / (np.linalg.norm(decoded) * np.linalg.norm(vector))
+    assert cosine == pytest.approx(1.0, abs=1e-4)
+    # the local engine decodes stored vectors the same way
+    assert np.array_equal(as_array(encoded), decoded)
+
+def test_empty_vectors_are_skipped():
+    assert as_array(None) is None
+    assert as_array([]) is None
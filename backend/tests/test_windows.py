@@ -0,0 +1,17 @@
+from conftest import concurrently
+
+def test_concurrent_window_sessions(client, slow_queries):
+    responses = concurrently(
+        client, 'POST', '/trials/', params={'term': 'asthma', 'limit': 5, 'window_pages': 3})
+    assert [response.status_code for response in responses] == [200] * 4
+    pages = [response.json() for response in responses]
+    assert len({page['session'] for page in pages}) == 4
+    assert all(page['results'] == pages[0]['results'] for page in pages)
+
+def test_window_serves_later_pages(client):
+    first = client.post('/trials/', params={'term': 'asthma', 'limit': 5, 'window_pages': 3}).json()
+    second = client.post(
+        '/trials/', params={'term': 'asthma', 'limit': 5, 'skip': 5, 'session': first['session']}).json()
+    plain = client.post('/trials/', params={'term': 'asthma', 'limit': 10}).json()
+    assert [trial['nct_id'] for trial in first['results'] + second['results']] == \
+        [trial['nct_id'] for trial in plain['results']]
@@ -0,0 +1,99 @@
+'''
+Load test the API in-process against the local search engine (SEARCH_BACKEND=local)
+ or whatever backend the environment configures:
+
+    cd backend
+    SEARCH_BACKEND=local DB_URL=local DB_NAME=ClinicalTrials python tools/benchmark.py --requests 2000 --concurrency 32
+'''
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SEARCH_BACKEND", "local")
+os.environ.setdefault("DB_URL", "local")
+os.environ.setdefault("DB_NAME", "ClinicalTrials")
+
+import httpx
+
+from apps.search.corpus import conditions, interventions
+
+def terms():
+    return [c.lower() for c in conditions] + [i.lower() for i in interventions] + ['cancr', 'diabetis', 'metformn']
+
+def make_request(route: str, rng: random.Random):
+    term = rng.choice(terms())
+    if route == 'search':
+        return 'POST', '/trials/', {'term': term, 'limit': 20}
+    if route == 'search_filters':
+        return 'POST', '/trials/', {'term': term, 'limit': 20, 'filters': ['status:"Completed"']}
+    if route == 'deep_page':
+        return 'POST', '/trials/', {'term': term, 'limit': 20, 'skip': 20 * rng.randint(5, 20)}
+    if route == 'facets':
+        return 'POST', '/trials/facets', {'term': term}
+    if route == 'facets_default':
+        return 'POST', '/trials/facets', {}
+    if route == 'autocomplete':
+        return 'POST', '/trials/autocomplete', {'term': term[:rng.randint(2, 5)]}
+    if route == 'list':
+        return 'GET', '/trials/', {'limit': 100, 'skip': 100 * rng.randint(0, 10)}
+    if route == 'drugs':
+        return 'POST', '/drugs/', {'term': term, 'limit': 20}
+    if route == 'drug_facets':
+        return 'POST', '/drugs/facets', {'term': term}
+    if route == 'vector':
+        return 'POST', '/trials/', {'term': term, 'limit': 20, 'use_vector': True}
+    raise ValueError(f"unknown route {route}")
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run(args):
+    from main import app
+
+    rng = random.Random(args.seed)
+    routes = args.routes.split(',')
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(rng.choice(routes))
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            async def worker():
+                while not queue.empty():
+                    route = queue.get_nowait()
+                    method, path, params = make_request(route, rng)
+                    start = time.perf_counter()
+                    response = await client.request(method, path, params=params)
+                    latencies[route].append(time.perf_counter() - start)
+                    if response.status_code >= 400:
+                        errors[route] += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+            elapsed = time.perf_counter() - started
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {elapsed:.2f}s, {args.requests / elapsed:.1f} req/s")
+    print(f"{'route':<16}{'n':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route in routes:
+        values = latencies[route]
+        print(f"{route:<16}{len(values):>7}{errors[route]:>8}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--routes", default="search,search_filters,deep_page,facets,facets_default,autocomplete,list,drugs,drug_facets")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
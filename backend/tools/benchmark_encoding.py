@@ -0,0 +1,63 @@
+'''
+Compare response encoding for result pages: FastAPI's jsonable_encoder + json (what
+ routes used before BSONResponse) against BSONResponse (orjson), on synthetic trial
+ and drug pages shaped like the list/search projections:
+
+    cd backend
+    DB_URL=local DB_NAME=ClinicalTrials python tools/benchmark_encoding.py --page-size 100
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_URL", "local")
+os.environ.setdefault("DB_NAME", "ClinicalTrials")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from apps.search.corpus import synthetic_drugs, synthetic_trials
+from apps.search.pipeline import project
+from apps.trials.responses import BSONResponse
+from apps.trials.routers import drug_project, trial_project
+
+def page(documents: list, projection: dict) -> dict:
+    results = [project(d, projection, {}, {}) for d in documents]
+    for document in results:
+        document['score'] = 1.0
+    return {'results': results, 'count': {'total': 12345}}
+
+def throughput(encode, content, seconds: float) -> float:
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        encode(content)
+        done += 1
+    return done / (time.perf_counter() - started)
+
+def main(args):
+    pages = {
+        'trials': page(synthetic_trials(args.page_size), trial_project['$project']),
+        'drugs': page(synthetic_drugs(args.page_size), drug_project['$project']),
+    }
+    encoders = {
+        'jsonable_encoder': lambda content: JSONResponse(jsonable_encoder(content)).body,
+        'BSONResponse': lambda content: BSONResponse(content).body,
+    }
+
+    print(f"{args.page_size} documents per page")
+    print(f"{'page':<10}{'encoder':<20}{'pages/s':>12}{'bytes':>10}")
+    for name, content in pages.items():
+        baseline = None
+        for encoder_name, encode in encoders.items():
+            rate = throughput(encode, content, args.seconds)
+            baseline = baseline or rate
+            print(f"{name:<10}{encoder_name:<20}{rate:>12.0f}{len(encode(content)):>10}  x{rate / baseline:.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=2)
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+'''
+Precompute each trial's nearest neighbours by stored vector into trial_neighbors, which
+ mlt_search (POST /trials/mlt {"nct_id": ...} with use_vector) serves from:
+
+    cd backend
+    python tools/build_neighbors.py --k 20 --workers 8            # full rebuild
+    python tools/build_neighbors.py --refresh                     # only trials added since the last run
+
+Against SEARCH_BACKEND=local the corpus only lives in this process, so this measures
+ the job (and checks it against an exact search) rather than storing anything.
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.trials.db import connect
+from apps.trials.neighbors import NeighborGraph, collection_name
+
+async def check(db, graph: NeighborGraph, samples: int):
+    '''
+    Recall of the stored lists against an exact search over the same vectors
+    '''
+    cards, matrix = await graph.load()
+    rng = np.random.default_rng(0)
+    found = total = 0
+    for row in rng.choice(len(cards), min(samples, len(cards)), replace=False):
+        scores = matrix @ matrix[row]
+        scores[row] = -np.inf
+        exact = {cards[i]['nct_id'] for i in np.argsort(-scores)[:graph.k]}
+        stored = await db[collection_name].find_one({'nct_id': cards[row]['nct_id'], 'path': graph.path})
+        found += len(exact & {neighbor['nct_id'] for neighbor in stored['neighbors']})
+        total += len(exact)
+    print(f"recall@{graph.k} over {min(samples, len(cards))} trials: {found / max(total, 1):.4f}")
+
+async def run(args):
+    client, db = await connect()
+    try:
+        await db[collection_name].create_index([("nct_id", 1), ("path", 1)], unique=True)
+        graph = NeighborGraph(
+            db,
+            path=args.path,
+            k=args.k,
+            workers=args.workers,
+            row_block=args.row_block,
+            column_block=args.column_block)
+        started = time.perf_counter()
+        stats = await (graph.refresh() if args.refresh else graph.build())
+        print(f"{'refresh' if args.refresh else 'build'} of {args.path} k={args.k} in {time.perf_counter() - started:.2f}s: "
+              + ', '.join(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}" for name, value in stats.items()))
+        if args.check:
+            await check(db, graph, args.check)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="detailed_description_vector", choices=["detailed_description_vector", "brief_summary_vector"])
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--row-block", type=int, default=256)
+    parser.add_argument("--column-block", type=int, default=16384)
+    parser.add_argument("--refresh", action="store_true", help="only trials without neighbours yet")
+    parser.add_argument("--check", type=int, default=0, metavar="N", help="check recall against exact search for N trials")
+    asyncio.run(run(parser.parse_args()))
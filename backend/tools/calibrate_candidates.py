@@ -0,0 +1,174 @@
+'''
+Fit VECTOR_CANDIDATE_MULTIPLIER and VECTOR_SELECTIVITY_EXPONENT to a recall target.
+ Runs $vectorSearch over a grid of numCandidates, for pre-filters of increasing
+ selectivity, and scores recall@limit against an exact filtered kNN (numpy, over the
+ same stored vectors) alongside the latency of each setting:
+
+    cd backend
+    python tools/calibrate_candidates.py --recall 0.95 --limit 10 --queries 50
+    python tools/calibrate_candidates.py --fields status,phase --multipliers 1,2,4,8,16
+
+Query vectors are sampled from the stored trial vectors. Against SEARCH_BACKEND=local
+ $vectorSearch is exact below LOCAL_IVF_MIN_SIZE vectors, so raise LOCAL_TRIALS (or
+ lower LOCAL_IVF_MIN_SIZE) to calibrate anything meaningful.
+'''
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.trials.db import connect
+from apps.trials.pipelines import parse_filters
+from apps.trials.vectors import encode_vector, vector_array
+from config import settings
+
+index = 'trials_vector_index'
+
+async def load(db, path: str, fields: list):
+    '''
+    nct_ids, filter field values and normalized vectors of every trial with a vector
+    '''
+    ids = []
+    values = []
+    vectors = []
+    projection = {'_id': 0, 'nct_id': 1, path: 1, **{field: 1 for field in fields}}
+    async for trial in db["trials"].find({path: {'$exists': True}}, projection).batch_size(2000):
+        vector = trial.pop(path)
+        if vector:
+            ids.append(trial['nct_id'])
+            values.append(trial)
+            vectors.append(vector_array(vector))
+    matrix = np.vstack(vectors)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return np.asarray(ids), values, matrix
+
+def choose_filters(values: list, fields: list, limit: int) -> list:
+    '''
+    (selectivity, field:value list, row mask) for no filter plus the closest filter to
+     each selectivity in 1/2, 1/4, ..., from single fields and pairs of fields, with at
+     least limit matches
+    '''
+    total = len(values)
+    singles = []
+    for field in fields:
+        seen = {}
+        for row, trial in enumerate(values):
+            value = trial.get(field)
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, str):
+                    seen.setdefault(item, []).append(row)
+        for value, rows in seen.items():
+            mask = np.zeros(total, dtype=bool)
+            mask[rows] = True
+            singles.append(([(field, value)], mask))
+
+    candidates = list(singles)
+    for (first, first_mask), (second, second_mask) in itertools.combinations(singles, 2):
+        if first[0][0] != second[0][0]:
+            candidates.append((first + second, first_mask & second_mask))
+    candidates = [
+        (mask.sum() / total, clauses, mask) for clauses, mask in candidates if limit <= mask.sum() < total]
+
+    chosen = [(1.0, [], np.ones(total, dtype=bool))]
+    target = 0.5
+    while candidates and target * total >= limit:
+        best = min(candidates, key=lambda candidate: abs(math.log(candidate[0] / target)))
+        if abs(math.log(best[0] / target)) < math.log(2) / 2 and best[0] < chosen[-1][0]:
+            chosen.append(best)
+        target /= 2
+    return chosen
+
+async def measure(db, path: str, queries, ids, matrix, clauses, mask, limit, grid):
+    '''
+    Mean recall@limit and median latency for each numCandidates in grid
+    '''
+    mql = parse_filters([f'{field}:"{value}"' for field, value in clauses]).mql
+    allowed = np.flatnonzero(mask)
+    results = {candidates: ([], []) for candidates in grid}
+    for query in queries:
+        scores = matrix[allowed] @ query
+        exact = set(ids[allowed[np.argsort(-scores)[:limit]]])
+        for candidates in grid:
+            search = {
+                'index': index,
+                'queryVector': encode_vector(query.tolist(), settings.VECTOR_FORMAT),
+                'path': path,
+                'numCandidates': candidates,
+                'limit': limit,
+            }
+            if mql is not None:
+                search['filter'] = mql
+            started = time.perf_counter()
+            found = await db["trials"].aggregate([{'$vectorSearch': search}, {'$project': {'_id': 0, 'nct_id': 1}}]).to_list(length=limit)
+            elapsed = time.perf_counter() - started
+            recalls, latencies = results[candidates]
+            recalls.append(len(exact & {trial['nct_id'] for trial in found}) / max(len(exact), 1))
+            latencies.append(elapsed * 1000)
+    return {candidates: (float(np.mean(recalls)), float(np.median(latencies))) for candidates, (recalls, latencies) in results.items()}
+
+def fit(needed: list):
+    '''
+    multiplier, exponent with limit * multiplier * selectivity ** -exponent at or above
+     every (selectivity, smallest multiplier reaching the target) point: a least squares
+     line through log(multiplier) against -log(selectivity), raised to cover the worst point
+    '''
+    x = np.asarray([-math.log(selectivity) for selectivity, _ in needed])
+    y = np.asarray([math.log(multiplier) for _, multiplier in needed])
+    exponent = max(0.0, float(np.polyfit(x, y, 1)[0])) if len(needed) > 1 and np.ptp(x) > 0 else 0.0
+    multiplier = math.exp(float(np.max(y - exponent * x)))
+    return multiplier, exponent
+
+async def run(args):
+    client, db = await connect()
+    try:
+        fields = args.fields.split(',')
+        started = time.perf_counter()
+        ids, values, matrix = await load(db, args.path, fields)
+        print(f"loaded {len(ids)} vectors ({matrix.shape[1]} dimensions) in {time.perf_counter() - started:.1f}s")
+
+        rng = np.random.default_rng(args.seed)
+        queries = matrix[rng.choice(len(ids), min(args.queries, len(ids)), replace=False)]
+        multipliers = [float(value) for value in args.multipliers.split(',')]
+        grid = sorted({min(settings.VECTOR_MAX_CANDIDATES, max(args.limit, math.ceil(args.limit * m))) for m in multipliers})
+
+        print(f"{'selectivity':>11}  {'numCandidates':>13}{'recall':>8}{'p50 ms':>9}  filter")
+        needed = []
+        for selectivity, clauses, mask in choose_filters(values, fields, args.limit):
+            measured = await measure(db, args.path, queries, ids, matrix, clauses, mask, args.limit, grid)
+            label = ' '.join(f'{field}:"{value}"' for field, value in clauses) or '-'
+            for candidates, (recall, latency) in measured.items():
+                print(f"{selectivity:>11.4f}  {candidates:>13}{recall:>8.3f}{latency:>9.1f}  {label}")
+            reached = [candidates for candidates, (recall, _) in measured.items() if recall >= args.recall]
+            if reached:
+                needed.append((selectivity, min(reached) / args.limit))
+            else:
+                print(f"{'':>11}  recall {args.recall} not reached by {grid[-1]} candidates")
+
+        if not needed:
+            print("no filter reached the recall target; widen --multipliers")
+            return
+        multiplier, exponent = fit(needed)
+        print(f"\nsmallest numCandidates / limit for recall >= {args.recall}: "
+              + ', '.join(f"{multiplier:g} at {selectivity:.4f}" for selectivity, multiplier in needed))
+        print(f"VECTOR_CANDIDATE_MULTIPLIER={multiplier:.2f}")
+        print(f"VECTOR_SELECTIVITY_EXPONENT={exponent:.2f}")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="detailed_description_vector", choices=["detailed_description_vector", "brief_summary_vector"])
+    parser.add_argument("--recall", type=float, default=0.95, help="recall@limit target")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=50, help="query vectors per filter")
+    parser.add_argument("--fields", default="status,phase,gender,study_type", help="comma separated filter fields")
+    parser.add_argument("--multipliers", default="1,2,4,8,16,32,64,128", help="numCandidates / limit grid")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,83 @@
+'''
+Rewrite stored vectors in another format (see VECTOR_FORMAT): BSON arrays of doubles,
+ float32 binary vectors (~3x smaller) or int8 binary vectors (~12x smaller):
+
+    cd backend
+    python tools/migrate_vectors.py --format float32 --dry-run     # sizes only
+    python tools/migrate_vectors.py --format float32
+    python tools/migrate_vectors.py --format int8 --fields trials.detailed_description_vector
+
+Switch VECTOR_FORMAT (and, on Atlas, rebuild the vector indexes) once the fields are
+ migrated; queryVector has to match the indexed format. Going back from int8 only
+ restores the quantized values.
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import bson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.trials.db import connect
+from apps.trials.vectors import encode_vector, vector_format
+
+fields = [
+    'queries.vector',
+    'trials.detailed_description_vector',
+    'trials.brief_summary_vector',
+    'drug_data.description_vector',
+]
+
+async def migrate(db, field: str, format: str, batch_size: int, dry_run: bool):
+    collection_name, path = field.split('.', 1)
+    collection = db[collection_name]
+    started = time.perf_counter()
+    scanned = converted = before = after = 0
+    updates = []
+
+    async def flush():
+        if updates and not dry_run:
+            await asyncio.gather(*[
+                collection.update_one({'_id': _id}, {'$set': {path: vector}}) for _id, vector in updates])
+        updates.clear()
+
+    async for document in collection.find({path: {'$exists': True}}, {path: 1}).batch_size(batch_size):
+        scanned += 1
+        vector = document[path]
+        size = len(bson.encode({path: vector}))
+        before += size
+        if vector_format(vector) == format or not len(vector):
+            after += size
+            continue
+
+        encoded = encode_vector(vector, format)
+        after += len(bson.encode({path: encoded}))
+        updates.append((document['_id'], encoded))
+        converted += 1
+        if len(updates) >= batch_size:
+            await flush()
+    await flush()
+
+    print(f"{field:<38}{scanned:>9}{converted:>10}{before / max(scanned, 1):>11.0f}{after / max(scanned, 1):>10.0f}"
+          f"{before / max(after, 1):>8.1f}x{time.perf_counter() - started:>8.1f}s")
+
+async def run(args):
+    # against SEARCH_BACKEND=local this shows the sizes of the in-process corpus, storing nothing
+    client, db = await connect()
+    try:
+        print(f"{'field':<38}{'docs':>9}{'converted':>10}{'bytes/doc':>11}{'after':>10}{'ratio':>9}{'time':>9}")
+        for field in args.fields.split(','):
+            await migrate(db, field, args.format, args.batch_size, args.dry_run)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", required=True, choices=["array", "float32", "int8"])
+    parser.add_argument("--fields", default=','.join(fields), help="comma separated collection.path list")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="report sizes without writing")
+    asyncio.run(run(parser.parse_args()))
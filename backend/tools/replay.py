@@ -0,0 +1,118 @@
+'''
+Replay requests captured by CaptureMiddleware (CAPTURE_PATH) against a running server,
+ or in-process against this checkout, and report throughput and latency percentiles:
+
+    cd backend
+    python tools/replay.py capture.jsonl capture.jsonl.1 --base-url http://localhost:8000 --concurrency 32 --speed 2
+    SEARCH_BACKEND=local DB_URL=local DB_NAME=ClinicalTrials python tools/replay.py capture.jsonl --in-process
+
+Requests are issued on the captured schedule divided by --speed (--speed 0 sends them
+ back to back), with at most --concurrency in flight.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+
+def load(paths: list, slow_only: bool = False) -> list:
+    records = []
+    for path in paths:
+        with open(path) as lines:
+            for line in lines:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get('slow') or not slow_only:
+                        records.append(record)
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def replay(args, client: httpx.AsyncClient, records: list):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    sizes = defaultdict(int)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def issue(record):
+        async with slots:
+            start = time.perf_counter()
+            try:
+                response = await client.request(
+                    record['method'],
+                    record['path'],
+                    params=record['query'],
+                    content=record['body'].encode() if record.get('body') else None,
+                    headers={'content-type': 'application/json'} if record.get('body') else None)
+                if response.status_code >= 400:
+                    errors[record['route']] += 1
+                sizes[record['route']] += len(response.content)
+            except httpx.HTTPError:
+                errors[record['route']] += 1
+            latencies[record['route']].append(time.perf_counter() - start)
+
+    first = records[0]['ts']
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        if args.speed > 0:
+            delay = (record['ts'] - first) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(issue(record)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    print(f"{len(records)} requests, concurrency {args.concurrency}, speed {args.speed}x, "
+          f"{elapsed:.2f}s, {len(records) / elapsed:.1f} req/s")
+    print(f"{'route':<28}{'n':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'avg KB':>9}")
+    for route, values in sorted(latencies.items(), key=lambda item: -len(item[1])):
+        print(f"{route:<28}{len(values):>7}{errors[route]:>8}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{sizes[route] / len(values) / 1024:>9.1f}")
+    everything = [value for values in latencies.values() for value in values]
+    print(f"{'all':<28}{len(everything):>7}{sum(errors.values()):>8}"
+          f"{percentile(everything, 50) * 1000:>10.1f}{percentile(everything, 95) * 1000:>10.1f}"
+          f"{percentile(everything, 99) * 1000:>10.1f}")
+
+async def run(args):
+    records = load(args.captures, args.slow_only)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        sys.exit("no requests in the capture")
+
+    if not args.in_process:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=None) as client:
+            await replay(args, client, records)
+        return
+
+    # don't capture the replay into the files being replayed
+    os.environ['CAPTURE_PATH'] = ''
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=None) as client:
+            await replay(args, client, records)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="capture files (JSONL), e.g. capture.jsonl capture.jsonl.1")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--in-process", action="store_true", help="replay against main.app instead of --base-url")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--speed", type=float, default=1.0, help="schedule multiplier; 0 replays back to back")
+    parser.add_argument("--slow-only", action="store_true", help="only replay requests captured as slow")
+    parser.add_argument("--limit", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
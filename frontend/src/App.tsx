@@ -40,7 +40,8 @@ function App() {
   async function getTrialList(url: string, searchParams: any, config: any): Promise<void> {
     // TODO: axios query string parameters
     const response = await axios.get(url + '/trials', config);
-    return response.data;
+    // {results, count}
+    return response.data.results;
   }
   
   async function handleSubmit(event: React.FormEvent<HTMLFormElement>) {